@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 from collections import OrderedDict
 
 def calc_out(input, kernel=1, stride=1, padding=0, dilation=0):
@@ -13,6 +14,32 @@ def calc_same_padding(input_, kernel=1, stride=1, dilation=1, transposed=False):
     else:
         return (dilation*(kernel-1) + 1) // 2, input_ // stride
 
+def tile_windows(size, tile, kernel, stride=1, padding=0, dilation=1, transposed=False):
+    """
+    Split one spatial axis of a (transposed) convolution into output tiles of length tile.
+    Returns per tile: the input slice including the halo of the kernel, the zero padding
+    (low, high) this slice needs at the borders, and the part of the unpadded convolution
+    of the slice that belongs to the tile
+    """
+    span = dilation*(kernel-1) + 1
+    if transposed:
+        out_size = (size-1)*stride - 2*padding + span
+    else:
+        out_size = (size + 2*padding - span) // stride + 1
+    windows = []
+    for o0 in range(0, out_size, tile):
+        o1 = min(o0 + tile, out_size)
+        if transposed:
+            i0 = max(-((span - 1 - o0 - padding) // stride), 0)     # first input reaching o0
+            i1 = min((o1 - 1 + padding) // stride + 1, size)        # past the last input reaching o1-1
+            first = i0*stride - padding                             # output position of the slice's first output
+            windows.append((slice(i0, i1), (0, 0), slice(o0 - first, o1 - first)))
+        else:
+            start = o0*stride - padding
+            stop = (o1-1)*stride - padding + span
+            windows.append((slice(max(start, 0), min(stop, size)), (max(-start, 0), max(stop - size, 0)), slice(None)))
+    return windows
+
 def make_decoder(layer_sizes, out_activation, std=0.1):
     last_layer_size = layer_sizes[0]
     layer_sizes.pop(0)
@@ -44,9 +71,11 @@ class CapsuleLayer(torch.nn.Module):
     
     """
     output_dim:    number of classes
+    tile:          route tile x tile output positions at a time (Conv2d and ConvTranspose2d voting),
+                   bounds the memory of the votes for large images. Same output as untiled
     """
     
-    def __init__(self, output_dim, output_atoms, num_routing, voting, device = torch.device('cuda')):
+    def __init__(self, output_dim, output_atoms, num_routing, voting, device = torch.device('cuda'), tile=None):
         super(CapsuleLayer, self).__init__()
 
         self.not_initialized = True
@@ -55,6 +84,7 @@ class CapsuleLayer(torch.nn.Module):
         self.num_routing = num_routing
         self.voting = voting
         self.device = device
+        self.tile = tile
         self.bias = nn.Parameter(torch.Tensor(self.output_dim, self.output_atoms, 1, 1))
         nn.init.constant_(self.bias.data, val=0.1)
 
@@ -97,16 +127,48 @@ class CapsuleLayer(torch.nn.Module):
             self.standard = True
         else:
             nn.init.normal_(self.conv.weight.data, mean=0,std=0.1)
-            self.conv.cuda(self.device)
+            self.conv.to(self.device)
             self.standard = False
         self.not_initialized = False
 
 
     def forward(self, x):
-        x_sh = x.size()                                             # batch_size, input_dim, input_atoms, dim_x, dim_y
         if self.not_initialized:
-            self.init(x_sh[1], x_sh[2])
-
+            self.init(x.size(1), x.size(2))
+
+        if self.tile and self.voting['type'] in ('Conv2d', 'ConvTranspose2d'):
+            return self.tiled(x)
+        return self.route(x)
+
+    def tiled(self, x):
+        """
+        Routing is local to each output position, so only the voting convolution needs the neighbourhood
+        of a tile: every tile is routed from its input slice plus halo, and the tiles are stitched together.
+        Only the votes of one tile exist at a time; with gradients the tiles are checkpointed and
+        their votes are recomputed in backward
+        """
+        transposed = self.voting['type'] == 'ConvTranspose2d'
+        if transposed and any(self.conv.output_padding):
+            raise NotImplementedError('Tiling does not support output_padding')
+        windows = [tile_windows(x.size(3+d), self.tile, self.conv.kernel_size[d], self.conv.stride[d],
+                                self.conv.padding[d], self.conv.dilation[d], transposed) for d in range(2)]
+        rows = []
+        for y_in, y_pad, y_out in windows[0]:
+            tiles = []
+            for x_in, x_pad, x_out in windows[1]:
+                x_tile = F.pad(x[..., y_in, x_in], x_pad + y_pad)    # batch_size, input_dim, input_atoms, tile+halo, tile+halo
+                if torch.is_grad_enabled():
+                    tiles.append(checkpoint(self.route, x_tile, (y_out, x_out), use_reentrant=False))
+                else:
+                    tiles.append(self.route(x_tile, (y_out, x_out)))
+            rows.append(torch.cat(tiles, dim=-1))
+        return torch.cat(rows, dim=-2)                              # batch_size, output_dim, output_atoms, dim_x, dim_y
+
+    def route(self, x, crop=None):
+        """
+        crop: the input is a padded tile, convolve without padding and keep crop (y, x) of the result
+        """
+        x_sh = x.size()                                             # batch_size, input_dim, input_atoms, dim_x, dim_y
         if self.standard:
             x.unsqueeze_(3)                                         # batch_size, input_dim, input_atoms, 1, dim_x, dim_y
             tile_shape = list(x.size())
@@ -115,49 +177,56 @@ class CapsuleLayer(torch.nn.Module):
             x = torch.sum(x * self.weights, dim=2)                  # batch_size, input_dim, output_dim*output_atoms
         else:
             x = x.view(x_sh[0]*x_sh[1], x_sh[2], x_sh[3], x_sh[4])  # batch_size*input_dim, input_atoms, dim_x, dim_y
-            x = self.conv(x)                                        # batch_size, input_atoms, dim_x, dim_y
+            if crop is None:
+                x = self.conv(x)                                    # batch_size, input_atoms, dim_x, dim_y
+            else:
+                conv = F.conv_transpose2d if self.voting['type'] == 'ConvTranspose2d' else F.conv2d
+                x = conv(x, self.conv.weight, stride=self.conv.stride, dilation=self.conv.dilation)[..., crop[0], crop[1]]
             
         votes = x.view(x_sh[0], x_sh[1], self.output_dim, self.output_atoms, x.size(-2), x.size(-1))
                                                                     # batch_size, input_dim, output_dim, output_atoms, dim_x, dim_y
-        biases_replicated = self.bias.repeat([1,1,x.size(-2),x.size(-1)])
-                                                                    # output_dim, output_atoms, dim_x, dim_y
-        logit_shape = list(votes.size())
-        logit_shape.pop(3)                                          # batch_size, input_dim, output_dim, dim_x, dim_y
+                                                                    # self.bias: output_dim, output_atoms, 1, 1 broadcasts over dim_x, dim_y
+        return dynamic_routing(votes, self.bias, self.num_routing, capsule_dim=2)
 
-        return _routing(votes=votes, biases=biases_replicated, logit_shape=logit_shape, num_routing=self.num_routing, device=self.device)
 
-
-def _routing(votes, biases, logit_shape, num_routing, device):
-    votes_t_shape = [3, 0, 1, 2, 4, 5]
-    r_t_shape = [1, 2, 3, 0, 4, 5]
+def _routing(votes, biases, num_routing):
                                                                     # votes: batch_size, input_dim, output_dim, output_atoms, (dim_x, dim_y)
-    
-    votes_trans = votes.permute(votes_t_shape)                      # output_atoms, batch_size, input_dim, output_dim, (dim_x, dim_y)
-    votes_trans_stopped = votes_trans.clone().detach()
+    return dynamic_routing(votes, biases, num_routing, capsule_dim=2)
+                                                                    # batch_size, output_dim, output_atoms, (dim_x, dim_y)
 
-    logits = Variable(torch.zeros(logit_shape, device=device), requires_grad=False)
-                                                                    # batch_size, input_dim, output_dim, (dim_x, dim_y)
-    for i in range(num_routing):
-        route = F.softmax(logits, 2)                                # batch_size, input_dim, output_dim, (dim_x, dim_y)
+def dynamic_routing(votes, biases, num_routing, capsule_dim, detach_logits=False):
+    """
+    Routing by agreement with broadcast products, on any device. Also the routing of SegCaps-tensorflow
+    (capsule_layers_pytorch.update_routing), which imports it from here.
 
-        if i == num_routing - 1:
-            preactivate_unrolled = route * votes_trans              # output_atoms, batch_size, input_dim, output_dim, (dim_x, dim_y)
-            preact_trans = preactivate_unrolled.permute(r_t_shape)  # batch_size, input_dim, output_dim, output_atoms, (dim_x, dim_y)
-            preactivate = torch.sum(preact_trans, dim=1) + biases   # batch_size, output_dim, output_atoms, (dim_x, dim_y)
-            activation = _squash(preactivate)                       # squashing of "output_atoms" dimension
-        else:
-            preactivate_unrolled = route * votes_trans_stopped      # output_atoms, batch_size, input_dim, output_dim, (dim_x, dim_y)
-            preact_trans = preactivate_unrolled.permute(r_t_shape)  # batch_size, input_dim, output_dim, output_atoms, (dim_x, dim_y)
-            preactivate = torch.sum(preact_trans, dim=1) + biases   # batch_size, output_dim, output_atoms, (dim_x, dim_y)
-            activation = _squash(preactivate)                       # squashing of "output_atoms" dimension
-
-            act_3d = activation.unsqueeze_(1)                       # batch_size, 1, output_dim, output_atoms, (dim_x, dim_y)
-            distances = torch.sum(votes * act_3d, dim=3)            # batch_size, input_dim, output_dim, (dim_x, dim_y)
-            logits = logits + distances                             # batch_size, input_dim, output_dim, (dim_x, dim_y)
-            
-    return activation                                               # batch_size, output_dim, output_atoms, (dim_x, dim_y)
+    votes:      batch_size, input_dim, ... with output_dim at capsule_dim and output_atoms right after it,
+                all other dims are spatial
+    biases:     broadcastable to the output (votes without input_dim)
+    detach_logits: the agreement does not take part in the gradient (votes and activations stopped)
 
-def _squash(input_tensor):
-    norm = torch.norm(input_tensor, p=2, dim=2, keepdim=True)
+    Neither the votes nor the activations are permuted or replicated over input_dim, and only the
+    last activation is kept. All iterations but the last use stopped votes.
+    Returns the squashed output capsules (votes without input_dim)
+    """
+    atom_dim = capsule_dim + 1
+    votes_stopped = votes.detach()
+    logits = votes.new_zeros(votes.shape[:atom_dim] + votes.shape[atom_dim+1:])
+                                                                    # batch_size, input_dim, ..., output_dim, ...
+    for i in range(num_routing):
+        route = F.softmax(logits, dim=capsule_dim).unsqueeze(atom_dim)
+        last = i == num_routing - 1
+        preactivate = (route * (votes if last else votes_stopped)).sum(1) + biases
+        activation = _squash(preactivate, dim=atom_dim - 1)        # batch_size, ..., output_dim, output_atoms, ...
+        if not last:
+            if detach_logits:
+                distances = (votes_stopped * activation.detach().unsqueeze(1)).sum(atom_dim)
+            else:
+                distances = (votes * activation.unsqueeze(1)).sum(atom_dim)
+            logits = logits + distances
+
+    return activation
+
+def _squash(input_tensor, dim=2):
+    norm = torch.norm(input_tensor, p=2, dim=dim, keepdim=True)
     norm_squared = norm * norm
     return (input_tensor / norm) * (norm_squared / (1 + norm_squared))
@@ -17,6 +17,7 @@ from torchvision.utils import make_grid
 import numpy as np
 import random
 import os
+import sys
 import glob
 
 import argparse
@@ -24,6 +25,10 @@ from tqdm import tqdm
 import torchnet as tnt
 from torchnet.logger import VisdomPlotLogger, VisdomLogger
 
+# one image folder index for both projects, the one of PoseCapsules_experimental2/folder_index.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PoseCapsules_experimental2'))
+from folder_index import image_index
+
 torch.manual_seed(1991)
 torch.cuda.manual_seed(1991)
 random.seed(1991)
@@ -41,17 +46,32 @@ def gaussian(ins, is_training, mean, stddev):
     return ins
 
 class MyImageFolder(datasets.ImageFolder):
+    """
+    Image folder with the pose labels in the file names. The folder scan and the labels come from image_index,
+    so a large folder is not rescanned and no file name is parsed again
+    """
+    def __init__(self, root, transform=None, target_transform=None):
+        self.index = image_index(root)
+        super(MyImageFolder, self).__init__(root, transform, target_transform)
+        self.labels, self.offsets = self.index['labels'], self.index['offsets']
+        del self.index
+
+    def find_classes(self, directory):
+        classes = self.index['classes'].tolist()
+        return classes, {c: i for i, c in enumerate(classes)}
+
+    def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None, allow_empty=False):
+        """ os.path.join(directory, path), spelled out for the hundreds of thousands of paths """
+        prefix = os.path.join(os.path.expanduser(directory), '')
+        return list(zip([prefix + path.decode('utf-8', 'surrogateescape') for path in self.index['paths'].tolist()], self.index['targets'].tolist()))
+
     def __getitem__(self, index):
         path, target = self.samples[index]
         sample = self.loader(path)
         if self.transform is not None:
             sample = self.transform(sample)
-        data = path.split('/')
-        data = data[-1].split('_')
-        data[-1] = data[-1].split('.p')[0]
-        data = [float(i) for i in data]
         
-        labels = np.asarray(data)
+        labels = self.labels[self.offsets[index]:self.offsets[index+1]].copy()
         
         return sample, labels
 
@@ -90,6 +110,10 @@ if __name__ == '__main__':
                         help='loss to use: cross_entropy_loss, margin_loss, spread_loss')
     parser.add_argument('--routing', type=str, default='EM_routing', metavar='N',
                         help='routing to use: angle_routing, EM_routing')
+    parser.add_argument('--routing-tol', type=float, default=None, metavar='N',
+                        help='stop EM_routing of a test sample once its routing coefficients change less than this')
+    parser.add_argument('--routing-bytes', type=int, default=None, metavar='N',
+                        help='memory budget in bytes for one tile of output capsules in EM_routing (default: route all at once)')
     parser.add_argument('--recon-factor', type=float, default=0.0001, metavar='N',
                         help='use reconstruction loss or not')
     parser.add_argument('--num-workers', type=int, default=4, metavar='N',
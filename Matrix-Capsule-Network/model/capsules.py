@@ -140,53 +140,117 @@ class ConvCaps(nn.Module):
         self.h = h
         self.hh = self.h*self.h
         self.routing = args.routing
+        self.routing_bytes = args.routing_bytes
+        self.routing_tol = args.routing_tol
+        self.iteration_count = 0
+        self.sample_count = 0
         self.eps = 1e-10
+        self.coord_offsets = {}  # (K, width_in, device, dtype) -> b,B,K,K,C,w,w,4,4 broadcastable offset
+
+    def _apply(self, fn):
+        self.coord_offsets = {}
+        return super(ConvCaps, self)._apply(fn)
 
     def coordinate_addition(self, width_in, votes):
-        add = [[i / width_in, j / width_in] for i in range(width_in) for j in range(width_in)]  # K,K,w,w
-        if self.W.is_cuda:
-            add = torch.Tensor(add).cuda()
-        else:
-            add = torch.Tensor(add)
-        add = Variable(add).view(1, 1, self.K, self.K, 1, 1, 1, 2)
-        add = add.expand(self.b, self.B, self.K, self.K, self.C, 1, 1, 2).contiguous()
-        votes[:, :, :, :, :, :, :, :2, -1] = votes[:, :, :, :, :, :, :, :2, -1] + add
-        return votes
+        key = (self.K, width_in, votes.device, votes.dtype)
+        add = self.coord_offsets.get(key)
+        if add is None:
+            # built once per geometry and broadcast over batch, B and C
+            dist = torch.arange(self.K, device=votes.device, dtype=votes.dtype) / width_in
+            add = votes.new_zeros(self.K, self.K, self.h, self.h)
+            add[:, :, 0, -1] = dist.view(-1, 1)
+            add[:, :, 1, -1] = dist
+            add = add.view(1, 1, self.K, self.K, 1, 1, 1, self.h, self.h)
+            self.coord_offsets[key] = add
+        return votes + add
 
     #def down_w(self, w):
     #    return range(w * self.stride, w * self.stride + self.K)
 
+    def routing_tile(self, V):
+        """
+        Number of output capsules (Cww) routed at once, such that about three
+        (b, Bkk, tile, hh) intermediates fit in args.routing_bytes
+        """
+        if self.routing_bytes is None:
+            return self.Cww
+        column_bytes = 3 * self.b * self.Bkk * self.hh * V.element_size()
+        return max(1, min(self.Cww, int(self.routing_bytes // column_bytes)))
+
+    def mean_iterations(self):
+        """ Average number of EM iterations per sample since the last reset_iterations() """
+        return self.iteration_count / max(self.sample_count, 1)
+
+    def reset_iterations(self):
+        self.iteration_count = 0
+        self.sample_count = 0
+
     def EM_routing(self, lambda_, a_, V):
         # routing coefficient
         if self.W.is_cuda:
             R = Variable(torch.ones([self.b, self.Bkk, self.Cww]), requires_grad=False).cuda() / self.Cww
         else:
             R = Variable(torch.ones([self.b, self.Bkk, self.Cww]), requires_grad=False) / self.Cww
+        tile = self.routing_tile(V)
+        b = self.b
+
+        # convergence-adaptive routing (inference only): converged samples are frozen and removed from the batch
+        adaptive = self.routing_tol is not None and not self.training
+        if adaptive:
+            active = torch.arange(b, device=V.device)
+            a_out, mu_out = V.new_empty(b, self.Cww), V.new_empty(b, 1, self.Cww, self.hh)
 
         for i in range(self.iteration):
-            # M-step
+            # M-step, tile by tile along the output capsules
+            R_prev = R
             R = (R * a_).unsqueeze(-1)
             sum_R = R.sum(1)
-            mu = ((R * V).sum(1) / sum_R).unsqueeze(1)
-            sigma_square = ((R * (V - mu) ** 2).sum(1) / sum_R).unsqueeze(1)
-
-            cost = (self.beta_v + torch.log(sigma_square.sqrt().view(self.b,self.C,-1,self.hh)+self.eps)) * sum_R.view(self.b, self.C,-1,1)
+            mu, sigma_square = [], []
+            for t in range(0, self.Cww, tile):
+                R_, V_, sum_R_ = R[:, :, t:t+tile], V[:, :, t:t+tile], sum_R[:, t:t+tile]
+                mu_ = ((R_ * V_).sum(1) / sum_R_).unsqueeze(1)
+                sigma_square.append(((R_ * (V_ - mu_) ** 2).sum(1) / sum_R_).unsqueeze(1))
+                mu.append(mu_)
+            mu, sigma_square = torch.cat(mu, 2), torch.cat(sigma_square, 2)
+
+            cost = (self.beta_v + torch.log(sigma_square.sqrt().view(b,self.C,-1,self.hh)+self.eps)) * sum_R.view(b, self.C,-1,1)
             a = torch.sigmoid(lambda_ * (self.beta_a - cost.sum(-1)))
-            a = a.view(self.b, self.Cww)
+            a = a.view(b, self.Cww)
 
             # E-step
             if i != self.iteration - 1:
                 #mu, sigma_square, V_, a__ = mu.data, sigma_square.data, V.data, a.data
-                normal = Normal(mu, sigma_square.sqrt())
-                p = torch.exp(normal.log_prob(V+self.eps))   # https://stackoverflow.com/questions/40472499/issue-nan-with-adam-solver
-                ap = a[:,None,:] * p.sum(-1)
+                p = []
+                for t in range(0, self.Cww, tile):
+                    normal = Normal(mu[:, :, t:t+tile], sigma_square[:, :, t:t+tile].sqrt())
+                    p.append(torch.exp(normal.log_prob(V[:, :, t:t+tile]+self.eps)).sum(-1))   # https://stackoverflow.com/questions/40472499/issue-nan-with-adam-solver
+                ap = a[:,None,:] * torch.cat(p, 2)
                 R = Variable(ap / (torch.sum(ap, -1, keepdim=True) + self.eps), requires_grad=False)
 
+                if adaptive:
+                    converged = (R - R_prev).abs().view(b, -1).max(1)[0] < self.routing_tol
+                    if converged.any():
+                        done = active[converged]
+                        a_out[done], mu_out[done] = a[converged], mu[converged]
+                        self.iteration_count += (i+1) * done.numel()
+                        keep = ~converged
+                        active, V, a_, R = active[keep], V[keep], a_[keep], R[keep]
+                        b = V.shape[0]
+                        if b == 0:
+                            break
+
+        if adaptive:
+            if b > 0:
+                a_out[active], mu_out[active] = a, mu
+                self.iteration_count += self.iteration * b
+            self.sample_count += self.b
+            a, mu = a_out, mu_out
+
         return a, mu
 
     def angle_routing(self, lambda_, a_, V):
         # routing coefficient
-        R = Variable(torch.zeros([self.b, self.Bkk, self.Cww]), requires_grad=False).cuda()
+        R = V.new_zeros((self.b, self.Bkk, self.Cww))
 
         for i in range(self.iteration):
             R = F.softmax(R, dim=1)
@@ -196,12 +260,13 @@ class ConvCaps(nn.Module):
 
             if i != self.iteration - 1:
                 u_v = mu.permute(0, 2, 1, 3) @ V.permute(0, 2, 3, 1)
-                u_v = u_v.squeeze().permute(0, 2, 1) / V.norm(2, -1) / mu.norm(2, -1)
-                R = R.squeeze() + u_v
+                u_v = u_v.squeeze(2).permute(0, 2, 1) / V.norm(2, -1) / mu.norm(2, -1)
+                R = R.squeeze(-1) + u_v
             else:
+                # beta_v, beta_a per output capsule type, shared over the w*w positions as in EM_routing
                 sigma_square = (R * (V - mu) ** 2).sum(1) / sum_R
-                const = (self.beta_v.expand_as(sigma_square) + torch.log(sigma_square)) * sum_R
-                a = torch.sigmoid(lambda_ * (self.beta_a.repeat(self.b, 1) - const.sum(2)))
+                const = (self.beta_v + torch.log(sigma_square.view(self.b, self.C, -1, self.hh))) * sum_R.view(self.b, self.C, -1, 1)
+                a = torch.sigmoid(lambda_ * (self.beta_a - const.sum(-1))).view(self.b, self.Cww)
 
         return a, mu
 
@@ -217,30 +282,29 @@ class ConvCaps(nn.Module):
         if self.transform_share:
             if self.K == 0:
                 self.K = width_in  # class Capsules' kernel = width_in
-            W = self.W.view(self.B, 1, 1, self.C, self.h, self.h).expand(self.B, self.K, self.K, self.C, self.h, self.h).contiguous()
-        else:
-            W = self.W  # B,K,K,C,4,4
 
         self.Bkk = self.K * self.K * self.B
 
         # used to store every capsule i's poses in each capsule c's receptive field
         #pose = poses.contiguous()  # b,16*32,12,12
-        pose = poses.view(self.b, self.hh, self.B, width_in, width_in).permute(0, 2, 3, 4, 1).contiguous()  # b,B,12,12,16
-        poses = torch.stack([pose[:, :, self.stride * i:self.stride * i + self.K,
-                             self.stride * j:self.stride * j + self.K, :] for i in range(w) for j in range(w)],
-                            dim=-1)  # b,B,K,K,w*w,16
-        poses = poses.view(self.b, self.B, self.K, self.K, 1, w, w, self.h, self.h)  # b,B,K,K,1,w,w,4,4
-        W_hat = W[None, :, :, :, :, None, None, :, :]  # 1,B,K,K,C,1,1,4,4
-        votes = W_hat @ poses  # b,B,K,K,C,w,w,4,4
+        pose = poses.view(self.b, self.hh, self.B, width_in, width_in).permute(0, 2, 3, 4, 1)  # b,B,12,12,16
+        # receptive fields as a strided view, copied once into the same (b,B,K,K,16,w*w) layout as before
+        poses = pose.unfold(2, self.K, self.stride).unfold(3, self.K, self.stride)  # b,B,w,w,16,K,K
+        poses = poses.permute(0, 1, 5, 6, 4, 2, 3).reshape(self.b, self.B, self.K, self.K, w, w, self.h, self.h)  # b,B,K,K,w,w,4,4
+        # one batched matmul per (B,K,K) group instead of b*B*K*K*C*w*w 4x4 products
+        if self.transform_share:
+            # shared B,C,4,4 weight broadcast over K,K inside the matmul, no B,K,K,C,4,4 copy
+            votes = torch.einsum('ncij,bnklxyjm->bnklcxyim', self.W, poses)  # b,B,K,K,C,w,w,4,4
+        else:
+            votes = torch.einsum('nklcij,bnklxyjm->bnklcxyim', self.W, poses)  # b,B,K,K,C,w,w,4,4
 
         if self.coordinate_add:
             votes = self.coordinate_addition(width_in, votes)
             activations_ = activations.view(self.b, -1)[..., None].repeat(1, 1, self.Cww)
         else:
-            activations_ = torch.stack([activations[:, :, self.stride * i:self.stride * i + self.K,
-                                 self.stride * j:self.stride * j + self.K] for i in range(w) for j in range(w)],
-                                dim=-1)  # b,B,K,K,w*w
-            activations_ = activations_.view(self.b, self.Bkk, 1, -1).repeat(1, 1, self.C, 1).view(self.b, self.Bkk, self.Cww)
+            activations_ = activations.unfold(2, self.K, self.stride).unfold(3, self.K, self.stride)  # b,B,w,w,K,K
+            activations_ = activations_.permute(0, 1, 4, 5, 2, 3).reshape(self.b, self.Bkk, 1, -1)  # b,B*K*K,1,w*w
+            activations_ = activations_.repeat(1, 1, self.C, 1).view(self.b, self.Bkk, self.Cww)
             
             #activations_ = [activations[:, :, self.down_w(x), :][:, :, :, self.down_w(y)]
             #                for x in range(w) for y in range(w)]
@@ -248,7 +312,7 @@ class ConvCaps(nn.Module):
             #    activations_, dim=4).view(self.b, self.Bkk, 1, -1) \
             #    .repeat(1, 1, self.C, 1).view(self.b, self.Bkk, self.Cww)
 
-        votes = votes.view(self.b, self.Bkk, self.Cww, self.hh)
+        votes = votes.reshape(self.b, self.Bkk, self.Cww, self.hh)
         activations, poses = getattr(self, self.routing)(lambda_, activations_, votes)
         
         if isnan(activations) or isnan(poses):
@@ -54,6 +54,7 @@ if __name__ == '__main__':
     parser.add_argument('--noise',help='Add noise value',type=float,default=.3,metavar='N')
     parser.add_argument('--num-workers', type=int, default=4, metavar='N', help='num of workers to fetch data')
     parser.add_argument('--patience', type=int, default=5, metavar='N', help='Scheduler patience')
+    parser.add_argument('--routing-tol', type=float, default=None, metavar='N', help='Stop EM routing of a test sample once its routing coefficients change less than this')
     parser.add_argument('--lamb',help='Load prev loss',type=float,nargs='?',const=1e-3,default=None,metavar='PERIOD')
     args = parser.parse_args()
     args.use_cuda = not args.disable_cuda and torch.cuda.is_available()
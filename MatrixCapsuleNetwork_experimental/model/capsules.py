@@ -58,11 +58,12 @@ class ConvCaps(nn.Module):
         iteration: number of EM iterations
         coordinate_add: whether to use Coordinate Addition
         transform_share: whether to share transformation matrix.
+        tolerance: at inference, stop routing a sample once its routing coefficients change less than this
 
     """
 
     def __init__(self, B=32, C=32, kernel=3, stride=2, h=4, iteration=3,
-                 coordinate_add=False, transform_share=False):
+                 coordinate_add=False, transform_share=False, tolerance=None):
         super(ConvCaps, self).__init__()
         self.B = B
         self.C = C
@@ -82,42 +83,64 @@ class ConvCaps(nn.Module):
             self.W = nn.Parameter(torch.randn(B, kernel, kernel, C, h, h))  # B,K,K,C,4,4
 
         self.iteration = iteration
+        self.tolerance = tolerance
+        self.iteration_count = 0
+        self.sample_count = 0
 
         self.h = h
         self.hh = self.h*self.h
         self.eps = 1e-10
         self.ln_2pi = torch.FloatTensor(1).fill_(math.log(2*math.pi))
         self.w = 1
-        self.initial = True
+        self.coord_offsets = {}  # (K, width, device, dtype) -> b,B,K,K,C,w,w,4,4 broadcastable offset
 
     def _apply(self, fn):
         if fn.__qualname__.find('cuda') != -1:
             self.ln_2pi = self.ln_2pi.cuda()
         elif fn.__qualname__.find('cpu') != -1:
             self.ln_2pi = self.ln_2pi.cpu()
-        super()._apply(fn)
+        self.coord_offsets = {}
+        return super()._apply(fn)
         
-    def create_coordinate_offset(self):
-        dist = torch.arange(float(self.K)) / self.K
-        off = torch.zeros(self.K, self.K, self.h, self.h)
-        off[:,:,0,3] = dist
-        off[:,:,1,3] = dist.view(3,1)
-        if self.W.is_cuda:
-            off = off.cuda()
-        self.coord_offset = Variable(off).view(1, 1, self.K, self.K, 1, 1, 1, self.h, self.h)
-        self.initial = False
+    def coordinate_offset(self, votes):
+        key = (self.K, self.width_in, votes.device, votes.dtype)
+        off = self.coord_offsets.get(key)
+        if off is None:
+            dist = torch.arange(self.K, device=votes.device, dtype=votes.dtype) / self.K
+            off = votes.new_zeros(self.K, self.K, self.h, self.h)
+            off[:,:,0,-1] = dist
+            off[:,:,1,-1] = dist.view(-1,1)
+            off = off.view(1, 1, self.K, self.K, 1, 1, 1, self.h, self.h)
+            self.coord_offsets[key] = off
+        return off
         
         #votes[:, :, :, :, :, :, :, :2, -1] = votes[:, :, :, :, :, :, :, :2, -1] + add
 
+    def mean_iterations(self):
+        """ Average number of EM iterations per sample since the last reset_iterations() """
+        return self.iteration_count / max(self.sample_count, 1)
+
+    def reset_iterations(self):
+        self.iteration_count = 0
+        self.sample_count = 0
+
     def EM_routing(self, lambda_, a_, V):
         # routing coefficient
         if self.W.is_cuda:
             R = Variable(torch.ones([self.b, self.Bkk, self.Cww]), requires_grad=False).cuda() / self.C
         else:
             R = Variable(torch.ones([self.b, self.Bkk, self.Cww]), requires_grad=False) / self.C
+        b = self.b
+
+        # convergence-adaptive routing (inference only): converged samples are frozen and removed from the batch
+        adaptive = self.tolerance is not None and not self.training
+        if adaptive:
+            active = torch.arange(b, device=V.device)
+            a_out, mu_out, sigma_out = V.new_empty(b, self.Cww), V.new_empty(b, 1, self.Cww, self.hh), V.new_empty(b, 1, self.Cww, self.hh)
 
         for i in range(self.iteration):
             # M-step
+            R_prev = R
             R = (R * a_).unsqueeze(-1)
             sum_R = R.sum(1)
             mu = ((R * V).sum(1) / sum_R).unsqueeze(1)
@@ -133,9 +156,9 @@ class ConvCaps(nn.Module):
             Votes are routed by the learned weight self.W.
             """
             log_sigma = torch.log(self.sigma_square.sqrt()+self.eps)
-            cost = (self.beta_v + log_sigma.view(self.b,self.C,-1,self.hh)) * sum_R.view(self.b, self.C,-1,1)
+            cost = (self.beta_v + log_sigma.view(b,self.C,-1,self.hh)) * sum_R.view(b, self.C,-1,1)
             a = torch.sigmoid(lambda_ * (self.beta_a - cost.sum(-1)))
-            a = a.view(self.b, self.Cww)
+            a = a.view(b, self.Cww)
 
             # E-step
             if i != self.iteration - 1:
@@ -144,6 +167,25 @@ class ConvCaps(nn.Module):
                 ap = a[:,None,:] * p.sum(-1)
                 R = Variable(ap / (torch.sum(ap, 2, keepdim=True) + self.eps) + self.eps, requires_grad=False) # detaches from graph
 
+                if adaptive:
+                    converged = (R - R_prev).abs().view(b, -1).max(1)[0] < self.tolerance
+                    if converged.any():
+                        done = active[converged]
+                        a_out[done], mu_out[done], sigma_out[done] = a[converged], mu[converged], self.sigma_square[converged]
+                        self.iteration_count += (i+1) * done.numel()
+                        keep = ~converged
+                        active, V, a_, R = active[keep], V[keep], a_[keep], R[keep]
+                        b = V.shape[0]
+                        if b == 0:
+                            break
+
+        if adaptive:
+            if b > 0:
+                a_out[active], mu_out[active], sigma_out[active] = a, mu, self.sigma_square
+                self.iteration_count += self.iteration * b
+            self.sample_count += self.b
+            a, mu, self.sigma_square = a_out, mu_out, sigma_out
+
         return a, mu
 
     #torch.save(poses, 'poses.pt')
@@ -159,39 +201,31 @@ class ConvCaps(nn.Module):
                 self.K = self.width_in  # class Capsules' kernel = width_in
         self.Bkk = self.K * self.K * self.B
         
-        if self.transform_share:
-            W = self.W.view(self.B, 1, 1, self.C, self.h, self.h).expand(self.B, self.K, self.K, self.C, self.h, self.h).contiguous()
-        else:
-            W = self.W  # B,K,K,C,4,4
-
         # used to store every capsule i's poses in each capsule c's receptive field
         #pose = poses.contiguous()  # b,16*32,12,12
         #pose = poses.view(self.b, self.B, self.width_in, self.width_in, self.hh)
 
-        pose_list = []
-        for j in range(self.w):
-            for i in range(self.w):
-                pose_list.append( poses[:, :, self.stride * i:self.stride * i + self.K, self.stride * j:self.stride * j + self.K, :] )
-        poses = torch.stack(pose_list, dim=-2)  # b,B,K,K,w*w,16
-        
-        poses = poses.view(self.b, self.B, self.K, self.K, 1, self.w, self.w, self.h, self.h)  # b,B,K,K,1,w,w,4,4
-        W_hat = W[None, :, :, :, :, None, None, :, :]  # 1,B,K,K,C,1,1,4,4
-        votes = W_hat @ poses  # b,B,K,K,C,w,w,4,4
+        # receptive fields as a strided view (no copies), output positions ordered (j, i) as before
+        poses = poses.unfold(2, self.K, self.stride).unfold(3, self.K, self.stride)  # b,B,w,w,16,K,K
+        poses = poses.permute(0, 1, 5, 6, 3, 2, 4)  # b,B,K,K,w,w,16
+        poses = poses.view(self.b, self.B, self.K, self.K, self.w, self.w, self.h, self.h)  # b,B,K,K,w,w,4,4
+
+        # one batched matmul per (B,K,K) group instead of b*B*K*K*C*w*w 4x4 products
+        if self.transform_share:
+            # shared B,C,4,4 weight broadcast over K,K inside the matmul, no B,K,K,C,4,4 copy
+            votes = torch.einsum('ncij,bnklxyjm->bnklcxyim', self.W, poses)  # b,B,K,K,C,w,w,4,4
+        else:
+            votes = torch.einsum('nklcij,bnklxyjm->bnklcxyim', self.W, poses)  # b,B,K,K,C,w,w,4,4
 
         if self.coordinate_add:
-            if (self.initial):
-                self.create_coordinate_offset()
-            votes = votes + self.coord_offset
+            votes = votes + self.coordinate_offset(votes)
             activations_ = activations.view(self.b, -1).unsqueeze(-1).repeat(1, 1, self.Cww)
         else:
-            act_list = []
-            for j in range(self.w):
-                for i in range(self.w):
-                    act_list.append( activations[:, :, self.stride * i:self.stride * i + self.K, self.stride * j:self.stride * j + self.K] )
-            activations_ = torch.stack(act_list, dim=-1)  # b,B,K,K,w*w
-            activations_ = activations_.view(self.b, self.Bkk, 1, -1).repeat(1, 1, self.C, 1).view(self.b, self.Bkk, self.Cww)
-
-        votes = votes.view(self.b, self.Bkk, self.Cww, self.hh)
+            activations_ = activations.unfold(2, self.K, self.stride).unfold(3, self.K, self.stride)  # b,B,w,w,K,K
+            activations_ = activations_.permute(0, 1, 4, 5, 3, 2).reshape(self.b, self.Bkk, 1, -1)  # b,B*K*K,1,w*w
+            activations_ = activations_.repeat(1, 1, self.C, 1).view(self.b, self.Bkk, self.Cww)
+
+        votes = votes.reshape(self.b, self.Bkk, self.Cww, self.hh)
         activations, poses = self.EM_routing(lambda_, activations_, votes)
         
         return poses.view(self.b, self.C, self.w, self.w, -1), activations.view(self.b, self.C, self.w, self.w)
@@ -278,10 +312,10 @@ class CapsNet(nn.Module):
         self.bn3 = nn.BatchNorm2d(num_features=AA, eps=0.001, momentum=0.1, affine=True)
         """
         self.primary_caps = PrimaryCaps(AA*2, B, h=h)
-        self.convcaps1 = ConvCaps(B, C, kernel=3, stride=2, h=h, iteration=r, coordinate_add=False, transform_share=False)
-        self.convcaps2 = ConvCaps(C, D, kernel=3, stride=1, h=h, iteration=r, coordinate_add=False, transform_share=False)
-        self.convcaps3 = ConvCaps(D, D, kernel=1, stride=1, h=h, iteration=r, coordinate_add=False, transform_share=False)
-        self.classcaps = ConvCaps(D, E, kernel=0, stride=1, h=h, iteration=r, coordinate_add=True, transform_share=True)
+        self.convcaps1 = ConvCaps(B, C, kernel=3, stride=2, h=h, iteration=r, coordinate_add=False, transform_share=False, tolerance=args.routing_tol)
+        self.convcaps2 = ConvCaps(C, D, kernel=3, stride=1, h=h, iteration=r, coordinate_add=False, transform_share=False, tolerance=args.routing_tol)
+        self.convcaps3 = ConvCaps(D, D, kernel=1, stride=1, h=h, iteration=r, coordinate_add=False, transform_share=False, tolerance=args.routing_tol)
+        self.classcaps = ConvCaps(D, E, kernel=0, stride=1, h=h, iteration=r, coordinate_add=True, transform_share=True, tolerance=args.routing_tol)
 
         #if not args.disable_dae:
         """ Denoising Autoencoder """
@@ -88,24 +88,27 @@ class ConvCaps(nn.Module):
         self.eps = 1e-10
         self.ln_2pi = torch.FloatTensor(1).fill_(math.log(2*math.pi))
         self.w = 1
-        self.initial = True
+        self.coord_offsets = {}  # (K, width, device, dtype) -> b,B,K,K,C,w,w,4,4 broadcastable offset
 
     def _apply(self, fn):
         if fn.__qualname__.find('cuda') != -1:
             self.ln_2pi = self.ln_2pi.cuda()
         elif fn.__qualname__.find('cpu') != -1:
             self.ln_2pi = self.ln_2pi.cpu()
-        super()._apply(fn)
+        self.coord_offsets = {}
+        return super()._apply(fn)
         
-    def create_coordinate_offset(self):
-        dist = torch.arange(float(self.K)) / self.K
-        off = torch.zeros(self.K, self.K, self.h, self.h)
-        off[:,:,0,3] = dist
-        off[:,:,1,3] = dist.view(3,1)
-        if self.W.is_cuda:
-            off = off.cuda()
-        self.coord_offset = Variable(off).view(1, 1, self.K, self.K, 1, 1, 1, self.h, self.h)
-        self.initial = False
+    def coordinate_offset(self, votes):
+        key = (self.K, self.width_in, votes.device, votes.dtype)
+        off = self.coord_offsets.get(key)
+        if off is None:
+            dist = torch.arange(self.K, device=votes.device, dtype=votes.dtype) / self.K
+            off = votes.new_zeros(self.K, self.K, self.h, self.h)
+            off[:,:,0,-1] = dist
+            off[:,:,1,-1] = dist.view(-1,1)
+            off = off.view(1, 1, self.K, self.K, 1, 1, 1, self.h, self.h)
+            self.coord_offsets[key] = off
+        return off
         
         #votes[:, :, :, :, :, :, :, :2, -1] = votes[:, :, :, :, :, :, :, :2, -1] + add
 
@@ -159,39 +162,31 @@ class ConvCaps(nn.Module):
                 self.K = self.width_in  # class Capsules' kernel = width_in
         self.Bkk = self.K * self.K * self.B
         
-        if self.transform_share:
-            W = self.W.view(self.B, 1, 1, self.C, self.h, self.h).expand(self.B, self.K, self.K, self.C, self.h, self.h).contiguous()
-        else:
-            W = self.W  # B,K,K,C,4,4
-
         # used to store every capsule i's poses in each capsule c's receptive field
         #pose = poses.contiguous()  # b,16*32,12,12
         #pose = poses.view(self.b, self.B, self.width_in, self.width_in, self.hh)
 
-        pose_list = []
-        for j in range(self.w):
-            for i in range(self.w):
-                pose_list.append( poses[:, :, self.stride * i:self.stride * i + self.K, self.stride * j:self.stride * j + self.K, :] )
-        poses = torch.stack(pose_list, dim=-2)  # b,B,K,K,w*w,16
-        
-        poses = poses.view(self.b, self.B, self.K, self.K, 1, self.w, self.w, self.h, self.h)  # b,B,K,K,1,w,w,4,4
-        W_hat = W[None, :, :, :, :, None, None, :, :]  # 1,B,K,K,C,1,1,4,4
-        votes = W_hat @ poses  # b,B,K,K,C,w,w,4,4
+        # receptive fields as a strided view (no copies), output positions ordered (j, i) as before
+        poses = poses.unfold(2, self.K, self.stride).unfold(3, self.K, self.stride)  # b,B,w,w,16,K,K
+        poses = poses.permute(0, 1, 5, 6, 3, 2, 4)  # b,B,K,K,w,w,16
+        poses = poses.view(self.b, self.B, self.K, self.K, self.w, self.w, self.h, self.h)  # b,B,K,K,w,w,4,4
+
+        # one batched matmul per (B,K,K) group instead of b*B*K*K*C*w*w 4x4 products
+        if self.transform_share:
+            # shared B,C,4,4 weight broadcast over K,K inside the matmul, no B,K,K,C,4,4 copy
+            votes = torch.einsum('ncij,bnklxyjm->bnklcxyim', self.W, poses)  # b,B,K,K,C,w,w,4,4
+        else:
+            votes = torch.einsum('nklcij,bnklxyjm->bnklcxyim', self.W, poses)  # b,B,K,K,C,w,w,4,4
 
         if self.coordinate_add:
-            if (self.initial):
-                self.create_coordinate_offset()
-            votes = votes + self.coord_offset
+            votes = votes + self.coordinate_offset(votes)
             activations_ = activations.view(self.b, -1).unsqueeze(-1).repeat(1, 1, self.Cww)
         else:
-            act_list = []
-            for j in range(self.w):
-                for i in range(self.w):
-                    act_list.append( activations[:, :, self.stride * i:self.stride * i + self.K, self.stride * j:self.stride * j + self.K] )
-            activations_ = torch.stack(act_list, dim=-1)  # b,B,K,K,w*w
-            activations_ = activations_.view(self.b, self.Bkk, 1, -1).repeat(1, 1, self.C, 1).view(self.b, self.Bkk, self.Cww)
-
-        votes = votes.view(self.b, self.Bkk, self.Cww, self.hh)
+            activations_ = activations.unfold(2, self.K, self.stride).unfold(3, self.K, self.stride)  # b,B,w,w,K,K
+            activations_ = activations_.permute(0, 1, 4, 5, 3, 2).reshape(self.b, self.Bkk, 1, -1)  # b,B*K*K,1,w*w
+            activations_ = activations_.repeat(1, 1, self.C, 1).view(self.b, self.Bkk, self.Cww)
+
+        votes = votes.reshape(self.b, self.Bkk, self.Cww, self.hh)
         activations, poses = self.EM_routing(lambda_, activations_, votes)
         
         return poses.view(self.b, self.C, self.w, self.w, -1), activations.view(self.b, self.C, self.w, self.w)
@@ -36,17 +36,9 @@ class CutoffScaleSigmoid(nn.Module):
 
 
 def r_d_max_func(itr):
-    "Default max r and d provider as recommended in paper."
-    if itr < 5000:
-        return 1, 0
-    if itr < 40000:
-        r_max = 2 / 35000 * (itr - 5000) + 1
-    else:
-        r_max = 3
-    if itr < 25000:
-        d_max = 5 / 20000 * (itr - 5000)
-    else:
-        d_max = 5
+    "Default max r and d provider as recommended in paper. Computed on the itr tensor, without a device sync"
+    r_max = (2 / 35000 * (itr - 5000) + 1).clamp(1, 3)
+    d_max = (5 / 20000 * (itr - 5000)).clamp(0, 5)
     return r_max, d_max
 
 
@@ -83,9 +75,9 @@ class BatchRenorm(nn.Module):
 
             bn = (input - mean_b.view(shp)) / sigma_b.view(shp)
 
-            r_max, d_max = r_d_max_func(self.itr.item())
-            r = (sigma_b.detach()/self.running_sigma).clamp(1/r_max, r_max)
-            d = ((mean_b.detach()-self.running_mean) / self.running_sigma).clamp(-d_max, d_max)
+            r_max, d_max = r_d_max_func(self.itr)
+            r = torch.min(torch.max(sigma_b.detach()/self.running_sigma, 1/r_max), r_max)
+            d = torch.min(torch.max((mean_b.detach()-self.running_mean) / self.running_sigma, -d_max), d_max)
             
             bn = bn * r.view(shp) + d.view(shp)
             
@@ -55,6 +55,16 @@ def insert(ordereddict, key, newkey, object):
     ordereddict.update(new_orderded_dict)
 
 
+def routing_options(args, name):
+    """
+    MatrixRouting arguments of the routing layer name from the command line,
+    --routing_checkpoint without layer names checkpoints every routing layer
+    """
+    return dict(routing_bytes=args.routing_bytes, tolerance=args.routing_tol, topk=args.routing_topk,
+                backward_steps=args.routing_backward_steps,
+                checkpoint=args.routing_checkpoint is not None and (not args.routing_checkpoint or name in args.routing_checkpoint))
+
+
 class CapsNet(nn.Module):
     def __init__(self, args, len_dataset, stat=None):
         super(CapsNet, self).__init__()
@@ -80,15 +90,15 @@ class CapsNet(nn.Module):
 
             layer_list['prim1'] = layers.PrimMatrix2d(output_dim=8, h=9, kernel_size=15, stride=2, padding=7, bias=True)
             layer_list['bnn1'] = layers2.BNLayer()
-            layer_list['route1'] = layers.MatrixRouting(output_dim=8, num_routing=1)
+            layer_list['route1'] = layers.MatrixRouting(output_dim=8, num_routing=1, **routing_options(args, 'route1'))
 
             layer_list['prim2'] = layers.PrimMatrix2d(output_dim=8, h=9, kernel_size=9, stride=2, padding=4, bias=False, advanced=True)
             layer_list['bnn2'] = layers2.BNLayer()
-            layer_list['route2'] = layers.MatrixRouting(output_dim=8, num_routing=3)
+            layer_list['route2'] = layers.MatrixRouting(output_dim=8, num_routing=3, **routing_options(args, 'route2'))
 
             layer_list['prim3'] = layers.PrimMatrix2d(output_dim=32, h=14, kernel_size=9, stride=2, padding=4, bias=False, advanced=True)
             layer_list['bnn3'] = layers2.BNLayer()
-            layer_list['route3'] = layers.MatrixRouting(output_dim=32, num_routing=3)
+            layer_list['route3'] = layers.MatrixRouting(output_dim=32, num_routing=3, **routing_options(args, 'route3'))
 
 
             left_container = []
@@ -113,7 +123,7 @@ class CapsNet(nn.Module):
             self.decoder_input_atoms = 10
             layer_list['prim4'] = layers.PrimMatrix2d(output_dim=1, h=self.decoder_input_atoms, kernel_size=0, stride=1, padding=0, bias=False, advanced=True)
             layer_list['bnn4'] = layers2.BNLayer()
-            layer_list['route4'] = layers.MatrixRouting(output_dim=1, num_routing=3)
+            layer_list['route4'] = layers.MatrixRouting(output_dim=1, num_routing=3, **routing_options(args, 'route4'))
             self.capsules = nn.Sequential(layer_list)
             self.image_decoder = None
 
@@ -131,35 +141,35 @@ class CapsNet(nn.Module):
 
             layer_list['prim1'] = layers.PrimMatrix2d(output_dim=8, h=16, kernel_size=15, stride=2, padding=7, bias=True)
             layer_list['bnn1'] = layers2.BNLayer()
-            layer_list['route1'] = layers.MatrixRouting(output_dim=8, num_routing=1)
+            layer_list['route1'] = layers.MatrixRouting(output_dim=8, num_routing=1, **routing_options(args, 'route1'))
 
             layer_list['prim2'] = layers.PrimMatrix2d(output_dim=8, h=16, kernel_size=9, stride=2, padding=4, bias=False, advanced=True)
             layer_list['bnn2'] = layers2.BNLayer()
-            layer_list['route2'] = layers.MatrixRouting(output_dim=8, num_routing=3)
+            layer_list['route2'] = layers.MatrixRouting(output_dim=8, num_routing=3, **routing_options(args, 'route2'))
 
             layer_list['prim3'] = layers.PrimMatrix2d(output_dim=32, h=16, kernel_size=9, stride=2, padding=4, bias=False, advanced=True)
             layer_list['bnn3'] = layers2.BNLayer()
-            layer_list['route3'] = layers.MatrixRouting(output_dim=32, num_routing=3)
+            layer_list['route3'] = layers.MatrixRouting(output_dim=32, num_routing=3, **routing_options(args, 'route3'))
 
             self.decoder_input_atoms = 10
             layer_list['prim4'] = layers.PrimMatrix2d(output_dim=1, h=self.decoder_input_atoms, kernel_size=0, stride=1, padding=0, bias=False, advanced=True)
             layer_list['bnn4'] = layers2.BNLayer()
-            layer_list['route4'] = layers.MatrixRouting(output_dim=1, num_routing=3)
+            layer_list['route4'] = layers.MatrixRouting(output_dim=1, num_routing=3, **routing_options(args, 'route4'))
             self.capsules = nn.Sequential(layer_list)
 
             decoder_list = OrderedDict()
             #decoder_list['prepare'] = layers2.Pose2VectorRepLayer()
             decoder_list['1transposed'] = layers.PrimMatrix2d(output_dim=16, h=16, kernel_size=9, stride=1, padding=0, bias=False, advanced=True, func='ConvTranspose2d')
             decoder_list['bnn1_transposed'] = layers2.BNLayer()
-            decoder_list['route1_transposed'] = layers.MatrixRouting(output_dim=16, num_routing=3)
+            decoder_list['route1_transposed'] = layers.MatrixRouting(output_dim=16, num_routing=3, **routing_options(args, 'route1_transposed'))
 
             decoder_list['2transposed'] = layers.PrimMatrix2d(output_dim=16, h=16, kernel_size=9, stride=2, padding=0, bias=False, advanced=True, func='ConvTranspose2d')
             decoder_list['bnn2_transposed'] = layers2.BNLayer()
-            decoder_list['route2_transposed'] = layers.MatrixRouting(output_dim=16, num_routing=3)
+            decoder_list['route2_transposed'] = layers.MatrixRouting(output_dim=16, num_routing=3, **routing_options(args, 'route2_transposed'))
 
             decoder_list['3transposed'] = layers.PrimMatrix2d(output_dim=8, h=16, kernel_size=9, stride=2, padding=0, bias=False, advanced=True, func='ConvTranspose2d')
             decoder_list['bnn3_transposed'] = layers2.BNLayer()
-            decoder_list['route3_transposed'] = layers.MatrixRouting(output_dim=8, num_routing=3)
+            decoder_list['route3_transposed'] = layers.MatrixRouting(output_dim=8, num_routing=3, **routing_options(args, 'route3_transposed'))
 
             decoder_list['transform'] = layers.MatrixToConv()
 
@@ -183,22 +193,22 @@ class CapsNet(nn.Module):
     
             layer_list['prim1'] = layers.PrimMatrix2d(output_dim=B, h=16, kernel_size=1, stride=1, padding=0, bias=True, advanced=False)
             layer_list['bnn1'] = layers2.BNLayer()
-            layer_list['route1'] = layers.MatrixRouting(output_dim=B, num_routing=1, experimental=False, sparse=None)
+            layer_list['route1'] = layers.MatrixRouting(output_dim=B, num_routing=1, experimental=False, sparse=None, **routing_options(args, 'route1'))
     
             layer_list['prim2'] = layers.PrimMatrix2d(output_dim=C, h=16, kernel_size=3, stride=2, padding=0, bias=False, advanced=True)
             layer_list['bnn2'] = layers2.BNLayer()
-            layer_list['route2'] = layers.MatrixRouting(output_dim=C, num_routing=3, experimental=False) #, sparse=layers.SparseCoding(C, return_mask=True))
+            layer_list['route2'] = layers.MatrixRouting(output_dim=C, num_routing=3, experimental=False, **routing_options(args, 'route2')) #, sparse=layers.SparseCoding(C, return_mask=True))
             #layer_list['boost2'] = layers.Boost()
     
             layer_list['prim2a'] = layers.PrimMatrix2d(output_dim=D, h=16, kernel_size=3, stride=1, padding=0, bias=False, advanced=True)
             layer_list['bnn2a'] = layers2.BNLayer()
-            layer_list['route2a'] = layers.MatrixRouting(output_dim=D, num_routing=3, experimental=False) #, sparse=layers.SparseCoding(D, return_mask=True))
+            layer_list['route2a'] = layers.MatrixRouting(output_dim=D, num_routing=3, experimental=False, **routing_options(args, 'route2a')) #, sparse=layers.SparseCoding(D, return_mask=True))
             #layer_list['boost2a'] = layers.Boost()
     
             layer_list['prim3'] = layers.PrimMatrix2d(output_dim=E, h=16, kernel_size=0, stride=1, padding=0, bias=False, advanced=True)
             layer_list['bnn3'] = layers2.BNLayer()
             #layer_list['route3'] = layers.MatrixRouting(output_dim=E, num_routing=3, experimental=False)
-            route3 = layers.MatrixRouting(output_dim=E, num_routing=3, experimental=True, sparse=layers.SparseCoding(E, return_mask=False), stat=stat)
+            route3 = layers.MatrixRouting(output_dim=E, num_routing=3, experimental=True, sparse=layers.SparseCoding(E, return_mask=False), stat=stat, **routing_options(args, 'route3'))
             self.routing_list.append(route3)
             layer_list['route3'] = route3
             #layer_list['boost3'] = layers.Boost()
@@ -227,17 +237,17 @@ class CapsNet(nn.Module):
     
             layer_list['prim1'] = layers.PrimMatrix2d(output_dim=B, h=16, kernel_size=1, stride=1, padding=0, bias=True, advanced=False)
             layer_list['sigmoid1'] = layers2.SigmoidLayer()
-            layer_list['route1'] = layers.MatrixRouting(output_dim=B, num_routing=1)
+            layer_list['route1'] = layers.MatrixRouting(output_dim=B, num_routing=1, **routing_options(args, 'route1'))
     
     
             layer_list['caps2'] = layers.ConvMatrix2d(output_dim=C, hh=16, kernel_size=3, stride=2)
-            layer_list['route2'] = layers.MatrixRouting(output_dim=C, num_routing=3)
+            layer_list['route2'] = layers.MatrixRouting(output_dim=C, num_routing=3, **routing_options(args, 'route2'))
 
             layer_list['caps3'] = layers.ConvMatrix2d(output_dim=D, hh=16, kernel_size=3, stride=1)
-            layer_list['route3'] = layers.MatrixRouting(output_dim=C, num_routing=3)
+            layer_list['route3'] = layers.MatrixRouting(output_dim=C, num_routing=3, **routing_options(args, 'route3'))
 
             layer_list['caps4'] = layers.ConvMatrix2d(output_dim=E, hh=16, kernel_size=0, stride=1)
-            layer_list['route4'] = layers.MatrixRouting(output_dim=E, num_routing=3)
+            layer_list['route4'] = layers.MatrixRouting(output_dim=E, num_routing=3, **routing_options(args, 'route4'))
 
             self.capsules = nn.Sequential(layer_list)
 
@@ -265,20 +275,20 @@ class CapsNet(nn.Module):
 
             layer_list['prim1'] = layers.PrimMatrix2d(output_dim=B, h=h, kernel_size=9, stride=2, padding=2, bias=True)
             layer_list['bnn1'] = layers2.BNLayer()
-            layer_list['route1'] = layers.MatrixRouting(output_dim=B, num_routing=1)
+            layer_list['route1'] = layers.MatrixRouting(output_dim=B, num_routing=1, **routing_options(args, 'route1'))
 
             layer_list['prim2'] = layers.PrimMatrix2d(output_dim=C, h=h, kernel_size=7, stride=2, padding=1, bias=False, advanced=True)
             layer_list['bnn2'] = layers2.BNLayer()
-            layer_list['route2'] = layers.MatrixRouting(output_dim=C, num_routing=3)
+            layer_list['route2'] = layers.MatrixRouting(output_dim=C, num_routing=3, **routing_options(args, 'route2'))
 
             layer_list['prim3'] = layers.PrimMatrix2d(output_dim=D, h=h, kernel_size=5, stride=2, padding=1, bias=False, advanced=True)
             layer_list['bnn3'] = layers2.BNLayer()
-            layer_list['route3'] = layers.MatrixRouting(output_dim=D, num_routing=3)
+            layer_list['route3'] = layers.MatrixRouting(output_dim=D, num_routing=3, **routing_options(args, 'route3'))
 
             #self.decoder_input_atoms = 16
             layer_list['prim4'] = layers.PrimMatrix2d(output_dim=E, h=h, kernel_size=0, stride=1, padding=0, bias=False, advanced=True)
             layer_list['bnn4'] = layers2.BNLayer()
-            layer_list['route4'] = layers.MatrixRouting(output_dim=E, num_routing=3)
+            layer_list['route4'] = layers.MatrixRouting(output_dim=E, num_routing=3, **routing_options(args, 'route4'))
             self.capsules = nn.Sequential(layer_list)
 
             self.capsules = nn.Sequential(layer_list)
@@ -360,20 +370,20 @@ class CapsNet(nn.Module):
 
             layer_list['prim1'] = layers.PrimMatrix2d(output_dim=B, h=h, kernel_size=5, stride=2, padding=0, bias=True) # -> 29
             layer_list['bnn1'] = layers2.BNLayer()
-            layer_list['route1'] = layers.MatrixRouting(output_dim=B, num_routing=1)
+            layer_list['route1'] = layers.MatrixRouting(output_dim=B, num_routing=1, **routing_options(args, 'route1'))
 
             layer_list['prim2'] = layers.PrimMatrix2d(output_dim=C, h=h, kernel_size=3, stride=2, padding=1, bias=False, advanced=True, pool=True) # -> 13
             layer_list['bnn2'] = layers2.BNLayer2()
             route2 = layers.MatrixRouting(output_dim=C, num_routing=3, batchnorm=af.BatchRenorm(num_features=C, update_interval=3, momentum=0.1*(args.batch_size/20)),
                                             sparse=layers.SparseCoding(C, type='lifetime',
-                                            target_max_boost=2., boost_update_count=len_dataset, return_mask=False, active=True), stat=stat)
+                                            target_max_boost=2., boost_update_count=len_dataset, return_mask=False, active=True), stat=stat, **routing_options(args, 'route2'))
             layer_list['route2'] = route2
             
             layer_list['prim2a'] = layers.PrimMatrix2d(output_dim=D, h=h, kernel_size=3, stride=2, padding=0, bias=False, advanced=True, pool=True) # -> 7
             layer_list['bnn2a'] = layers2.BNLayer2()
             route2a = layers.MatrixRouting(output_dim=D, num_routing=3, batchnorm=af.BatchRenorm(num_features=D, update_interval=3, momentum=0.1*(args.batch_size/20)),
                                             sparse=layers.SparseCoding(D, type='lifetime',
-                                            target_max_boost=2., boost_update_count=len_dataset, return_mask=False, active=True), stat=stat)
+                                            target_max_boost=2., boost_update_count=len_dataset, return_mask=False, active=True), stat=stat, **routing_options(args, 'route2a'))
             layer_list['route2a'] = route2a
 
 
@@ -392,7 +402,7 @@ class CapsNet(nn.Module):
             layer_list['bnn3'] = layers2.BNLayer2()
             route3 = layers.MatrixRouting(output_dim=E, num_routing=3, batchnorm=af.BatchRenorm(num_features=E, update_interval=3, momentum=0.1*(args.batch_size/20)),
                                             sparse=layers.SparseCoding(E, type='lifetime',
-                                            target_max_boost=2., boost_update_count=len_dataset, return_mask=False, active=True), stat=stat)
+                                            target_max_boost=2., boost_update_count=len_dataset, return_mask=False, active=True), stat=stat, **routing_options(args, 'route3'))
             layer_list['route3'] = route3
 
             #container = []
@@ -401,7 +411,7 @@ class CapsNet(nn.Module):
             self.decoder_input_atoms = 15
             layer_list['prim4'] = layers.PrimMatrix2d(output_dim=F, h=self.decoder_input_atoms, kernel_size=0, stride=1, padding=0, bias=False, advanced=True, pool=True)
             layer_list['bnn4'] = layers2.BNLayer2()
-            layer_list['route4'] = layers.MatrixRouting(output_dim=F, num_routing=3)
+            layer_list['route4'] = layers.MatrixRouting(output_dim=F, num_routing=3, **routing_options(args, 'route4'))
             #layer_list['route4'] = layers.MatrixRouting(output_dim=E, num_routing=3, activation=af.NormedActivation(E, momentum=0.1*(args.batch_size/20), update_interval=3, activation=af.Sigmoid()))
 
             layer_list['cat'] = layers2.CatLayer()
@@ -441,3 +451,13 @@ class CapsNet(nn.Module):
         if not disable_recon and self.image_decoder is not None:
             return p, self.image_decoder(p)
         return p
+
+    def routing_iterations(self, reset=True):
+        """ Average routing iterations per sample of every MatrixRouting layer (convergence-adaptive routing) """
+        iterations = OrderedDict()
+        for name, module in self.named_modules():
+            if isinstance(module, layers.MatrixRouting) and module.sample_count > 0:
+                iterations[name] = module.mean_iterations()
+                if reset:
+                    module.reset_iterations()
+        return iterations
@@ -8,6 +8,8 @@ import scipy.misc as misc
 import sys
 import os
 import math
+import time
+import multiprocessing
 
 from skimage.transform import resize
 
@@ -68,13 +70,9 @@ def readDepth(path):
     See http://cims.nyu.edu/~tompson/NYU_Hand_Pose_Dataset.htm#download
     Ref: [1]
     """
-    rgb = Image.open(path)
-    print(rgb)
-    r, g, b = rgb.split()
-
-    r = np.asarray(r, np.int32)
-    g = np.asarray(g, np.int32)
-    b = np.asarray(b, np.int32)
+    rgb = np.asarray(Image.open(path).convert('RGB'))
+    g = rgb[:, :, 1].astype(np.int32)
+    b = rgb[:, :, 2].astype(np.int32)
 
     # dpt = b + g*256
 
@@ -101,8 +99,72 @@ id_ends = [72756, 2440, 8252]
 # num_packages = [3, 1, 1]
 num_packages = [1, 1, 1]
 
-def makeH5(root='../data/nyu14/'):
+def processFrame(args):
+    """
+    Decode, crop and normalize one frame (in a worker), None if its png does not exist
+    """
+    img_path, uvd_com, xyz, cube_size = args
+    if not os.path.exists(img_path):
+        return None
+    depth = readDepth(img_path)
+
+    # is joint_uvc[id, 34] center of mass???
+
+    depth = CropImage(depth, uvd_com, cube_size)
 
+    com3D = xyz[34]
+    joint = xyz[joint_id] - com3D
+
+    # normalize depth to [-1,1] and resize to one of the shape [128,128]
+    depth = ((depth - com3D[2]) / (cube_size / 2)).reshape(1, img_size, img_size)
+
+    # normalized ground truth joint 3d coordinates to [-1,1]
+    joint = np.clip(joint / (cube_size / 2), -1, 1)
+    return depth.astype(np.float32), joint.astype(np.float32).reshape(3 * J), com3D.copy()
+
+h5_fields = ['depth', 'joint', 'com', 'inds']
+h5_chunk = 64
+
+def openPackage(path):
+    """
+    Package being written: chunked, compressed datasets that grow as frames arrive, 'inds' holds the
+    frame index of every row. A package left by an interrupted build is cut to its complete rows
+    """
+    h5 = h5py.File(path, 'a')
+    if 'inds' not in h5:
+        shapes = [(1, img_size, img_size), (3 * J,), (3,), ()]
+        dtypes = [np.float32, np.float32, np.float64, np.int64]
+        for k, shape, dtype in zip(h5_fields, shapes, dtypes):
+            h5.create_dataset(k, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype, chunks=(h5_chunk,) + shape,
+                              compression='gzip', compression_opts=1, shuffle=True)
+    n = min(len(h5[k]) for k in h5_fields)
+    for k in h5_fields:
+        h5[k].resize(n, axis=0)
+    return h5
+
+def appendRows(h5, rows):
+    """
+    Appends the buffered frames, a whole chunk at a time so no compressed chunk is written twice
+    """
+    n = len(h5['inds'])
+    for k, values in zip(h5_fields, zip(*rows)):
+        h5[k].resize(n + len(rows), axis=0)
+        h5[k][n:] = np.asarray(values)
+    h5.flush()
+
+def makeH5(root='../data/nyu14/', processes=None, report_every=1024):
+    """
+    Frames are decoded and cropped in a process pool and streamed, in order, into h5data/<name>_<package>.h5.
+    A package is written to <package>.h5.part and renamed once complete, so calling makeH5 again after an
+    interruption skips the finished packages and continues the partial one after its last frame
+    """
+    dH5 = os.path.join(root, 'h5data/')
+    try:
+        os.makedirs(dH5)
+    except OSError:
+        pass
+
+    pool = multiprocessing.Pool(processes)
     for D in range(0, len(data_names)):
         data_name = data_names[D]
         cube_size = cube_sizes[D]
@@ -114,57 +176,46 @@ def makeH5(root='../data/nyu14/'):
         data_path = '{}/{}'.format(root, task)
         label_path = '{}/joint_data.mat'.format(data_path)
 
-        labels = sio.loadmat(label_path)
-        joint_uvd = labels['joint_uvd'][0]
-        joint_xyz = labels['joint_xyz'][0]
-
-        cnt = 0
-        chunck = 0
-        depth_h5, joint_h5, com_h5, = [], [], []
-        for idx in range(id_start, id_end):
-            img_path = '{}/depth_1_{:07d}.png'.format(data_path, idx + 1)
-
-            if not os.path.exists(img_path):
-                print('{} Not Exists!'.format(img_path))
+        labels = None
+        for chunck in range(num_packages[D]):
+            path = (dH5+'/{}_{}.h5').format(data_name, chunck)
+            if os.path.exists(path):
                 continue
+            if labels is None:
+                labels = sio.loadmat(label_path)
+                joint_uvd = labels['joint_uvd'][0]
+                joint_xyz = labels['joint_xyz'][0]
+
+            h5 = openPackage(path + '.part')
+            first = id_start + chunck * chunck_size
+            last = id_end if chunck == num_packages[D] - 1 else first + chunck_size
+            if len(h5['inds']):
+                first = int(h5['inds'][-1]) + 1
+
+            img_paths = ['{}/depth_1_{:07d}.png'.format(data_path, idx + 1) for idx in range(first, last)]
+            jobs = ((img_paths[i], joint_uvd[idx, 34], joint_xyz[idx], cube_size) for i, idx in enumerate(range(first, last)))
+            t, cnt, rows = time.time(), 0, []
+            for i, frame in enumerate(pool.imap(processFrame, jobs, chunksize=16)):
+                if frame is None:
+                    print('{} Not Exists!'.format(img_paths[i]))
+                    continue
+                rows.append(frame + (first + i,))
+                if len(rows) == h5_chunk:
+                    appendRows(h5, rows)
+                    rows = []
+                cnt += 1
+                if cnt % report_every == 0:
+                    print('{}_{}: {}/{} frames, {:.1f} images/s'.format(data_name, chunck, first + i + 1 - id_start, id_end - id_start, cnt / (time.time() - t)))
+            if rows:
+                appendRows(h5, rows)
+            h5.close()
+            os.rename(path + '.part', path)
+            print('{}_{}: done, {:.1f} images/s'.format(data_name, chunck, cnt / max(time.time() - t, 1e-6)))
+    pool.close()
+    pool.join()
 
-            print(img_path)
-            depth = readDepth(img_path)
-
-            # is joint_uvc[id, 34] center of mass???
-            
-            depth = CropImage(depth, joint_uvd[idx, 34], cube_size)
-
-            com3D = joint_xyz[idx, 34]
-            joint = joint_xyz[idx][joint_id] - com3D
-            
-            # normalize depth to [-1,1] and resize to one of the shape [128,128]
-            depth = ((depth - com3D[2]) / (cube_size / 2)).reshape(1, img_size, img_size)
-
-            # normalized ground truth joint 3d coordinates to [-1,1]
-            joint = np.clip(joint / (cube_size / 2), -1, 1)
-            depth_h5.append(depth.astype(np.float32))
-            joint_h5.append(joint.astype(np.float32).reshape(3 * J))
-            com_h5.append(com3D.copy())
-            cnt += 1
-            if cnt % chunck_size == 0 or idx == id_end - 1:
-                dH5 = os.path.join(root, 'h5data/')
-                try:
-                    os.makedirs(dH5)
-                except OSError:
-                    pass
-                
-                # rng = np.arange(cnt) if task == 'test' else np.random.choice(np.arange(cnt), cnt, replace = False)
-                dset = h5py.File((dH5+'/{}_{}.h5').format(data_name, chunck), 'w')
-                dset['depth'] = np.asarray(depth_h5)
-                dset['joint'] = np.asarray(joint_h5)
-                dset['com'] = np.asarray(com_h5)
-                dset.close()
-                chunck += 1
-                cnt = 0
-            
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('Specify the root directory of NYU14 directory as argument')
+    if len(sys.argv) not in [2, 3]:
+        print('Specify the root directory of NYU14 directory (and optionally the number of processes) as argument')
     else:
-        makeH5(sys.argv[1])
+        makeH5(sys.argv[1], None if len(sys.argv) == 2 else int(sys.argv[2]))
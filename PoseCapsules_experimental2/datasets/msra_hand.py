@@ -9,6 +9,7 @@ from PIL import Image
 #import torchvision.transforms.functional as TF
 import math
 import collections
+import multiprocessing
 import torch
 #from torchsample.transforms import *
 #from scipy.misc import imrotate
@@ -33,14 +34,51 @@ _bpro = lambda pt2, cfg: [(pt2[0]-cfg[2])*pt2[2]/cfg[0], (pt2[1]-cfg[3])*pt2[2]/
 
 _loc = lambda pt1, cfg: [pt1[0] + (cfg[2]-cfg[4]/2.)*pt1[2]/cfg[0], pt1[1] + (cfg[3]-cfg[5]/2.)*pt1[2]/cfg[1], pt1[2]]
 
+def _camera(cfg, pts):
+    '''cfg: camera configuration (6,) or one per sample (N, 6) for points (N, J, 3)
+    Returns the 6 parameters as arrays of the kind of pts (numpy or torch, same device)
+    that broadcast against the points
+    '''
+    if torch.is_tensor(pts):
+        cfg = torch.as_tensor(np.asarray(cfg) if not torch.is_tensor(cfg) else cfg, dtype=pts.dtype, device=pts.device)
+        if cfg.dim() > 1:
+            cfg = cfg.unsqueeze(-2)
+    else:
+        cfg = np.asarray(cfg, dtype=float)
+        if cfg.ndim > 1:
+            cfg = cfg[..., None, :]
+    return [cfg[..., k] for k in range(6)]
+
+def _apply(f, pts, cfg):
+    ''' apply one of the point lambdas to all points of pts (..., 3) at once '''
+    stack = torch.stack if torch.is_tensor(pts) else np.stack
+    return stack(f([pts[..., k] for k in range(3)], _camera(cfg, pts)), -1)
+
+def xyz2uvd_batch(xyz, cfg):
+    '''xyz: numpy array or tensor of xyz points (..., 3), e.g. (N, J, 3)
+    cfg: camera configuration (6,), or (N, 6) with one configuration per sample
+    '''
+    return _apply(_pro, xyz, cfg)
+
+def uvd2xyz_batch(uvd, cfg):
+    '''uvd: numpy array or tensor of uvd points (..., 3), e.g. (N, J, 3)
+    cfg: camera configuration (6,), or (N, 6) with one configuration per sample
+    '''
+    return _apply(_bpro, uvd, cfg)
+
+def xyz2xyz_local_batch(xyz, cfg):
+    '''xyz: numpy array or tensor of xyz points (..., 3), e.g. (N, J, 3)
+    cfg: camera configuration (6,), or (N, 6) with one configuration per sample
+    '''
+    return _apply(_loc, xyz, cfg)
+
 def xyz2uvd(xyz, cfg):
     '''xyz: list of xyz points
     cfg: camera configuration
     '''
     xyz = xyz.view(-1,3)
     # perspective projection function
-    uvd = [_pro(pt3, cfg) for pt3 in xyz]
-    return np.array(uvd)
+    return xyz2uvd_batch(xyz, cfg).cpu().numpy()
 
 def uvd2xyz(uvd, cfg):
     '''uvd: list of uvd points
@@ -48,35 +86,22 @@ def uvd2xyz(uvd, cfg):
     '''
     uvd = uvd.view(-1,3)
     # backprojection
-    xyz = [_bpro(pt2, cfg) for pt2 in uvd]
-    return np.array(xyz)
+    return uvd2xyz_batch(uvd, cfg).cpu().numpy()
 
 def xyz2uvd_op(xyz_pts, cfg):
     '''xyz_pts: tensor of xyz points
        camera_cfg: constant tensor of camera configuration
     '''
-    xyz_pts = np.reshape(xyz_pts, (-1,3))
-    xyz_list = xyz_pts.tolist()
-    uvd_list = [_pro(pt, cfg) for pt in xyz_list]
-    uvd_pts = np.stack(uvd_list)
-    return uvd_pts #np.reshape(uvd_pts, (-1,))
+    return xyz2uvd_batch(np.reshape(xyz_pts, (-1,3)), cfg) #np.reshape(uvd_pts, (-1,))
 
 def uvd2xyz_op(uvd_pts, cfg):
-    uvd_pts = np.reshape(uvd_pts, (-1,3))
-    uvd_list = uvd_pts.tolist()
-    xyz_list = [_bpro(pt, cfg) for pt in uvd_list]
-    xyz_pts = np.stack(xyz_list)
-    return xyz_pts #np.reshape(xyz_pts, (-1,))
+    return uvd2xyz_batch(np.reshape(uvd_pts, (-1,3)), cfg) #np.reshape(xyz_pts, (-1,))
 
 def xyz2xyz_local(xyz_pts, cfg):
     '''xyz_pts: tensor of xyz points
        camera_cfg: constant tensor of camera configuration
     '''
-    xyz_pts = np.reshape(xyz_pts, (-1,3))
-    xyz_list = xyz_pts.tolist()
-    xyzloc_list = [_loc(pt, cfg) for pt in xyz_list]
-    xyzloc_pts = np.stack(xyzloc_list)
-    return xyzloc_pts
+    return xyz2xyz_local_batch(np.reshape(xyz_pts, (-1,3)), cfg)
 
 def center_of_mass(dm, cfg):
     #dm = torch.from_numpy(dm)
@@ -282,6 +307,21 @@ def load_depthmap(filename, img_width, img_height, max_depth):
         return depth_image
 
 
+def crop_frame(filename, pose_orig, cfg, max_depth, out_size=128):
+    '''depth map of filename cropped around pose_orig and resized to out_size x out_size,
+    the pose in local coordinates of the crop and the camera configuration of the crop
+    '''
+    depthmap_orig = load_depthmap(filename, cfg.w, cfg.h, max_depth)
+    depthmap, pose, cropped_cfg = crop_from_xyz_pose(depthmap_orig, pose_orig, cfg, out_w=out_size, out_h=out_size, pad=20.0, max_depth=max_depth)
+    return depthmap, xyz2xyz_local(pose, cropped_cfg), cropped_cfg
+
+def _crop_record(args):
+    return crop_frame(*args)
+
+""" Fixed-size record of a preprocessed frame in the MSRA shards """
+shard_dtype = np.dtype([('depth', '<f4', (128, 128)), ('pose', '<f8', (21, 3)), ('cfg', '<f8', (6,))])
+
+
 def show_Data(depthmap, joints, cfg, max_depth):
 
     points = depthmap2points(depthmap, cfg)
@@ -309,6 +349,8 @@ class MARAHandDataset(Dataset):
     #max_depth = 500.0
     pose_dim = 48
     jnt_num = 16
+    shard_folder = 'shards'
+    annotation_file = 'annotations.npz'
     
     
     def __init__(self, root, mode, test_subject_id, transform=None):
@@ -342,6 +384,7 @@ class MARAHandDataset(Dataset):
         if not self._check_exists(): raise RuntimeError('Invalid MSRA hand dataset')
         
         self._load()
+        self.shards = self._open_shards()
         
         """ NORMALIZE """
         #coords = []
@@ -399,7 +442,7 @@ class MARAHandDataset(Dataset):
         for _ in range(100):
             index = int(torch.rand(1)*20000)
             print(index)
-            depthmap_orig = load_depthmap(self.names[index], self.img_width, self.img_height, self.max_depth)
+            depthmap_orig = load_depthmap(self.name(index), self.img_width, self.img_height, self.max_depth)
 
             
             #depthmap = -depthmap_orig + self.max_depth
@@ -485,10 +528,11 @@ class MARAHandDataset(Dataset):
 
 
     def __getitem__(self, index):
-        depthmap_orig = load_depthmap(self.names[index], self.img_width, self.img_height, self.max_depth)
-        pose_orig = self.joints_world[index]
-
-        depthmap, pose, cropped_cfg = crop_from_xyz_pose(depthmap_orig, pose_orig, self.cfg, out_w=128, out_h=128, pad=20.0, max_depth=self.max_depth)
+        if self.shards is not None:
+            record = self._shard_record(index)
+            depthmap, xyzlocal_pose = np.array(record['depth']), record['pose']
+        else:
+            depthmap, xyzlocal_pose, cropped_cfg = crop_frame(self.name(index), self.joints_world[index], self.cfg, self.max_depth)
         #show_Data(depthmap, pose, cropped_cfg, self.max_depth)
 
         """
@@ -502,9 +546,6 @@ class MARAHandDataset(Dataset):
         #show_Data(depthmap, pose, cropped_cfg, self.max_depth)
 
 
-        xyzlocal_pose = xyz2xyz_local(pose, cropped_cfg)
-
-
 
         """
         for i in range(3):
@@ -594,7 +635,7 @@ class MARAHandDataset(Dataset):
             #save_to_jpg('test%1.png', depthmap, format="PNG")
         """
         sample = {
-            'name': self.names[index],
+            'name': self.name(index),
             #'points': points,
             'joints': self.joints_world[index],
             'refpoint': self.ref_pts[index],
@@ -609,90 +650,103 @@ class MARAHandDataset(Dataset):
     def __len__(self):
         return self.num_samples
 
-    def _load(self):
-        self._compute_dataset_size()
+    def build_shards(self, processes=None):
+        """
+        Offline preprocessing: crop every frame of every subject once and store the depth map, the local pose
+        and the crop configuration as fixed-size records (shard_dtype), one memory-mappable shard per subject
+        in <root>/shards/P<mid>.npy. Datasets created afterwards read the records instead of the depth files
+        """
+        folder = os.path.join(self.root, self.shard_folder)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        index = self._annotations()
+        with multiprocessing.Pool(processes) as pool:
+            for mid in range(self.subject_num):
+                subject = index['subject'] == mid
+                names = [self._depth_file(mid, g, f) for g, f in zip(index['gesture'][subject], index['frame'][subject])]
+                joints = index['joints'][subject]
+                path = os.path.join(folder, 'P{}.npy'.format(mid))
+                shard = np.lib.format.open_memmap(path + '.part', mode='w+', dtype=shard_dtype, shape=(len(names),))
+                jobs = ((name, pose, self.cfg, self.max_depth) for name, pose in zip(names, joints))
+                for i, (depthmap, pose, cfg) in enumerate(pool.imap(_crop_record, jobs, chunksize=64)):
+                    shard[i] = (depthmap, pose, cfg)
+                shard.flush()
+                del shard
+                os.rename(path + '.part', path)
+                print('P{}: {} frames'.format(mid, len(names)))
+        self.shards = self._open_shards()
+
+    def _open_shards(self):
+        """ The memory-mapped shards of the subjects of this mode, None if they are not built """
+        subjects = [mid for mid in range(self.subject_num) if (mid != self.test_subject_id) == self.training]
+        paths = [os.path.join(self.root, self.shard_folder, 'P{}.npy'.format(mid)) for mid in subjects]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        shards = [np.load(path, mmap_mode='r') for path in paths]
+        if sum(len(shard) for shard in shards) != self.num_samples:
+            print('Warning: MSRA shards do not match the annotations, reading the depth files instead')
+            return None
+        self.shard_ends = np.cumsum([len(shard) for shard in shards])
+        return shards
+
+    def _shard_record(self, index):
+        s = int(np.searchsorted(self.shard_ends, index, side='right'))
+        return self.shards[s][index - self.shard_ends[s] + len(self.shards[s])]
 
-        if self.mode == 'train':
-            self.num_samples = self.train_size
-            self.num_samples_alt = self.test_size
-        else:
-            self.num_samples = self.test_size
-            self.num_samples_alt = self.train_size
+    def _load(self):
+        index = self._annotations()
 
-        #self.num_samples = self.train_size if self.mode == 'train' else self.test_size
-        self.joints_world = np.zeros((self.num_samples, self.joint_num, self.world_dim))
-        self.joints_world_alt = np.zeros((self.num_samples_alt, self.joint_num, self.world_dim))
-        #self.ref_pts = np.zeros((self.num_samples, self.world_dim))
-        self.names = []
+        if self.mode == 'train': model_chk = (index['subject'] != self.test_subject_id)
+        elif self.mode == 'test': model_chk = (index['subject'] == self.test_subject_id)
+        else: raise RuntimeError('unsupported mode {}'.format(self.mode))
 
-        # Collect reference center points strings
-        #if self.mode == 'train': ref_pt_file = 'center_train_' + str(self.test_subject_id) + '_refined.txt'
-        #else: ref_pt_file = 'center_test_' + str(self.test_subject_id) + '_refined.txt'
+        self.test_size = int((index['subject'] == self.test_subject_id).sum())
+        self.train_size = len(index['subject']) - self.test_size
 
-        #with open(os.path.join(self.center_dir, ref_pt_file)) as f:
-        #        ref_pt_str = [l.rstrip() for l in f]
+        self.joints_world = index['joints'][model_chk]
+        self.joints_world_alt = index['joints'][~model_chk]
+        self.num_samples = len(self.joints_world)
+        self.num_samples_alt = len(self.joints_world_alt)
+        self.frames = np.stack([index['subject'], index['gesture'], index['frame']], axis=1)[model_chk]
 
-        #
-        #file_id = 0
-        frame_id = 0
-        frame_id_alt = 0
+    def name(self, index):
+        """ depth file of sample index """
+        return self._depth_file(*self.frames[index])
 
-        for mid in range(self.subject_num):
-            if self.mode == 'train': model_chk = (mid != self.test_subject_id)
-            elif self.mode == 'test': model_chk = (mid == self.test_subject_id)
-            else: raise RuntimeError('unsupported mode {}'.format(self.mode))
-            
-            #if model_chk:
-            for fd in self.folder_list:
-                annot_file = os.path.join(self.root, 'P'+str(mid), fd, 'joint.txt')
+    def _depth_file(self, subject, gesture, frame):
+        return os.path.join(self.root, 'P'+str(subject), self.folder_list[gesture], '{:0>6d}'.format(frame) + '_depth.bin')
 
-                lines = []
-                with open(annot_file) as f:
-                    lines = [line.rstrip() for line in f]
-
-                # skip first line
-                for i in range(1, len(lines)):
-                    # referece point
-                    #splitted = ref_pt_str[file_id].split()
-                    #if splitted[0] == 'invalid':
-                    #    print('Warning: found invalid reference frame')
-                    #    file_id += 1
-                    #    continue
-                    #else:
-                    #    self.ref_pts[frame_id, 0] = float(splitted[0])
-                    #    self.ref_pts[frame_id, 1] = float(splitted[1])
-                    #    self.ref_pts[frame_id, 2] = float(splitted[2])
-
-                    # joint point
-                    splitted = lines[i].split()
-                    if model_chk:
-                        for jid in range(self.joint_num):
-                            self.joints_world[frame_id, jid, 0] = float(splitted[jid * self.world_dim])
-                            self.joints_world[frame_id, jid, 1] = float(splitted[jid * self.world_dim + 1])
-                            self.joints_world[frame_id, jid, 2] = -float(splitted[jid * self.world_dim + 2])
-                        frame_id += 1
-                        filename = os.path.join(self.root, 'P'+str(mid), fd, '{:0>6d}'.format(i-1) + '_depth.bin')
-                        self.names.append(filename)
-                    else:
-                        for jid in range(self.joint_num):
-                            self.joints_world_alt[frame_id_alt, jid, 0] = float(splitted[jid * self.world_dim])
-                            self.joints_world_alt[frame_id_alt, jid, 1] = float(splitted[jid * self.world_dim + 1])
-                            self.joints_world_alt[frame_id_alt, jid, 2] = -float(splitted[jid * self.world_dim + 2])
-                        frame_id_alt += 1
-
-                    #file_id += 1
-
-    def _compute_dataset_size(self):
-        self.train_size, self.test_size = 0, 0
-
-        for mid in range(self.subject_num):
-            num = 0
-            for fd in self.folder_list:
-                annot_file = os.path.join(self.root, 'P'+str(mid), fd, 'joint.txt')
-                with open(annot_file) as f:
-                    num = int(f.readline().rstrip())
-                if mid == self.test_subject_id: self.test_size += num
-                else: self.train_size += num
+    def _annotations(self):
+        """
+        Index of all annotated frames: subject, gesture (into folder_list), frame and joints (world coordinates).
+        Cached in <root>/annotations.npz, which is rebuilt when a joint.txt is newer than it
+        """
+        cache = os.path.join(self.root, self.annotation_file)
+        annot_files = [os.path.join(self.root, 'P'+str(mid), fd, 'joint.txt') for mid in range(self.subject_num) for fd in self.folder_list]
+        if os.path.exists(cache) and os.path.getmtime(cache) >= max(os.path.getmtime(f) for f in annot_files):
+            with np.load(cache) as index:
+                return {k: index[k] for k in index.files}
+
+        subject, gesture, frame, joints = [], [], [], []
+        for k, annot_file in enumerate(annot_files):
+            with open(annot_file) as f:
+                f.readline()                                        # skip first line, the number of frames
+                jnts = np.fromstring(f.read(), dtype=float, sep=' ').reshape(-1, self.joint_num * self.world_dim)
+            subject.append(np.full(len(jnts), k // len(self.folder_list), dtype=np.int8))
+            gesture.append(np.full(len(jnts), k % len(self.folder_list), dtype=np.int8))
+            frame.append(np.arange(len(jnts), dtype=np.int32))
+            joints.append(jnts)
+        joints = np.concatenate(joints).reshape(-1, self.joint_num, self.world_dim)
+        joints[:, :, 2] = -joints[:, :, 2]
+        index = {'subject': np.concatenate(subject), 'gesture': np.concatenate(gesture), 'frame': np.concatenate(frame), 'joints': joints}
+
+        try:
+            with open(cache + '.part', 'wb') as f:
+                np.savez(f, **index)
+            os.rename(cache + '.part', cache)
+        except OSError as e:
+            print('Warning: could not cache the MSRA annotations,', e)
+        return index
 
     def _check_exists(self):
         # Check basic data
@@ -827,3 +881,9 @@ def foo(points, verbose=False):
     transformed = np.stack(stk, axis=0).reshape(-1, 6, 4*3)
     #print(transformed.shape)
     return transformed
+
+
+if __name__ == '__main__':
+    """ Build the preprocessed shards: python -m datasets.msra_hand <MSRA root> """
+    import sys
+    MARAHandDataset(sys.argv[1], 'train', 0).build_shards()
@@ -18,11 +18,15 @@ class NORB(data.Dataset):
     for a stereo image pair. More details about the data collection can be found in
     `http://leon.bottou.org/publications/pdf/cvpr-2004.pdf`.
     
+    The .mat files are converted once to ``processed/{training,test}_{dat,cat,info}.npy``,
+    which are opened memory-mapped: construction is instant and DataLoader workers
+    share the pages of the images instead of copying them.
+
     Args:
-        root (string): Root directory of dataset where ``processed/training.pt``
-            and  ``processed/test.pt`` exist.
-        train (bool, optional): If True, creates dataset from ``training.pt``,
-            otherwise from ``test.pt``.
+        root (string): Root directory of dataset where ``processed/training_*.npy``
+            and  ``processed/test_*.npy`` exist.
+        train (bool, optional): If True, creates dataset from ``training_*.npy``,
+            otherwise from ``test_*.npy``.
         download (bool, optional): If true, downloads the dataset from the internet and
             puts it in root directory. If dataset is already downloaded, it is not
             downloaded again.
@@ -34,8 +38,8 @@ class NORB(data.Dataset):
 
     raw_folder = 'raw'
     processed_folder = 'processed'
-    training_file = 'training.pt'
-    test_file = 'test.pt'
+    training_file = 'training_{}.npy'
+    test_file = 'test_{}.npy'
     types = ['dat', 'cat', 'info']
     urls = {}
 
@@ -61,23 +65,20 @@ class NORB(data.Dataset):
                                ' You can use download=True to download it')
 
         # image pairs stored in [i, :, :] and [i+1, :, :]
-        # they are sharing the same labels and info
+        # they are sharing the same labels and info, stored once per pair: labels[i//2], info[i//2]
         if self.train:
-            self.train_data, self.train_labels, self.train_info = torch.load(
-                os.path.join(self.root, self.processed_folder, self.training_file))
+            self.train_data, self.train_labels, self.train_info = self._load(self.training_file)
             size = len(self.train_labels)
             assert size == len(self.train_info)
             assert size*2 == len(self.train_data)
-            self.train_labels = self.train_labels.view(size, 1).repeat(1, 2).view(2*size, 1)
-            self.train_info = self.train_info.repeat(1, 2).view(2*size, 4)
         else:
-            self.test_data, self.test_labels, self.test_info = torch.load(
-                os.path.join(self.root, self.processed_folder, self.test_file))
+            self.test_data, self.test_labels, self.test_info = self._load(self.test_file)
             size = len(self.test_labels)
             assert size == len(self.test_info)
             assert size*2 == len(self.test_data)
-            self.test_labels = self.test_labels.view(size, 1).repeat(1, 2).view(2*size, 1)
-            self.test_info = self.test_info.repeat(1, 2).view(2*size, 4)
+
+    def _load(self, file):
+        return [np.load(os.path.join(self.root, self.processed_folder, file.format(k)), mmap_mode='r') for k in self.types]
 
     def __getitem__(self, index):
         """
@@ -92,13 +93,14 @@ class NORB(data.Dataset):
             ...
         """
         if self.train:
-            img, target = self.train_data[index], self.train_labels[index]
+            img, target = self.train_data[index], self.train_labels[index // 2]
         else:
-            img, target = self.test_data[index], self.test_labels[index]
+            img, target = self.test_data[index], self.test_labels[index // 2]
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(img.numpy(), mode='L')
+        img = Image.fromarray(np.array(img), mode='L')
+        target = torch.tensor([target], dtype=torch.long)
 
         if self.transform is not None:
             img = self.transform(img)
@@ -115,8 +117,8 @@ class NORB(data.Dataset):
             return len(self.test_data)
 
     def _check_exists(self):
-        return os.path.exists(os.path.join(self.root, self.processed_folder, self.training_file)) and \
-            os.path.exists(os.path.join(self.root, self.processed_folder, self.test_file))
+        return all(os.path.exists(os.path.join(self.root, self.processed_folder, file.format(k)))
+                   for file in (self.training_file, self.test_file) for k in self.types)
 
     def download(self):
         """Download the MNIST data if it doesn't exist in processed_folder already."""
@@ -127,21 +129,23 @@ class NORB(data.Dataset):
             return
 
         # download files
-        try:
-            os.makedirs(os.path.join(self.root, self.raw_folder))
-            os.makedirs(os.path.join(self.root, self.processed_folder))
-        except OSError as e:
-            if e.errno == errno.EEXIST:
-                pass
-            else:
-                raise
+        for folder in (self.raw_folder, self.processed_folder):
+            try:
+                os.makedirs(os.path.join(self.root, folder))
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    pass
+                else:
+                    raise
 
         for k in self.urls:
             for url in self.urls[k]:
-                print('Downloading ' + url)
-                data = urllib.request.urlopen(url)
                 filename = url.rpartition('/')[2]
                 file_path = os.path.join(self.root, self.raw_folder, filename)
+                if os.path.exists(file_path.replace('.gz', '')):
+                    continue
+                print('Downloading ' + url)
+                data = urllib.request.urlopen(url)
                 with open(file_path, 'wb') as f:
                     f.write(data.read())
                 with open(file_path.replace('.gz', ''), 'wb') as out_f, \
@@ -149,35 +153,27 @@ class NORB(data.Dataset):
                     out_f.write(zip_f.read())
                 os.unlink(file_path)
 
-        # process and save as torch files
+        # convert to .npy files that are memory-mapped when loading
         print('Processing...')
 
-        parsed = {}
         for k in self.urls:
-            op = get_op(k)
-            for url in self.urls[k]:
-                filename = url.rpartition('/')[2].replace('.gz', '')
-                path = os.path.join(self.root, self.raw_folder, filename)
-                print(path)
-                if k not in parsed:
-                    parsed[k] = op(path)
-                else:
-                    parsed[k] = torch.cat([parsed[k], op(path)], dim=0)
-                
-        training_set = (
-            parsed['train_dat'],
-            parsed['train_cat'],
-            parsed['train_info']
-        )
-        test_set = (
-            parsed['test_dat'],
-            parsed['test_cat'],
-            parsed['test_info']
-        )
-        with open(os.path.join(self.root, self.processed_folder, self.training_file), 'wb') as f:
-            torch.save(training_set, f)
-        with open(os.path.join(self.root, self.processed_folder, self.test_file), 'wb') as f:
-            torch.save(test_set, f)
+            split, kind = k.split('_')
+            file = (self.training_file if split == 'train' else self.test_file).format(kind)
+            parts = [read_mat(os.path.join(self.root, self.raw_folder, url.rpartition('/')[2].replace('.gz', '')))
+                     for url in self.urls[k]]
+            if kind == 'dat':
+                parts = [p.reshape((-1,) + p.shape[2:]) for p in parts]     # pairs (N, 2, h, w) -> images (2*N, h, w)
+            print(file)
+            path = os.path.join(self.root, self.processed_folder, file)
+            out = np.lib.format.open_memmap(path + '.part', mode='w+', dtype=parts[0].dtype,
+                                            shape=(sum(len(p) for p in parts),) + parts[0].shape[1:])
+            start = 0
+            for p in parts:
+                out[start:start + len(p)] = p
+                start += len(p)
+            out.flush()
+            del out
+            os.rename(path + '.part', path)
 
         print('Done!')
 
@@ -230,35 +226,42 @@ def magic2type(magic):
     m = bytearray(reversed(magic)).hex().upper()
     return m2t[m]
 
+type2dtype = {'single precision matrix': '<f4',
+              'double precision matrix': '<f8',
+              'integer matrix': '<i4',
+              'byte matrix': 'u1',
+              'short matrix': '<i2'}
+
 def parse_header(fd):
+    """
+        The header is the magic number, ndim and max(ndim, 3) dimensions (the unused ones are padding),
+        'offset' is where the payload starts
+    """
     magic = struct.unpack('<BBBB', fd.read(4))
     ndim, = struct.unpack('<i', fd.read(4))
-    dim = []
-    for _ in range(ndim):
-        dim += struct.unpack('<i', fd.read(4))
+    dim = np.frombuffer(fd.read(4 * max(ndim, 3)), dtype='<i4')[:ndim].tolist()
 
     header = {'magic': magic,
               'type': magic2type(magic),
-              'dim': dim}
+              'dim': dim,
+              'offset': fd.tell()}
     return header
 
-def parse_cat_file(path):
+def read_mat(path):
     """
-        -cat file stores corresponding category of images
-        Return:
-            ByteTensor of shape (N,)
+        Memory-mapped, read-only view of the payload of a .mat file, shaped as in its header
     """
     with open(path, 'rb') as f:
         header = parse_header(f)
-        num, = header['dim']
-        struct.unpack('<BBBB', f.read(4))
-        struct.unpack('<BBBB', f.read(4))
-
-        labels = np.zeros(shape=num, dtype=np.int32)
-        for i in range(num):
-            labels[i], = struct.unpack('<i', f.read(4))
+    return np.memmap(path, dtype=type2dtype[header['type']], mode='r', offset=header['offset'], shape=tuple(header['dim']))
 
-        return torch.from_numpy(labels).long()
+def parse_cat_file(path):
+    """
+        -cat file stores corresponding category of images
+        Return:
+            LongTensor of shape (N,)
+    """
+    return torch.from_numpy(read_mat(path).astype(np.int64))
 
 def parse_dat_file(path):
     """
@@ -270,16 +273,8 @@ def parse_dat_file(path):
         Return:
             ByteTensor of shape (2*N, 96, 96)
     """
-    with open(path, 'rb') as f:
-        header = parse_header(f)
-        num, c, h, w = header['dim']
-        imgs = np.zeros(shape=(num * c, h, w), dtype=np.uint8)
-
-        for i in range(num * c):
-            img = struct.unpack('<' + h * w * 'B', f.read(h * w))
-            imgs[i] = np.uint8(np.reshape(img, newshape=(h, w)))
-
-        return torch.from_numpy(imgs)
+    dat = read_mat(path)
+    return torch.from_numpy(np.array(dat.reshape((-1,) + dat.shape[2:])))
 
 def parse_info_file(path):
     """
@@ -292,18 +287,9 @@ def parse_info_file(path):
             (:, 3): 6 lighting conditions
 
         Return:
-            ByteTensor of shape (N, 4)
+            IntTensor of shape (N, 4)
     """
-    with open(path, 'rb') as f:
-        header = parse_header(f)
-        num, num_info = header['dim']
-        struct.unpack('<BBBB', f.read(4))
-        info = np.zeros(shape=(num, num_info), dtype=np.int32)
-        for r in range(num):
-            for c in range(num_info):
-                info[r, c], = struct.unpack('<i', f.read(4))
-
-        return torch.from_numpy(info)
+    return torch.from_numpy(np.array(read_mat(path)))
 
 def get_op(key):
     op_dic = {
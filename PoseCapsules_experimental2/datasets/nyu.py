@@ -4,6 +4,7 @@ Some parts of the codes are based on
 """
 
 import os
+import collections
 import numpy as np
 import torch
 import torch.utils.data as data
@@ -13,35 +14,64 @@ from .GetH5DataNYU import *
 import h5py
     
 class NYU14(data.Dataset):
+    keys = ['depth', 'joint', 'com']
+
     def __init__(self, root='../data/nyu14/', task='train', split=1.0,
-                nUseJoint=31):
+                nUseJoint=31, lazy=False, cache_chunks=0, chunk_rows=256):
         """
         INPUT
         - split: the ratio of splitting the dataset
                  1, no split
+        - lazy: do not load the packages into RAM, every process (DataLoader worker) opens the h5 files
+                itself and reads rows on demand. Use with ChunkBatchSampler: a batch is read with one
+                read per chunk it touches (__getitems__)
+        - cache_chunks: lazy, keep this many decoded chunks per process (LRU)
+        - chunk_rows: lazy, rows per chunk if the h5 datasets are not chunked
         """
         
         self.root = root
         self.split = split
         self.nUseJoint = nUseJoint
         self.task = task
+        self.lazy = lazy
+        self.cache_chunks = cache_chunks
         
-        if os.path.exists(os.path.join(root, 'h5data')) == False:
+        """ Build the packages, or finish a build that was interrupted (it leaves a .part package) """
+        if os.path.exists(os.path.join(root, 'h5data')) == False or any(f.endswith('.part') for f in os.listdir(os.path.join(root, 'h5data'))):
             makeH5(root)
         
         if task == 'train':
-            h5 = h5py.File(root+'/h5data/train_0.h5')
+            name = 'train'
         elif task == 'test1':
-            h5 = h5py.File(root+'/h5data/test_1_0.h5')
+            name = 'test_1'
         elif task == 'test2':
-            h5 = h5py.File(root+'/h5data/test_2_0.h5')
-            
+            name = 'test_2'
+        # all packages <name>_0.h5, <name>_1.h5, ...
+        self.paths = []
+        while os.path.exists(root+'/h5data/{}_{}.h5'.format(name, len(self.paths))):
+            self.paths.append(root+'/h5data/{}_{}.h5'.format(name, len(self.paths)))
+
+        if lazy:
+            self._h5, self._pid = None, None
+            self._chunks = collections.OrderedDict()
+            sizes = []
+            for path in self.paths:
+                with h5py.File(path, 'r') as h5:
+                    sizes.append(len(h5['depth']))
+                    self.chunk_rows = h5['depth'].chunks[0] if h5['depth'].chunks else chunk_rows
+            self.starts = np.cumsum([0] + sizes)
+            print('data indexed, size: ', self.starts[-1])
+            self.length = (int)(self.starts[-1] * split)
+            return
+
         print('data loading...')
         # it is critical to add [()], See
         # http://stackoverflow.com/questions/10274476/how-to-export-hdf5-file-to-numpy-using-h5py
-        self.depths = h5['depth'][()]
-        self.joints = h5['joint'][()]
-        self.coms = h5['com'][()]
+        packages = []
+        for path in self.paths:
+            with h5py.File(path, 'r') as h5:
+                packages.append([h5[k][()] for k in self.keys])
+        self.depths, self.joints, self.coms = [np.concatenate(arrays) for arrays in zip(*packages)]
         
         # if task == 'train':
         #     for i in range(1,3,1):
@@ -66,14 +96,107 @@ class NYU14(data.Dataset):
     #     return self.nJoints
         
     def __getitem__(self, idx):
+        if self.lazy:
+            return self.__getitems__([idx])[0]
         depth = self.depths[idx]
         joint = self.joints[idx][0:3*self.nUseJoint]
         com   = self.coms[idx]
         
         return torch.from_numpy(depth), torch.from_numpy(joint), torch.from_numpy(com)
+
+    def __getitems__(self, idxs):
+        """ The samples of a batch of indices, lazy: grouped by chunk, one read per chunk """
+        if not self.lazy:
+            return [self[idx] for idx in idxs]
+        idxs = np.asarray(idxs)
+        if len(idxs) and (idxs.min() < 0 or idxs.max() >= self.length):
+            raise IndexError('index out of range')
+        samples = [None] * len(idxs)
+        chunk_ids = self.chunk_of(idxs)
+        for chunk_id in np.unique(chunk_ids):
+            pos = np.nonzero(chunk_ids == chunk_id)[0]
+            package = np.searchsorted(self.starts, idxs[pos[0]], side='right') - 1
+            rows = idxs[pos] - self.starts[package]
+            if self.cache_chunks:
+                start = rows.min() // self.chunk_rows * self.chunk_rows
+                depth, joint, com = self._chunk(package, start)
+            else:
+                # contiguous range covering the rows of this chunk
+                start = rows.min()
+                h5 = self._files()[package]
+                depth, joint, com = [h5[k][start:rows.max()+1] for k in self.keys]
+            for i, row in zip(pos, rows - start):
+                samples[i] = (torch.from_numpy(depth[row]), torch.from_numpy(joint[row][0:3*self.nUseJoint]), torch.from_numpy(com[row]))
+        return samples
+
+    def chunk_of(self, idxs):
+        """ Global chunk number of indices: chunks are chunk_rows rows of one package """
+        idxs = np.asarray(idxs)
+        package = np.searchsorted(self.starts, idxs, side='right') - 1
+        first_chunk = np.cumsum([0] + [-(-(b - a) // self.chunk_rows) for a, b in zip(self.starts[:-1], self.starts[1:])])
+        return first_chunk[package] + (idxs - self.starts[package]) // self.chunk_rows
+
+    def _chunk(self, package, start):
+        key = (package, start)
+        if key in self._chunks:
+            self._chunks.move_to_end(key)
+            return self._chunks[key]
+        h5 = self._files()[package]
+        chunk = [h5[k][start:start+self.chunk_rows] for k in self.keys]
+        self._chunks[key] = chunk
+        if len(self._chunks) > self.cache_chunks:
+            self._chunks.popitem(last=False)
+        return chunk
+
+    def _files(self):
+        """ h5 handles of this process, (re)opened after a fork so workers never share the parent's handles """
+        if self._h5 is None or self._pid != os.getpid():
+            self._h5 = [h5py.File(path, 'r') for path in self.paths]
+            self._pid = os.getpid()
+            self._chunks.clear()
+        return self._h5
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.lazy:
+            state['_h5'], state['_pid'], state['_chunks'] = None, None, collections.OrderedDict()
+        return state
     
     def __len__(self):
         return self.length
+
+
+class ChunkBatchSampler(data.Sampler):
+    """
+    Batch sampler for a lazy NYU14: the chunks are visited in random order and the indices of window
+    chunks at a time are shuffled and cut into batches, so a batch touches at most 2*window chunks.
+    Use as DataLoader(dataset, batch_sampler=ChunkBatchSampler(dataset, batch_size))
+    """
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, window=4):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.window = window
+        idxs = np.arange(len(dataset))
+        chunk_ids = dataset.chunk_of(idxs)
+        self.chunks = np.split(idxs, np.nonzero(np.diff(chunk_ids))[0] + 1)
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.chunks)) if self.shuffle else np.arange(len(self.chunks))
+        idxs = []
+        for w in range(0, len(order), self.window):
+            window = np.concatenate([self.chunks[c] for c in order[w:w+self.window]])
+            if self.shuffle:
+                np.random.shuffle(window)
+            idxs.extend(window.tolist())
+        for b in range(0, len(idxs), self.batch_size):
+            batch = idxs[b:b+self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                yield batch
+
+    def __len__(self):
+        n = sum(len(c) for c in self.chunks)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
     
 def convertNormTo3D(X):
     int((X[0] + 1) / 2 * 128), int( (-X[0]+1)/2 * 128)
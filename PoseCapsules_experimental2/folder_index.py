@@ -0,0 +1,51 @@
+'''
+Index of an image folder with the pose labels in the file names, shared by PoseCapsules_experimental2/util.py
+and Matrix-Capsule-Network/main.py
+'''
+
+from torchvision import datasets
+import numpy as np
+import os
+
+def label_from_filename(path):
+    """ Pose label encoded in the file name, <v0>_<v1>_..._<vn>.png """
+    data = path.split('/')
+    data = data[-1].split('_')
+    data[-1] = data[-1].split('.p')[0]
+    return [float(i) for i in data]
+
+def folder_unchanged(root, classes, since):
+    """ The class folders of root are still classes and none of them was changed after the file since was written """
+    current = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+    return current == classes and all(os.path.getmtime(os.path.join(root, c)) <= os.path.getmtime(since) for c in classes)
+
+def image_index(root, index_file='index.npz'):
+    """
+    Scan of an image folder (class folders, relative paths, class targets) and the labels parsed from the file
+    names (flat, sample i is labels[offsets[i]:offsets[i+1]]). Cached in <root>/<index_file>, rebuilt when the
+    class folders are not the same or one of them was changed after the index was written
+    """
+    root = os.path.expanduser(root)
+    cache = os.path.join(root, index_file)
+    if os.path.exists(cache):
+        with np.load(cache) as index:
+            index = {k: index[k] for k in index.files}
+        if folder_unchanged(root, index['classes'].tolist(), cache):
+            return index
+
+    classes, class_to_idx = datasets.folder.find_classes(root)
+    samples = datasets.folder.make_dataset(root, class_to_idx, extensions=datasets.folder.IMG_EXTENSIONS)
+    labels = [label_from_filename(path) for path, _ in samples]
+    index = {'classes': np.array(classes),
+             'paths': np.array([os.fsencode(os.path.relpath(path, root)) for path, _ in samples]),
+             'targets': np.array([target for _, target in samples], dtype=np.int64),
+             'labels': np.array([v for label in labels for v in label], dtype=np.float64),
+             'offsets': np.cumsum([0] + [len(label) for label in labels]).astype(np.int64)}
+
+    try:
+        with open(cache + '.part', 'wb') as f:
+            np.savez(f, **index)
+        os.rename(cache + '.part', cache)
+    except OSError as e:
+        print('Warning: could not write the image index,', e)
+    return index
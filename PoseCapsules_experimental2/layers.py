@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable, Function
+from torch.utils.checkpoint import checkpoint
 import math
 #from batchrenorm import BatchRenorm, Sigmoid
 import batchrenorm
@@ -15,6 +16,9 @@ eps = 1e-10
 ln_2pi = math.log(2*math.pi)
 #lambda_ = 0.0001
 
+""" Functions that must not be traced by torch.compile (no-op before pytorch 2.1) """
+compile_disable = getattr(getattr(torch, 'compiler', None), 'disable', lambda fn: fn)
+
 def calc_out(input_, kernel=1, stride=1, padding=0, dilation=1):
     return int((input_ + 2*padding - dilation*(kernel-1) - 1) / stride) + 1
 
@@ -363,11 +367,161 @@ class SparseCoding(nn.Module):
                 print ('Active filters (>5%) :', (self.freq_ema > 0.05/shp[1]).sum().item())
 
 
+def em_probabilities(V, mu, sigma_square, log_sigma, a):
+    """
+    E-step: unnormalized assignment probabilities a(j)*p(v_ij) of the votes V (b, Bkk, Cww, h) given
+    the Gaussian model (mu, sigma_square, log_sigma: b, 1, Cww, h) and the activations a (b, Cww).
+    With top-k routing all arguments are gathered to the k selected outputs (b, Bkk, k, ...)
+    """
+    V_minus_mu_sqr = (V - mu) ** 2 + eps
+    ln_p_j_h = -V_minus_mu_sqr / (2 * sigma_square) - log_sigma - 0.5*ln_2pi
+    return a.view(a.shape[0], -1, V.shape[2]) * torch.exp(ln_p_j_h).sum(-1)
+
+def em_m_step_topk(R, R_idx, a_, V):
+    """
+    M-step for routing coefficients in compact index/value layout: R, R_idx (b, Bkk, k) hold the
+    k output capsules (of Cww) each input capsule is routed to. Sums over the input capsules
+    become scatter-adds into (b, Cww). Returns sum_R (b, Cww, 1), mu and sigma_square (b, 1, Cww, h)
+    """
+    b, Bkk, Cww, h = V.shape
+    idx = R_idx.view(b, -1)
+    idx_h = idx.unsqueeze(-1).expand(-1, -1, h)
+    R = (R * a_.gather(2, R_idx)).view(b, -1, 1)
+    V = V.gather(2, R_idx.unsqueeze(-1).expand(-1, -1, -1, h)).view(b, -1, h)
+
+    sum_R = V.new_zeros(b, Cww).scatter_add(1, idx, R.squeeze(-1)).unsqueeze(-1) + eps
+    mu = V.new_zeros(b, Cww, h).scatter_add(1, idx_h, R * V) / sum_R
+    V_minus_mu_sqr = (V - mu.gather(1, idx_h)) ** 2 + eps
+    sigma_square = V.new_zeros(b, Cww, h).scatter_add(1, idx_h, R * V_minus_mu_sqr) / sum_R + eps
+    return sum_R, mu.unsqueeze(1), sigma_square.unsqueeze(1)
+
+def em_assignments(V, mu, sigma_square, log_sigma, a):
+    """ E-step: normalized assignment probabilities R(ij) (b, Bkk, Cww) """
+    ap = em_probabilities(V, mu, sigma_square, log_sigma, a)
+    return ap / (torch.sum(ap, 2, keepdim=True) + eps) + eps
+
+def routing_tile(V, routing_bytes, live=3):
+    """
+    Number of output capsules (Cww) routed at once, such that the (b, Bkk, tile, h)
+    intermediates of one M/E-step tile (about 'live' of them at a time) fit in routing_bytes
+    """
+    b, Bkk, Cww, h = V.shape
+    if routing_bytes is None:
+        return Cww
+    column_bytes = live * b * Bkk * h * V.element_size()
+    return max(1, min(Cww, int(routing_bytes // column_bytes)))
+
+
+class FusedEMStep(Function):
+    """
+    Fused E-step + M-step of the EM routing.
+
+    The assignment probabilities R are recomputed chunk by chunk along the input capsule axis (Bkk)
+    from the detached model of the previous iteration, so neither R nor any (b, Bkk, Cww, h)
+    intermediate is kept. Only the sufficient statistics (b, Cww, h) are stored for backward.
+    R is treated as a constant, as in the unfused routing where it is detached from the graph.
+
+    Inputs:  V (b, Bkk, Cww, h), a_ (b, Bkk, Cww), previous model mu, sigma_square, log_sigma
+             (b, 1, Cww, h) and a (b, Cww), or None for the first iteration (R = 1/output_dim)
+    Outputs: sum_R (b, Cww, 1), mu (b, Cww, h), sigma_square (b, Cww, h)
+    """
+
+    @staticmethod
+    def coefficients(V, prev, output_dim, begin, end):
+        if prev[0] is None:
+            return V.new_full(V[:, begin:end].shape[:3], 1. / output_dim)
+        return em_assignments(V[:, begin:end], *prev)
+
+    @staticmethod
+    def forward(ctx, V, a_, mu_prev, sigma_square_prev, log_sigma_prev, a_prev, output_dim, chunk_size):
+        b, Bkk, Cww, h = V.shape
+        prev = (mu_prev, sigma_square_prev, log_sigma_prev, a_prev)
+
+        sum_R = V.new_zeros(b, Cww)
+        RV = V.new_zeros(b, Cww, h)
+        for begin in range(0, Bkk, chunk_size):
+            end = begin + chunk_size
+            R = FusedEMStep.coefficients(V, prev, output_dim, begin, end) * a_[:, begin:end]
+            sum_R += R.sum(1)
+            RV += (R.unsqueeze(-1) * V[:, begin:end]).sum(1)
+        sum_R = sum_R.unsqueeze(-1) + eps
+        mu = RV / sum_R
+
+        """ Second pass for the variance. D = sum(R*(V-mu)) is only needed for the gradient of mu """
+        Q = V.new_zeros(b, Cww, h)
+        D = V.new_zeros(b, Cww, h)
+        for begin in range(0, Bkk, chunk_size):
+            end = begin + chunk_size
+            R = (FusedEMStep.coefficients(V, prev, output_dim, begin, end) * a_[:, begin:end]).unsqueeze(-1)
+            V_minus_mu = V[:, begin:end] - mu.unsqueeze(1)
+            Q += (R * (V_minus_mu ** 2 + eps)).sum(1)
+            D += (R * V_minus_mu).sum(1)
+        sigma_square = Q / sum_R + eps
+
+        ctx.output_dim = output_dim
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(V, a_, mu_prev, sigma_square_prev, log_sigma_prev, a_prev, sum_R, mu, Q, D)
+        return sum_R, mu, sigma_square
+
+    @staticmethod
+    def backward(ctx, grad_sum_R, grad_mu, grad_sigma_square):
+        V, a_, mu_prev, sigma_square_prev, log_sigma_prev, a_prev, sum_R, mu, Q, D = ctx.saved_tensors
+        prev = (mu_prev, sigma_square_prev, log_sigma_prev, a_prev)
+        Bkk = V.shape[1]
+
+        if grad_sum_R is None:
+            grad_sum_R = torch.zeros_like(sum_R)
+        if grad_mu is None:
+            grad_mu = torch.zeros_like(mu)
+        if grad_sigma_square is None:
+            grad_sigma_square = torch.zeros_like(Q)
+
+        """ sigma_square = Q/sum_R + eps, mu = RV/sum_R, sum_R = sum(R) + eps """
+        grad_Q = (grad_sigma_square / sum_R).unsqueeze(1)
+        grad_mu = grad_mu - 2 * grad_Q.squeeze(1) * D
+        grad_RV = (grad_mu / sum_R).unsqueeze(1)
+        grad_sum_R = grad_sum_R - ((grad_sigma_square * Q).sum(-1, keepdim=True) / sum_R
+                                   + (grad_mu * mu).sum(-1, keepdim=True)) / sum_R
+        grad_sum_R = grad_sum_R.view(grad_sum_R.shape[0], 1, -1)
+
+        grad_V = torch.empty_like(V) if ctx.needs_input_grad[0] else None
+        grad_a = torch.empty_like(a_) if ctx.needs_input_grad[1] else None
+        for begin in range(0, Bkk, ctx.chunk_size):
+            end = begin + ctx.chunk_size
+            R = FusedEMStep.coefficients(V, prev, ctx.output_dim, begin, end)
+            V_minus_mu = V[:, begin:end] - mu.unsqueeze(1)
+            if grad_V is not None:
+                grad_V[:, begin:end] = (R * a_[:, begin:end]).unsqueeze(-1) * (grad_RV + 2 * grad_Q * V_minus_mu)
+            if grad_a is not None:
+                grad_a[:, begin:end] = R * ((grad_Q * (V_minus_mu ** 2 + eps) + grad_RV * V[:, begin:end]).sum(-1) + grad_sum_R)
+
+        return grad_V, grad_a, None, None, None, None, None, None
+
+
 class MatrixRouting(nn.Module):
-    def __init__(self, output_dim, num_routing, batchnorm=None, sparse=None, stat=None):
+    def __init__(self, output_dim, num_routing, batchnorm=None, sparse=None, stat=None, fused=False, chunk_size=16, routing_bytes=None, tolerance=None, topk=None, checkpoint=False, backward_steps=1):
         super(MatrixRouting, self).__init__()
         self.output_dim = output_dim
         self.num_routing = num_routing
+        self.fused = fused
+        self.chunk_size = chunk_size
+        self.routing_bytes = routing_bytes
+        self.tolerance = tolerance
+        self.topk = topk
+        self.checkpoint = checkpoint
+        self.backward_steps = backward_steps
+        if fused:
+            """
+            FusedEMStep routes all Cww output capsules of every sample in every iteration, dense, and treats R
+            as a constant: the gradient is the one of backward_steps=1
+            """
+            unsupported = [k for k in ('routing_bytes', 'tolerance', 'topk') if getattr(self, k) is not None]
+            if backward_steps != 1:
+                unsupported.append('backward_steps')
+            if unsupported:
+                raise ValueError('fused routing does not support {}'.format(', '.join(unsupported)))
+        self.iteration_count = 0
+        self.sample_count = 0
         self.beta_v = nn.Parameter(torch.randn(self.output_dim).view(1,self.output_dim,1,1))
         self.sparse = sparse
         self.batchnorm = batchnorm
@@ -380,8 +534,95 @@ class MatrixRouting(nn.Module):
         if stat is not None:
             for _ in range(4):
                 self.stat.append(0.)
-        
+
+    def mean_iterations(self):
+        """ Average number of routing iterations per sample since the last reset_iterations() """
+        return self.iteration_count / max(self.sample_count, 1)
+
+    def reset_iterations(self):
+        self.iteration_count = 0
+        self.sample_count = 0
+
+    def buffer_state(self):
+        """ Buffers of this layer and its batchnorm/sparse submodules, as (module, name, tensor) """
+        return [(m, k, t) for m in self.modules() for k, t in m._buffers.items() if t is not None]
+
     def forward(self, x): # (b, Bkk, Cww, h)
+        if not (self.checkpoint and self.training and torch.is_grad_enabled()):
+            return self.route(x)
+
+        """
+        Gradient checkpointing: only the votes and activations are kept, the routing iterations are
+        recomputed during backward. The recomputation sees the buffers (batchnorm running statistics,
+        boosting weights) from before this forward pass and does not update statistics again
+        """
+        state = [(m, k, t.clone()) for m, k, t in self.buffer_state()]
+        calls = []
+        def run(V, a):
+            if not calls:
+                calls.append(True)
+                return self.route((V, a))
+            current = self.buffer_state()
+            for m, k, t in state:
+                m._buffers[k] = t.clone()
+            try:
+                return self.route((V, a), update=False)
+            finally:
+                for m, k, t in current:
+                    m._buffers[k] = t
+        return checkpoint(run, x[0], x[1], use_reentrant=False)
+
+    @compile_disable
+    def update_statistics(self, a, log_sigma, cost):
+        """
+        Bookkeeping of the last routing iteration (sparse boosting, activity histogram, stat list).
+        Kept out of compiled graphs: it mutates Python counters every step
+        """
+        if self.training:
+            self.sparse.update(a) #sum_R.view(b, self.output_dim,-1)) * a
+            #if self.L_fac.item() < 0:
+            #    self.L_fac.data += 0.1
+
+            if self.sparse.N == 0:
+                bt99 = (a > 0.99).sum()
+                bt8 = (a > 0.8).sum() - bt99
+                bt5 = (a > 0.5).sum() - bt8 - bt99
+                bt2 = (a > 0.2).sum() - bt5 - bt8 - bt99
+                lt2 = (a > 0.01).sum() - bt2 - bt5 - bt8 - bt99
+                eq0 = (a == 0.).sum()
+                lt01 = (a < 0.01).sum() - eq0
+                print('Activity distribution:', eq0.item(), '|0|', lt01.item(), '|0.01|', lt2.item(), '|0.2|', bt2.item(), '|0.5|', bt5.item(), '|0.8|', bt8.item(), '|0.99|', bt99.item())
+                #if self.experimental==1:
+                #    print('Lfac =', self.L_fac.mean().item())
+        if self.stat is not None:
+            """ Appended as tensors, a util.statSink collects them without waiting for the device """
+            log_sigma, cost, a = log_sigma.detach(), cost.detach(), a.detach()
+            self.stat.append( log_sigma.std() )
+            cost_sum = cost.sum(-1)
+            self.stat.append( cost_sum.mean() )
+            self.stat.append( cost_sum.std() )
+            
+            mask_a = a>0.01
+            
+            numel_a = mask_a.sum(dim=2).float()+eps
+            mean_a = a.sum(dim=2)/numel_a
+            sigma_a = mask_a.float()*(a - mean_a.unsqueeze(-1)) ** 2
+            sigma_a = (sigma_a.sum(dim=2)/numel_a).sqrt()
+            sigma_a = sigma_a.mean()
+            
+            """
+            numel_a = mask_a.sum()
+            if numel_a.item() > 0:
+                mean_a = a.sum()/numel_a
+                sigma_a = mask_a.float() * (a - mean_a) ** 2
+                sigma_a = (sigma_a.sum()/numel_a).sqrt()
+            else:
+                sigma_a = numel_a.float()
+            """
+            
+            self.stat.append( sigma_a )
+
+    def route(self, x, update=True):
         """ the votes are pooled/reduced, so bias should be detached? """
         V = x[0]
         shp = V.shape
@@ -395,113 +636,145 @@ class MatrixRouting(nn.Module):
 
         b, Bkk, Cww, h = shp
         a_ = x[1].view(b, Bkk, -1)
+        tile = routing_tile(V, self.routing_bytes)
         
         # routing coefficient
-        if V.is_cuda:
-            R = Variable(torch.ones(shp[:3]), requires_grad=False).cuda() / self.output_dim
+        if self.fused:
+            """ Model of the previous iteration, R is recomputed from it inside FusedEMStep """
+            prev = (None, None, None, None)
+            a_ = a_.expand(b, Bkk, Cww)
         else:
-            R = Variable(torch.ones(shp[:3]), requires_grad=False) / self.output_dim
-
-        for i in range(self.num_routing):
-            lambda_ = (1 - 0.65 ** (i+1)) * 1.37
-            #lambda_ = 0.01 * (1 - 0.95 ** (i+1))
-            #lambda_ = 1. * (1 - 0.5 ** (i+1))
+            R = V.new_full(shp[:3], 1. / self.output_dim)
+
+        """ Top-k routing: the first E-step is dense over all Cww, after it R only holds the k largest assignments, with indices R_idx """
+        R_idx = None
+        topk = self.topk is not None and self.topk < Cww
+        if topk:
+            a_ = a_.expand(b, Bkk, Cww)
+
+        """
+        Convergence-adaptive routing (inference only): a sample whose R changes less than
+        tolerance keeps the model of the current iteration and is removed from the batch
+        """
+        adaptive = self.tolerance is not None and not self.training
+        if adaptive:
+            batch = b
+            active = torch.arange(b, device=V.device)
+            mu_out, a_out, sum_R_out = V.new_empty(b, 1, Cww, h), V.new_empty(b, self.output_dim, Cww//self.output_dim), V.new_empty(b, Cww, 1)
+
+        grad_enabled = torch.is_grad_enabled()
+        try:
+            for i in range(self.num_routing):
+                """ Iterations before the last backward_steps do not reach the gradient, no graph is built for them """
+                torch.set_grad_enabled(grad_enabled and i >= self.num_routing - self.backward_steps)
+                lambda_ = (1 - 0.65 ** (i+1)) * 1.37
+                #lambda_ = 0.01 * (1 - 0.95 ** (i+1))
+                #lambda_ = 1. * (1 - 0.5 ** (i+1))
             
-            """ M-step: Compute an updated Gaussian model (μ, σ) """
-            R = (R * a_).unsqueeze(-1)
-            sum_R = R.sum(1) + eps
-            mu = ((R * V).sum(1) / sum_R).unsqueeze(1)
-            V_minus_mu_sqr = (V - mu) ** 2 + eps
-            sigma_square = ((R * V_minus_mu_sqr).sum(1) / sum_R).unsqueeze(1) + eps
-
-            """
-            beta_v: Bias for log probability of sigma ("standard deviation")
-            beta_a: Bias for offsetting
+                """ M-step: Compute an updated Gaussian model (μ, σ) """
+                R_prev = None if self.fused else R
+                if self.fused:
+                    sum_R, mu, sigma_square = FusedEMStep.apply(V, a_, *prev, self.output_dim, self.chunk_size)
+                    mu, sigma_square = mu.unsqueeze(1), sigma_square.unsqueeze(1)
+                elif R_idx is not None:
+                    sum_R, mu, sigma_square = em_m_step_topk(R, R_idx, a_, V)
+                else:
+                    """ Output capsules are independent in the M-step, so they are processed tile by tile """
+                    R = (R * a_).unsqueeze(-1)
+                    sum_R = R.sum(1) + eps
+                    mu, sigma_square = [], []
+                    for t in range(0, Cww, tile):
+                        R_, V_, sum_R_ = R[:,:,t:t+tile], V[:,:,t:t+tile], sum_R[:,t:t+tile]
+                        mu_ = ((R_ * V_).sum(1) / sum_R_).unsqueeze(1)
+                        V_minus_mu_sqr = (V_ - mu_) ** 2 + eps
+                        sigma_square.append(((R_ * V_minus_mu_sqr).sum(1) / sum_R_).unsqueeze(1) + eps)
+                        mu.append(mu_)
+                    mu, sigma_square = torch.cat(mu, 2), torch.cat(sigma_square, 2)
+
+                """
+                beta_v: Bias for log probability of sigma ("standard deviation")
+                beta_a: Bias for offsetting
             
-            In principle, beta_v and beta_a are only for learning regarding "activations".
-            Just like "batch normalization" it has both scaling and bias.
-            Votes are routed by the learned weight self.W.
-            """
-            log_sigma = torch.log(sigma_square.sqrt()+eps)
-
-            if self.sparse is None:
-                cost = (self.beta_v + log_sigma.view(b,self.output_dim,-1,h)) * sum_R.view(b, self.output_dim,-1,1)
-                a = self.sigmoid(lambda_*(self.beta_a - cost.sum(-1)))
-            else:
-                is_last_time = (i == (self.num_routing - 1))
-                #cost = (self.beta_v + self.beta_aa*log_sigma.view(b,self.output_dim,-1,h)) * sum_R.view(b, self.output_dim,-1,1)
-                cost = (self.beta_v + log_sigma.view(b,self.output_dim,-1,h)) * sum_R.view(b, self.output_dim,-1,1)
-                #a = self.batchnorm(self.beta_a - cost.sum(-1), i)
-                a = self.batchnorm(-cost.sum(-1), i)
-                #inp = lambda_*a*0.25 + 0.5
-                #a = (inp.clamp(0.001,0.999) + inp*0.0001).clamp(0,1)
+                In principle, beta_v and beta_a are only for learning regarding "activations".
+                Just like "batch normalization" it has both scaling and bias.
+                Votes are routed by the learned weight self.W.
+                """
+                log_sigma = torch.log(sigma_square.sqrt()+eps)
+
+                if self.sparse is None:
+                    cost = (self.beta_v + log_sigma.view(b,self.output_dim,-1,h)) * sum_R.view(b, self.output_dim,-1,1)
+                    a = self.sigmoid(lambda_*(self.beta_a - cost.sum(-1)))
+                else:
+                    is_last_time = (i == (self.num_routing - 1))
+                    #cost = (self.beta_v + self.beta_aa*log_sigma.view(b,self.output_dim,-1,h)) * sum_R.view(b, self.output_dim,-1,1)
+                    cost = (self.beta_v + log_sigma.view(b,self.output_dim,-1,h)) * sum_R.view(b, self.output_dim,-1,1)
+                    #a = self.batchnorm(self.beta_a - cost.sum(-1), i)
+                    a = self.batchnorm(-cost.sum(-1), i)
+                    #inp = lambda_*a*0.25 + 0.5
+                    #a = (inp.clamp(0.001,0.999) + inp*0.0001).clamp(0,1)
                 
-                a = self.sigmoid(lambda_*a)
-                #a = (self.hardtanh(lambda_*a) + lambda_*a * 0.001 + 0.01).# *0.25+0.25)
-                #a = ((lambda_*a).clamp(0.001, 0.999) + lambda_*a * 0.0001).clamp(0.,1.)
-                #a = torch.sigmoid((lambda_*a - 0.5)/0.17)
-                a = self.sparse.boosting_weights.view(1,-1,1) * a
-                #a_boost = self.sparse.boosting_weights.view(1,-1,1) * a.data
-                #a = a - (a_boost < 0.495).float() * a
-
-                if is_last_time:
-                    #mask = a.data > a.data.mean(dim=2, keepdim=True).clamp(min=0.495)
-                    #a = mask.float() * a
-                    #b = b * 0.00002 + 0.01
-                    #a = torch.max(a, b)
-                    
-                    if self.training:
-                        self.sparse.update(a) #sum_R.view(b, self.output_dim,-1)) * a
-                        #if self.L_fac.item() < 0:
-                        #    self.L_fac.data += 0.1
-
-                        if self.sparse.N == 0:
-                            bt99 = (a > 0.99).sum()
-                            bt8 = (a > 0.8).sum() - bt99
-                            bt5 = (a > 0.5).sum() - bt8 - bt99
-                            bt2 = (a > 0.2).sum() - bt5 - bt8 - bt99
-                            lt2 = (a > 0.01).sum() - bt2 - bt5 - bt8 - bt99
-                            eq0 = (a == 0.).sum()
-                            lt01 = (a < 0.01).sum() - eq0
-                            print('Activity distribution:', eq0.item(), '|0|', lt01.item(), '|0.01|', lt2.item(), '|0.2|', bt2.item(), '|0.5|', bt5.item(), '|0.8|', bt8.item(), '|0.99|', bt99.item())
-                            #if self.experimental==1:
-                            #    print('Lfac =', self.L_fac.mean().item())
-                    if self.stat is not None:
-                        self.stat.append( log_sigma.std().item() )
-                        cost_sum = cost.sum(-1)
-                        self.stat.append( cost_sum.mean().item() )
-                        self.stat.append( cost_sum.std().item() )
-                        
-                        mask_a = a>0.01
-                        
-                        numel_a = mask_a.sum(dim=2).float()+eps
-                        mean_a = a.sum(dim=2)/numel_a
-                        sigma_a = mask_a.float()*(a - mean_a.unsqueeze(-1)) ** 2
-                        sigma_a = (sigma_a.sum(dim=2)/numel_a).sqrt()
-                        sigma_a = sigma_a.mean()
-                        
-                        """
-                        numel_a = mask_a.sum()
-                        if numel_a.item() > 0:
-                            mean_a = a.sum()/numel_a
-                            sigma_a = mask_a.float() * (a - mean_a) ** 2
-                            sigma_a = (sigma_a.sum()/numel_a).sqrt()
-                        else:
-                            sigma_a = numel_a.float()
-                        """
-                        
-                        self.stat.append( sigma_a.item() )
+                    a = self.sigmoid(lambda_*a)
+                    #a = (self.hardtanh(lambda_*a) + lambda_*a * 0.001 + 0.01).# *0.25+0.25)
+                    #a = ((lambda_*a).clamp(0.001, 0.999) + lambda_*a * 0.0001).clamp(0.,1.)
+                    #a = torch.sigmoid((lambda_*a - 0.5)/0.17)
+                    a = self.sparse.boosting_weights.view(1,-1,1) * a
+                    #a_boost = self.sparse.boosting_weights.view(1,-1,1) * a.data
+                    #a = a - (a_boost < 0.495).float() * a
+
+                    if is_last_time and update:
+                        self.update_statistics(a, log_sigma, cost)
 
             
-            """ E-step: Recompute the assignment probabilities R(ij) based on the new Gaussian model and the new a(j) """
-            if i != self.num_routing - 1:
-                """ p_j_h is the probability of v_ij_h belonging to the capsule j’s Gaussian model """
-                ln_p_j_h = -V_minus_mu_sqr / (2 * sigma_square) - log_sigma - 0.5*ln_2pi
-                p_j_h = torch.exp(ln_p_j_h)
-
-                """ Calculate normalized Assignment Probabilities (batch_size, input_dim, output_dim)"""
-                ap = a.view(b, 1, Cww) * p_j_h.sum(-1)
-                R = Variable(ap / (torch.sum(ap, 2, keepdim=True) + eps) + eps, requires_grad=False) # detaches from graph
+                """ E-step: Recompute the assignment probabilities R(ij) based on the new Gaussian model and the new a(j) """
+                if i != self.num_routing - 1 and self.fused:
+                    prev = (mu.detach(), sigma_square.detach(), log_sigma.detach(), a.detach())
+                elif i != self.num_routing - 1:
+                    """ p_j_h is the probability of v_ij_h belonging to the capsule j’s Gaussian model """
+                    a_j = a.view(b, Cww)
+                    if R_idx is not None:
+                        gather = lambda t: t.expand(b, Bkk, Cww, -1).gather(2, R_idx.unsqueeze(-1).expand(-1, -1, -1, t.shape[-1]))
+                        ap = em_probabilities(gather(V), gather(mu), gather(sigma_square), gather(log_sigma), a_j.unsqueeze(1).expand(b, Bkk, Cww).gather(2, R_idx))
+                    else:
+                        ap = torch.cat([em_probabilities(V[:,:,t:t+tile], mu[:,:,t:t+tile], sigma_square[:,:,t:t+tile],
+                                                         log_sigma[:,:,t:t+tile], a_j[:,t:t+tile]) for t in range(0, Cww, tile)], 2)
+
+                    """ Calculate normalized Assignment Probabilities (batch_size, input_dim, output_dim)"""
+                    R = ap / (torch.sum(ap, 2, keepdim=True) + eps) + eps
+
+                    """
+                    Gradients flow through the last backward_steps iterations only, R is detached before that.
+                    With the default of 1 the routing result is treated as a fixed point: R is a constant and only
+                    the last M-step is differentiated, so backward cost does not depend on num_routing. Larger
+                    values add the dependence of R on the model (truncated implicit gradient), num_routing
+                    backpropagates through the whole unrolled routing
+                    """
+                    if i < self.num_routing - self.backward_steps:
+                        R = R.detach()
+                    if topk and R_idx is None:
+                        R, R_idx = R.topk(self.topk, dim=2)
+
+                    if adaptive and R.shape == R_prev.shape:
+                        converged = (R - R_prev).abs().view(b, -1).max(1)[0] < self.tolerance
+                        if converged.any():
+                            done = active[converged]
+                            mu_out[done], a_out[done], sum_R_out[done] = mu[converged], a[converged], sum_R[converged]
+                            self.iteration_count += (i+1) * done.numel()
+                            keep = ~converged
+                            active, V, a_, R = active[keep], V[keep], a_[keep], R[keep]
+                            if R_idx is not None:
+                                R_idx = R_idx[keep]
+                            b = V.shape[0]
+                            if b == 0:
+                                break
+        finally:
+            torch.set_grad_enabled(grad_enabled)
+
+        if adaptive:
+            if b > 0:
+                mu_out[active], a_out[active], sum_R_out[active] = mu, a, sum_R
+                self.iteration_count += self.num_routing * b
+            self.sample_count += batch
+            mu, a, sum_R, b = mu_out, a_out, sum_R_out, batch
 
         #mask = (a.data > 0).float()
         #mu = mask.view(b, 1, -1, 1) * mu
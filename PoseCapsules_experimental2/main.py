@@ -5,6 +5,7 @@ Created on Jan 14, 2019
 '''
 
 from capsnet import CapsNet #, MSELossWeighted
+from layers import MatrixRouting
 import util
 
 import torch
@@ -50,6 +51,7 @@ if __name__ == '__main__':
     parser.add_argument('--disable_cuda', action='store_true', help='Disable CUDA')
     parser.add_argument('--normalize',help='Normalize rotation part of generated labels [0-2]',type=int,nargs='?',const=1,default=None,metavar='PERIOD')    
     parser.add_argument('--jit', action='store_true', help='Enable pytorch jit compilation')
+    parser.add_argument('--compile', action='store_true', help='Compile the routing layers with torch.compile (pytorch >= 2.2)')
     parser.add_argument('--load_loss',help='Load prev loss',type=int,nargs='?',const=1000,default=None,metavar='PERIOD')    
     parser.add_argument('--pretrained',help='load pretrained epoch',type=int,nargs='?',const=-1,default=None,metavar='PERIOD')    
     parser.add_argument('--disable_recon', action='store_true', help='Disable Reconstruction')
@@ -62,6 +64,13 @@ if __name__ == '__main__':
     parser.add_argument('--num_workers', type=int, default=4, metavar='N', help='num of workers to fetch data')
     parser.add_argument('--patience', type=int, default=20, metavar='N', help='Scheduler patience')
     parser.add_argument('--dataset', type=str, default='images', metavar='N', help='dataset options: images,three_dot_3d')
+    parser.add_argument('--packed', action='store_true', help='Read image folder datasets (e.g. rabbit100x100) from their packed uint8 form, packed on first use')
+    parser.add_argument('--stat_interval', type=int, default=100, metavar='N', help='Copy the routing statistics to the host every N steps')
+    parser.add_argument('--routing_backward_steps', type=int, default=1, metavar='N', help='Backpropagate through the last N routing iterations (1: fixed-point gradient of the last M-step only)')
+    parser.add_argument('--routing_checkpoint', type=str, nargs='*', default=None, metavar='LAYER', help='Recompute the routing iterations of these MatrixRouting layers (e.g. route2 route3, all if none given) during backward to save memory')
+    parser.add_argument('--routing_topk', type=int, default=None, metavar='N', help='Route each input capsule to its k most likely output capsules after the first iteration')
+    parser.add_argument('--routing_tol', type=float, default=None, metavar='N', help='Stop routing a test sample once its routing coefficients change less than this')
+    parser.add_argument('--routing_bytes', type=int, default=None, metavar='N', help='Memory budget in bytes for one tile of output capsules in MatrixRouting')
     args = parser.parse_args()
     time_dump = int(time.time())
 
@@ -94,12 +103,17 @@ if __name__ == '__main__':
         #train_dataset.test()
         test_dataset = MARAHandDataset('../../data/cvpr15_MSRAHandGestureDB', 'test', 2)
         logger = util.statJoints(args, train_dataset.scale)
+    elif args.packed:
+        train_dataset = util.PackedImageFolder(root='../../data/{}/train/'.format(args.dataset))
+        test_dataset = util.PackedImageFolder(root='../../data/{}/test/'.format(args.dataset))
     else:
         train_dataset = util.MyImageFolder(root='../../data/{}/train/'.format(args.dataset), transform=transforms.ToTensor(), target_transform=transforms.ToTensor())
         test_dataset = util.MyImageFolder(root='../../data/{}/test/'.format(args.dataset), transform=transforms.ToTensor(), target_transform=transforms.ToTensor())
 
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True, drop_last=False)
-    test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True, drop_last=False)
+    """ Packed images come as uint8 views, they are converted to float per batch """
+    collate_fn = util.collate_packed if isinstance(train_dataset, util.PackedImageFolder) else None
+    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True, drop_last=False, collate_fn=collate_fn)
+    test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True, drop_last=False, collate_fn=collate_fn)
     sup_iterator = train_loader.__iter__()
     test_iterator = test_loader.__iter__()
     imgs, labels = sup_iterator.next()
@@ -110,17 +124,22 @@ if __name__ == '__main__':
     Setup model, load it to CUDA and make JIT compilation
     """
     #imgs = imgs[:2]
-    stat = []
+    stat = util.statSink(flush_interval=args.stat_interval)
     model = CapsNet(args, len(train_dataset) // (2*args.batch_size) + 3, stat)
 
     use_cuda = not args.disable_cuda and torch.cuda.is_available()
     if use_cuda:
         model.cuda()
         imgs = imgs.cuda()
+    """ First call builds the lazily initialized layers, they have to exist before tracing/compiling """
+    model(imgs)
     if args.jit:
         model = torch.jit.trace(model, (imgs), check_inputs=[(imgs)])
-    else:
-        model(imgs)
+    elif args.compile:
+        """ Routing layers compile to one graph each, on CPU this beats compiling the stack as a whole """
+        for module in model.modules():
+            if isinstance(module, MatrixRouting):
+                module.compile(dynamic=False)
     print("# model parameters:", sum(param.numel() for param in model.parameters()))
 
     """
@@ -351,5 +370,7 @@ if __name__ == '__main__':
             All train data processed: Do logging
             """
             logger.endTestLog(epoch)
+            if args.routing_tol is not None:
+                print('Routing iterations:', *['%s %.2f' % i for i in model.routing_iterations().items()])
 
 
@@ -0,0 +1,146 @@
+'''
+Numerical checks of the EM routing in layers.MatrixRouting against a plain, fully unrolled
+reference implementation. Run from this directory: python test_routing.py
+'''
+
+import math
+import unittest
+import torch
+import layers
+import batchrenorm
+
+eps = layers.eps
+
+
+def reference_routing(V, a_, beta_v, beta_a, output_dim, num_routing, detach_R):
+    """
+    Dense EM routing without tiling, V (b, Bkk, Cww, h), a_ (b, Bkk, Cww). With detach_R the assignment
+    probabilities R are constants (gradient of the last M-step only), otherwise the gradient flows
+    through all routing iterations
+    """
+    b, Bkk, Cww, h = V.shape
+    R = V.new_full((b, Bkk, Cww), 1. / output_dim)
+    for i in range(num_routing):
+        lambda_ = (1 - 0.65 ** (i+1)) * 1.37
+        Ra = (R * a_).unsqueeze(-1)
+        sum_R = Ra.sum(1) + eps
+        mu = ((Ra * V).sum(1) / sum_R).unsqueeze(1)
+        sigma_square = ((Ra * ((V - mu) ** 2 + eps)).sum(1) / sum_R).unsqueeze(1) + eps
+        log_sigma = torch.log(sigma_square.sqrt() + eps)
+        cost = (beta_v + log_sigma.view(b, output_dim, -1, h)) * sum_R.view(b, output_dim, -1, 1)
+        a = torch.sigmoid(lambda_ * (beta_a - cost.sum(-1)))
+        if i != num_routing - 1:
+            ln_p = -((V - mu) ** 2 + eps) / (2 * sigma_square) - log_sigma - 0.5 * math.log(2 * math.pi)
+            ap = a.view(b, 1, Cww) * torch.exp(ln_p).sum(-1)
+            R = ap / (ap.sum(2, keepdim=True) + eps) + eps
+            if detach_R:
+                R = R.detach()
+    return mu, a, sum_R
+
+
+class RoutingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dtype = torch.get_default_dtype()
+        torch.set_default_dtype(torch.float64)
+        torch.manual_seed(0)
+        self.V = torch.randn(3, 10, 4, 16, 2, 2) * 0.5 # b, Bkk, C, h, w, w
+        self.a = torch.rand(3, 10, 4, 1, 2, 2)
+
+    def tearDown(self):
+        torch.set_default_dtype(self.dtype)
+
+    def run_layer(self, routing):
+        V, a = self.V.clone().requires_grad_(), self.a.clone().requires_grad_()
+        mu, act, _ = routing((V, a))
+        (mu.sin().sum() + (act ** 2).sum()).backward()
+        return [mu, act], [V.grad, a.grad, routing.beta_v.grad, routing.beta_a.grad]
+
+    def run_reference(self, routing, detach_R):
+        V, a = self.V.clone().requires_grad_(), self.a.clone().requires_grad_()
+        beta_v, beta_a = routing.beta_v.detach().clone().requires_grad_(), routing.beta_a.detach().clone().requires_grad_()
+        b, Bkk, C, h = V.shape[:4]
+        mu, act, _ = reference_routing(V.permute(0, 1, 2, 4, 5, 3).reshape(b, Bkk, -1, h), a.view(b, Bkk, -1), beta_v, beta_a, routing.output_dim, routing.num_routing, detach_R)
+        (mu.sin().sum() + (act ** 2).sum()).backward()
+        return [mu, act], [V.grad, a.grad, beta_v.grad, beta_a.grad]
+
+    def assertClose(self, xs, ys, tol=1e-12):
+        """ Maximum difference relative to the magnitude of the values (absolute below 1) """
+        for x, y in zip(xs, ys):
+            scale = max(1., y.abs().max().item())
+            self.assertLess((x.flatten() - y.flatten()).abs().max().item() / scale, tol)
+
+    def test_backward_steps_unrolled(self):
+        """ backward_steps=num_routing is the gradient of the fully unrolled routing """
+        for num_routing in (1, 3, 5):
+            routing = layers.MatrixRouting(output_dim=4, num_routing=num_routing, backward_steps=num_routing)
+            out, grads = self.run_layer(routing)
+            out_ref, grads_ref = self.run_reference(routing, detach_R=False)
+            self.assertClose(out, out_ref)
+            self.assertClose(grads, grads_ref)
+
+    def test_backward_steps_detached(self):
+        """ backward_steps=1 (the default) keeps the previous gradient, R is a constant """
+        for num_routing in (1, 3, 5):
+            routing = layers.MatrixRouting(output_dim=4, num_routing=num_routing)
+            out, grads = self.run_layer(routing)
+            out_ref, grads_ref = self.run_reference(routing, detach_R=True)
+            self.assertClose(out, out_ref)
+            self.assertClose(grads, grads_ref)
+
+    def test_fused(self):
+        """ FusedEMStep gives the outputs and gradients of the dense routing, also with sparse coding """
+        for sparse in (False, True):
+            for num_routing in (1, 3):
+                for chunk_size in (3, 16):
+                    results = []
+                    for fused in (False, True):
+                        torch.manual_seed(1)
+                        kw = {}
+                        if sparse:
+                            kw = dict(batchnorm=batchrenorm.BatchRenorm(num_features=4, update_interval=3),
+                                      sparse=layers.SparseCoding(4, boost_update_count=100))
+                        routing = layers.MatrixRouting(output_dim=4, num_routing=num_routing, fused=fused, chunk_size=chunk_size, **kw)
+                        routing.eval() if sparse else routing.train()
+                        V, a = self.V.clone().requires_grad_(), self.a.clone().requires_grad_()
+                        mu, act, sum_R = routing((V, a))
+                        (mu.sin().sum() + (act ** 2).sum() + 0.1 * sum_R.sum()).backward()
+                        results.append([mu, act, sum_R, V.grad, a.grad] + [p.grad for p in routing.parameters() if p.grad is not None])
+                    self.assertEqual(len(results[0]), len(results[1]))
+                    self.assertClose(*results, tol=1e-14)
+
+    def test_fused_unsupported(self):
+        """ Options the fused routing does not implement are rejected instead of ignored """
+        for k, v in (('routing_bytes', 1024), ('tolerance', 1e-3), ('topk', 2), ('backward_steps', 3)):
+            with self.assertRaises(ValueError):
+                layers.MatrixRouting(output_dim=4, num_routing=3, fused=True, **{k: v})
+
+    def test_topk_m_step(self):
+        """ The scatter-add M-step of top-k routing equals the dense M-step when every output is selected """
+        b, Bkk, Cww, h = 3, 7, 12, 5
+        V, a_, R = torch.randn(b, Bkk, Cww, h), torch.rand(b, Bkk, Cww), torch.rand(b, Bkk, Cww)
+        R_idx = torch.arange(Cww).view(1, 1, -1).expand(b, Bkk, Cww).contiguous()
+        sum_R, mu, sigma_square = layers.em_m_step_topk(R, R_idx, a_, V)
+        Ra = (R * a_).unsqueeze(-1)
+        sum_R_ref = Ra.sum(1) + eps
+        mu_ref = ((Ra * V).sum(1) / sum_R_ref).unsqueeze(1)
+        sigma_square_ref = ((Ra * ((V - mu_ref) ** 2 + eps)).sum(1) / sum_R_ref).unsqueeze(1) + eps
+        self.assertClose([sum_R, mu, sigma_square], [sum_R_ref, mu_ref, sigma_square_ref])
+
+    def test_grad_mode_restored(self):
+        """ An exception inside the routing iterations must not leave autograd disabled """
+        routing = layers.MatrixRouting(output_dim=4, num_routing=3)
+        em_probabilities = layers.em_probabilities
+        def fail(*args):
+            raise RuntimeError('routing failed')
+        layers.em_probabilities = fail
+        try:
+            with self.assertRaises(RuntimeError):
+                routing((self.V, self.a))
+        finally:
+            layers.em_probabilities = em_probabilities
+        self.assertTrue(torch.is_grad_enabled())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+'''
+Checks of the routing statistics bookkeeping in util.statSink and util.statBase.
+Run from this directory: python test_stat.py
+'''
+
+import unittest
+from types import SimpleNamespace
+import torch
+import util
+
+
+class Dummy():
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def log(self, *args, **kwargs):
+        pass
+
+    def set_postfix(self, *args, **kwargs):
+        pass
+
+
+class StatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loggers = util.VisdomPlotLogger, util.VisdomLogger
+        util.VisdomPlotLogger = util.VisdomLogger = Dummy
+
+    def tearDown(self):
+        util.VisdomPlotLogger, util.VisdomLogger = self.loggers
+
+    def run_phase(self, logger, stat, steps, value):
+        """ One routing layer appending its 4 statistics per step, as MatrixRouting.update_statistics """
+        logger.reset()
+        for _ in range(steps):
+            for k in range(4):
+                stat.append(torch.tensor(value + k))
+            logger.log(Dummy(), None, None, stat=stat)
+
+    def test_phase_boundaries(self):
+        """ Each epoch and phase gets exactly the statistics of its own steps, none is late or lost """
+        args = SimpleNamespace(disable_recon=True, regularize=True, disable_loss=True, batch_size=1)
+        logger = util.statBase(args)
+        stat = util.statSink(flush_interval=3)
+        for k in range(4):
+            stat.append(0.)
+        for epoch in range(3):
+            value = 10. * epoch
+            self.run_phase(logger, stat, 7, value)
+            logger.endTrainLog(epoch)
+            self.assertEqual(logger.logsigAvg.n, 7)
+            self.assertEqual(logger.logsigAvg.value()[0], value)
+            self.assertEqual(logger.aAvg.value()[0], value + 3)
+            self.run_phase(logger, stat, 5, value + 5)
+            logger.endTestLog(epoch)
+            self.assertEqual(logger.logsigAvg.n, 5)
+            self.assertEqual(logger.costmeanAvg.value()[0], value + 6)
+
+    def test_postfix_without_values(self):
+        """ Before the first flush the progress bar shows no routing statistics instead of nan """
+        args = SimpleNamespace(disable_recon=True, regularize=True, disable_loss=True, batch_size=1)
+        logger = util.statBase(args)
+        stat = util.statSink(flush_interval=3)
+        postfix = {}
+        pbar = Dummy()
+        pbar.set_postfix = lambda d, refresh: postfix.update(d)
+        for k in range(4):
+            stat.append(torch.tensor(1.))
+        logger.log(pbar, None, None, {}, stat=stat)
+        self.assertNotIn('logsig', postfix)
+
+
+if __name__ == '__main__':
+    unittest.main()
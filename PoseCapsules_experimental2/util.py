@@ -17,6 +17,8 @@ import math
 from tqdm import tqdm
 import os
 import glob
+import time
+import multiprocessing
 from torchvision import transforms
 import torch.nn as nn
 import pyrr
@@ -24,6 +26,7 @@ import torchnet as tnt
 from torchnet.logger import VisdomPlotLogger, VisdomLogger
 from torchvision.utils import make_grid
 from collections import OrderedDict
+from folder_index import folder_unchanged, image_index
 #from axisAngle import get_y
 
 #meter_accuracy = tnt.meter.ClassErrorMeter(accuracy=True)
@@ -95,6 +98,88 @@ class CapsuleLoss(nn.Module):
         return self.loss(output, labels)
 
 
+class statSink():
+    """
+    Routing statistics without a device sync per value. append() writes (on-device) scalars into a
+    ring buffer of capacity values, step() marks the end of a training step. Every flush_interval steps
+    the buffer is copied to the host in one transfer, asynchronously into pinned memory on CUDA, and
+    the copy of the previous flush is returned as one list of values per step.
+    The ring buffer has to hold flush_interval steps of values, older ones are dropped.
+    """
+    def __init__(self, capacity=4096, flush_interval=100):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.buffer = None
+        self.head = []          # values appended before the device is known (initial zeros)
+        self.pos = 0            # values appended in total
+        self.flushed = 0        # values handed to the host
+        self.step_ends = []
+        self.steps = 0
+        self.pending = None
+
+    def append(self, value):
+        if not torch.is_tensor(value) and self.buffer is None:
+            self.head.append(float(value))
+            return
+        if self.buffer is None:
+            self.buffer = torch.zeros(self.capacity, device=value.device)
+        self.buffer[self.pos % self.capacity] = value.detach() if torch.is_tensor(value) else value
+        self.pos += 1
+
+    def step(self):
+        self.step_ends.append(self.pos)
+        self.steps += 1
+        if self.steps % self.flush_interval == 0:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """ Start copying the values of the finished steps to the host, returns those of the previous flush """
+        done = self.collect()
+        begin = max(self.flushed, self.pos - self.capacity)
+        values = None
+        if self.buffer is not None and self.pos > begin:
+            index = torch.arange(begin, self.pos, device=self.buffer.device) % self.capacity
+            values = self.buffer[index]
+            host = torch.empty(values.shape, pin_memory=values.is_cuda)
+            host.copy_(values, non_blocking=True)
+            event = None
+            if values.is_cuda:
+                event = torch.cuda.Event()
+                event.record()
+            values = (host, event)
+        self.pending = (values, begin, self.head, self.step_ends)
+        self.flushed = self.pos
+        self.head = []
+        self.step_ends = []
+        return done
+
+    def collect(self):
+        """ Values of the last flush, one list per step (waits for the copy if it is still running) """
+        if self.pending is None:
+            return []
+        values, begin, head, step_ends = self.pending
+        self.pending = None
+        if values is not None:
+            host, event = values
+            if event is not None:
+                event.synchronize()
+            values = host.tolist()
+        else:
+            values = []
+        steps, prev = [], begin
+        for end in step_ends:
+            steps.append(values[max(prev - begin, 0):end - begin])
+            prev = end
+        if head and steps:
+            steps[0] = head + steps[0]
+        return steps
+
+    def drain(self):
+        """ Values of all finished steps, including the ones not yet flushed (waits for the copy) """
+        return self.flush() + self.collect()
+
+
 class statNothing():
     def __init__(self):
         self.lossAvg = tnt.meter.AverageValueMeter()
@@ -124,6 +209,7 @@ class statBase():
         self.test_loss_logger = VisdomPlotLogger('line', opts={'title': 'Test Loss'}, env='PoseCapsules')
         self.recon_sum = 0
         self.rout_id = 1
+        self.stat = None
         if not self.args.disable_recon:
             self.reconLossAvg = tnt.meter.AverageValueMeter()
             self.ground_truth_logger_left = VisdomLogger('image', opts={'title': 'Ground Truth, left'}, env='PoseCapsules')
@@ -136,6 +222,8 @@ class statBase():
             self.aAvg = tnt.meter.AverageValueMeter()
         
     def reset(self):
+        """ Routing statistics still in flight belong to the previous phase, they are dropped """
+        self.drain_stat()
         self.lossAvg.reset()
         if not self.args.disable_recon:
             self.reconLossAvg.reset()
@@ -150,15 +238,19 @@ class statBase():
         if not self.args.disable_loss:
             dict['loss'] = self.lossAvg.value()[0]
         if stat is not None:
-            self.logsigAvg.add(stat[-self.rout_id*4 + 0])
-            self.costmeanAvg.add(stat[-self.rout_id*4 + 1])
-            self.costAvg.add(stat[-self.rout_id*4 + 2])
-            self.aAvg.add(stat[-self.rout_id*4 + 3])
-            stat.clear()
-            dict['logsig'] = self.logsigAvg.value()[0]
-            dict['costmean'] = self.costmeanAvg.value()[0]
-            dict['cost'] = self.costAvg.value()[0]
-            dict['a'] = self.aAvg.value()[0]
+            self.stat = stat
+            if isinstance(stat, statSink):
+                steps = stat.step()
+            else:
+                steps = [list(stat)]
+                stat.clear()
+            self.add_stat(steps)
+            """ A statSink hands over the values only every flush_interval steps """
+            if self.logsigAvg.n > 0:
+                dict['logsig'] = self.logsigAvg.value()[0]
+                dict['costmean'] = self.costmeanAvg.value()[0]
+                dict['cost'] = self.costAvg.value()[0]
+                dict['a'] = self.aAvg.value()[0]
         #dict['mloss'] = self.lossSparseMu.value()[0]
         #dict['vloss'] = self.lossSparseVar.value()[0]
         if not self.args.disable_recon:
@@ -172,7 +264,22 @@ class statBase():
 
         pbar.set_postfix(dict, refresh=False)
 
+    def add_stat(self, steps):
+        for values in steps:
+            if len(values) >= self.rout_id*4:
+                self.logsigAvg.add(float(values[-self.rout_id*4 + 0]))
+                self.costmeanAvg.add(float(values[-self.rout_id*4 + 1]))
+                self.costAvg.add(float(values[-self.rout_id*4 + 2]))
+                self.aAvg.add(float(values[-self.rout_id*4 + 3]))
+
+    def drain_stat(self):
+        """ Routing statistics of the steps logged so far that the statSink has not handed over yet """
+        if isinstance(self.stat, statSink):
+            return self.stat.drain()
+        return []
+
     def endTrainLog(self, epoch, groundtruth_image=None, recon_image=None):
+        self.add_stat(self.drain_stat())
         #self.train_loss = self.lossAvg.value()[0]
         if not self.args.disable_loss:
             self.train_loss_logger.log(epoch, self.lossAvg.value()[0], name='loss')
@@ -189,6 +296,7 @@ class statBase():
         #    self.train_regularize_loss = self.regularizeLossAvg.value()[0]
             
     def endTestLog(self, epoch):
+        self.add_stat(self.drain_stat())
         #loss = self.lossAvg.value()[0]
         if not self.args.disable_loss:
             self.test_loss_logger.log(epoch, self.lossAvg.value()[0], name='loss')
@@ -399,317 +507,366 @@ def split_in_channels(imgs):
     return imgs_stereo
 
 class MyImageFolder(datasets.ImageFolder):
+    """
+    Image folder with the pose labels in the file names. The folder scan and the labels come from image_index,
+    so a large folder is not rescanned and no file name is parsed again
+    """
     def __init__(self, root, transform=None, target_transform=None, data_rep='MSE'):
+        self.index = image_index(root)
         super(MyImageFolder, self).__init__(root, transform, target_transform)
         self.data_rep = 0 if data_rep == 'MSE' else 1
+        self.labels, self.offsets = self.index['labels'], self.index['offsets']
+        del self.index
+
+    def find_classes(self, directory):
+        classes = self.index['classes'].tolist()
+        return classes, {c: i for i, c in enumerate(classes)}
+
+    def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None, allow_empty=False):
+        """ os.path.join(directory, path), spelled out for the hundreds of thousands of paths """
+        prefix = os.path.join(os.path.expanduser(directory), '')
+        return list(zip([prefix + path.decode('utf-8', 'surrogateescape') for path in self.index['paths'].tolist()], self.index['targets'].tolist()))
 
     def __getitem__(self, index):
         path, target = self.samples[index]
         sample = self.loader(path)
         if self.transform is not None:
             sample = self.transform(sample)
-        data = path.split('/')
-        data = data[-1].split('_')
-        data[-1] = data[-1].split('.p')[0]
-        data = [float(i) for i in data]
-
-        if len(data) == 8:
-            data = matMinRep_from_qvec(torch.tensor(data).unsqueeze(0)).squeeze()
-            
-        if self.data_rep==0:
-            labels = torch.tensor(data)
-        else:
-            R = np.array(data[:6]).reshape(2,3)
-            R = np.stack([R[0], R[1], np.cross(R[0],R[1])], axis=0)
-            #axis_angle = get_y(R)
-            Q = pyrr.Quaternion.from_matrix(R)
-            axis_angle_rep = np.concatenate([Q.axis*Q.angle, np.array(data[6:9])], axis=0)
-            labels = torch.from_numpy(axis_angle_rep).float()
+        labels = pose_label(self.labels[self.offsets[index]:self.offsets[index+1]], self.data_rep)
         
         return sample, labels
 
+def pose_label(data, data_rep=0):
+    """ Training target of a label parsed from a file name, 0: as is (quaternions as matrix rows), 1: axis-angle """
+    if len(data) == 8:
+        data = matMinRep_from_qvec(torch.from_numpy(data).float().unsqueeze(0)).squeeze()
+        
+    if data_rep==0:
+        labels = torch.as_tensor(data).float()
+    else:
+        R = np.array(data[:6]).reshape(2,3)
+        R = np.stack([R[0], R[1], np.cross(R[0],R[1])], axis=0)
+        #axis_angle = get_y(R)
+        Q = pyrr.Quaternion.from_matrix(R)
+        axis_angle_rep = np.concatenate([Q.axis*Q.angle, np.array(data[6:9])], axis=0)
+        labels = torch.from_numpy(axis_angle_rep).float()
+    return labels
+
+def _load_chw(path):
+    """ Image as MyImageFolder loads it (RGB), uint8 (C,H,W) """
+    with open(path, 'rb') as f:
+        return np.asarray(Image.open(f).convert('RGB')).transpose(2, 0, 1)
+
+def pack_image_folder(root, processes=None):
+    """
+    Packs an image folder into <root>/images.npy, all images decoded once as uint8 (N,C,H,W), and <root>/labels.npz,
+    the label table of image_index (classes, targets, labels, offsets). The images are decoded in a process pool
+    and written to a memory-mapped file, so the folder never has to fit in memory. All images must have one size
+    """
+    index = image_index(root)
+    prefix = os.path.join(os.path.expanduser(root), '')
+    paths = [prefix + path.decode('utf-8', 'surrogateescape') for path in index['paths'].tolist()]
+    shape = _load_chw(paths[0]).shape
+
+    with open(os.path.join(root, 'labels.npz.part'), 'wb') as f:
+        np.savez(f, **{k: index[k] for k in ['classes', 'targets', 'labels', 'offsets']})
+    os.rename(os.path.join(root, 'labels.npz.part'), os.path.join(root, 'labels.npz'))
+
+    part = os.path.join(root, 'images.npy.part')
+    images = np.lib.format.open_memmap(part, mode='w+', dtype=np.uint8, shape=(len(paths),) + shape)
+    t = time.time()
+    with multiprocessing.Pool(processes) as pool:
+        for i, img in enumerate(pool.imap(_load_chw, paths, chunksize=64)):
+            if img.shape != shape:
+                raise ValueError('{} is {}, the packed images are {}'.format(paths[i], img.shape, shape))
+            images[i] = img
+            if (i+1) % 10000 == 0:
+                print('packed {}/{} images, {:.0f} images/s'.format(i+1, len(paths), (i+1) / (time.time() - t)))
+    images.flush()
+    del images
+    os.rename(part, os.path.join(root, 'images.npy'))
+
+def collate_packed(batch):
+    """ Batch of PackedImageFolder samples, the uint8 images converted to float in [0,1] (as ToTensor) in one go """
+    imgs, labels = data.dataloader.default_collate(batch)
+    return imgs.float().div_(255), labels
+
+class PackedImageFolder(data.Dataset):
+    """
+    MyImageFolder read from its packed form (pack_image_folder, run on first use and whenever the folder changed).
+    An image is a zero-copy uint8 (C,H,W) view of the memory-mapped images.npy, no PNG is decoded and no file is
+    opened per sample; use collate_packed to get float batches. batches() streams the folder in order, in contiguous views
+    """
+    def __init__(self, root, transform=None, target_transform=None, data_rep='MSE'):
+        super(PackedImageFolder, self).__init__()
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+        self.data_rep = 0 if data_rep == 'MSE' else 1
+        if not self.packed_current(root):
+            pack_image_folder(root)
+        with np.load(os.path.join(root, 'labels.npz')) as index:
+            self.classes = index['classes'].tolist()
+            self.targets = index['targets']
+            self.labels, self.offsets = index['labels'], index['offsets']
+        self._images = None
+
+    @staticmethod
+    def packed_current(root):
+        """
+        The packed files exist, come from one complete pack_image_folder run (labels.npz is written first) and no
+        class folder was changed after they were made, the same check as image_index
+        """
+        images, labels = os.path.join(root, 'images.npy'), os.path.join(root, 'labels.npz')
+        if not (os.path.exists(images) and os.path.exists(labels)) or os.path.getmtime(images) < os.path.getmtime(labels):
+            return False
+        with np.load(labels) as index:
+            classes = index['classes'].tolist()
+        return folder_unchanged(root, classes, labels)
+
+    def __getstate__(self):
+        """ Worker processes map the file themselves """
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    @property
+    def images(self):
+        """ Copy-on-write map: the views are writable tensors, writes never reach the file """
+        if self._images is None:
+            self._images = np.load(os.path.join(self.root, 'images.npy'), mmap_mode='c')
+        return self._images
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        img = torch.from_numpy(self.images[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        labels = pose_label(self.labels[self.offsets[index]:self.offsets[index+1]], self.data_rep)
+
+        return img, labels
+
+    def batches(self, batch_size, start=0):
+        """ Sequential streaming: (images, labels) of consecutive samples, the images one uint8 view per batch """
+        for first in range(start, len(self), batch_size):
+            imgs = torch.from_numpy(self.images[first:first+batch_size])
+            if self.transform is not None:
+                imgs = torch.stack([self.transform(img) for img in imgs])
+            labels = torch.stack([pose_label(self.labels[self.offsets[i]:self.offsets[i+1]], self.data_rep) for i in range(first, first+len(imgs))])
+            yield imgs, labels
+
+
+def _splitmix64(z):
+    z = z + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def uniform_hash(seed, index, n, stream=0):
+    """
+    n uniform numbers in [0,1) for every sample index, a counter based hash (splitmix64) of (seed, stream, index),
+    so any sample can be drawn on its own, in any order and in any worker process
+    """
+    with np.errstate(over='ignore'):
+        key = _splitmix64(np.uint64(seed * 2 + stream))
+        counter = np.asarray(index, np.uint64)[:, None] * np.uint64(n) + np.arange(n, dtype=np.uint64)
+        z = _splitmix64(key ^ _splitmix64(counter))
+    return torch.from_numpy((z >> np.uint64(11)).astype(np.float64) * 2.0**-53)
+
+def euler_matrices(roll, pitch, yaw):
+    """ Batched pyrr.matrix33.create_from_eulers(pyrr.euler.create(roll, pitch, yaw)), (N,3,3) """
+    sP, cP = torch.sin(pitch), torch.cos(pitch)
+    sR, cR = torch.sin(roll), torch.cos(roll)
+    sY, cY = torch.sin(yaw), torch.cos(yaw)
+    return torch.stack([torch.stack([cY * cP, -cY * sP * cR + sY * sR, cY * sP * sR + sY * cR], -1),
+                        torch.stack([sP, cP * cR, -cP * sR], -1),
+                        torch.stack([-sY * cP, sY * sP * cR + cY * sR, -sY * sP * sR + cY * cR], -1)], -2)
+
 
 class myTest(data.Dataset):
-    def __init__(self, width=28, sz=1000, img_type='one_point', factor=0.3, rnd = True, transform=None, target_transform=None, max_z=-100000, min_z=100000):
+    """
+    Synthetic datasets, generated on the fly: sample i is a function of (seed, i) only, nothing is stored and a
+    batch of indices is synthesized at once with tensor ops (__getitems__, used by the DataLoader).
+    Without rnd the angle-driven types (simple_angle, three_dot, three_dot_3d) step the angle with the index.
+    seed=None draws one from the (seeded) random module, so a train and a test set differ
+    """
+    """ uniform numbers drawn per sample, with and without rnd """
+    draws = {'one_dot': (2, 2), 'simple_angle': (1, 0), 'one_point': (2, 2), 'one_point_rot': (3, 3), 'two_capsules': (9, 9),
+             'three_dot': (3, 2), 'three_dot_3d': (5, 0), 'matmul_test': (3, 3), 'matmul': (3, 3), 'three_point': (3, 3)}
+
+    def __init__(self, width=28, sz=1000, img_type='one_point', factor=0.3, rnd = True, transform=None, target_transform=None, max_z=-100000, min_z=100000, seed=None):
         super(myTest, self).__init__()
+        if img_type not in self.draws:
+            raise ValueError('Unknown synthetic dataset {}'.format(img_type))
         self.transform = transform
         self.target_transform = target_transform
+        self.width = width
+        self.sz = sz
+        self.img_type = img_type
+        self.rnd = rnd
+        self.seed = random.getrandbits(62) if seed is None else seed
 
-        max_distance = math.sqrt(width**2 + width**2) * factor
+        self.max_distance = math.sqrt(width**2 + width**2) * factor
         self.max_z = max_z
         self.min_z = min_z
 
-        self.train_data = []
-        self.train_labels = []
-        
-        with tqdm(total=sz) as pbar:
-            if img_type=='one_dot':
-                for _ in range(sz):
-                    img = torch.zeros(width,width)
-                    x = int(random.random()*width)
-                    y = int(random.random()*width)
-                    img[x,y] = 1
-                    target = torch.FloatTensor((x,y))
-                    self.train_data.append(img)
-                    self.train_labels.append(target)
-                    pbar.update()
-            elif img_type=='simple_angle':
-                a = 0
-                for _ in range(sz):
-                    img = torch.zeros(width,width)
-                    if rnd:
-                        a = random.random()*2*math.pi
-                    else:
-                        a += 0.063
-                    step_x = math.cos(a)
-                    step_y = math.sin(a)
-                    x = y = width/2
-                    while True:
-                        if x >= width or y >= width or x < 0 or y < 0:
-                            break
-                        img[int(y),int(x)] = 1
-                        x += step_x
-                        y -= step_y
-                            
-                    target = torch.FloatTensor((step_x,step_y))
-                    self.train_data.append(img)
-                    self.train_labels.append(target)
-                    pbar.update()
-            elif img_type=='one_point':
-                for _ in range(sz):
-                    img = torch.zeros(width,width)
-                    x = int(random.random()*width)
-                    y = int(random.random()*width)
-                    for i in range(width):
-                        for j in range(width):
-                            intensency = 1. - math.sqrt((x-i)**2 + (y-j)**2) / max_distance
-                            if intensency < 0.:
-                                intensency = 0.
-                            img[i,j] = intensency**2
-                            
-                    target = torch.FloatTensor((x,y))
-                    self.train_data.append(img)
-                    self.train_labels.append(target)
-                    pbar.update()
-            elif img_type=='one_point_rot':
-                for _ in range(sz):
-                    img = torch.zeros(width,width,2)
-                    x = random.random()*(width-2)+1
-                    y = random.random()*(width-2)+1
-                    r = random.random()*math.pi/2 + math.pi/4
-                    img[int(x),int(y),0] = 1 if math.cos(r) > 0 else 0
-                    img[int(x),int(y),1] = math.sin(r)
-                    target = torch.FloatTensor((x,y,math.cos(r),math.sin(r)))
-                    self.train_data.append(img)
-                    self.train_labels.append(target)
-                    pbar.update()
-            elif img_type=='two_capsules':
-                for _ in range(sz):
-                    thetaA = random.random()*2*math.pi
-                    vectorA = torch.tensor([random.random()*10, random.random()*10, math.cos(thetaA), math.sin(thetaA)])
-                    vectorB = torch.tensor([vectorA[0]+math.cos(thetaA-math.pi/2)*4, vectorA[1]+math.sin(thetaA-math.pi/2)*4, math.cos(thetaA+math.pi/2), math.sin(thetaA+math.pi/2)])
-                    target = torch.tensor([vectorA[0]+(vectorB[0]-vectorA[0])/2, vectorA[1]+(vectorB[1]-vectorA[1])/2, math.cos(thetaA-math.pi/2), math.sin(thetaA-math.pi/2)])
-                    
-                    thetaA = random.random()*2*math.pi
-                    noiseA = torch.tensor([random.random()*10, random.random()*10, math.cos(thetaA), math.sin(thetaA)])
-                    thetaA = random.random()*2*math.pi
-                    noiseB = torch.tensor([random.random()*10, random.random()*10, math.cos(thetaA), math.sin(thetaA)])
-                    
-                    img = torch.stack([vectorA, vectorB, noiseA, noiseB]) # batch_size, input_dim, input_atoms, dim_x, dim_y
-                    self.train_data.append(img[...,None, None])
-                    self.train_labels.append(torch.tensor(target))
-                    pbar.update()
-
-            elif img_type=='three_dot':
-                scale = width/10.0
-                A = np.array([-1,-2])
-                B = np.array([1,-2])
-                C = np.array([0,2])
-                R = 0
-                
-                for _ in range(sz):
-                    img = torch.zeros(width,width)
-                    #XY = np.array([5., 5.])
-                    XY = np.array([random.random()*5 + 2.5, random.random()*5 + 2.5])
-                    
-                    if rnd:
-                        R = random.random()*2*math.pi
-                    else:
-                        R += 0.063
-                        
-                    AA = ( [A[0]*math.cos(R)-A[1]*math.sin(R), A[0]*math.sin(R)+A[1]*math.cos(R)] + XY ) * scale
-                    BB = ( [B[0]*math.cos(R)-B[1]*math.sin(R), B[0]*math.sin(R)+B[1]*math.cos(R)] + XY ) * scale
-                    CC = ( [C[0]*math.cos(R)-C[1]*math.sin(R), C[0]*math.sin(R)+C[1]*math.cos(R)] + XY ) * scale
-                    Xaxis = [math.cos(R), math.sin(R)]
-
-                    img[int(AA[0]), int(AA[1])] = 1
-                    img[int(BB[0]), int(BB[1])] = 0.7
-                    img[int(CC[0]), int(CC[1])] = 0.4
-
-                    img = img.unsqueeze(0)
-                            
-                    target = torch.tensor([XY[0], XY[1], Xaxis[0], Xaxis[1]])
-                    target[:2] = (target[:2] - 2.5) / (5./2.) - 1 # scale to {-1,1}
-                    self.train_data.append(img)
-                    self.train_labels.append(target)
-                    pbar.update()
-            elif img_type=='three_dot_3d':
-                scale = width/10.0
-                A = np.array([-1,-2,0])
-                B = np.array([1,-2,0])
-                C = np.array([0,2,0])
-                R = 0.01222
-
-                if self.max_z != -100000 or self.min_z != 100000:
-                    find_max_min = False
-                else:
-                    find_max_min = True
-                for _ in range(sz):
-                    img = torch.zeros(3, width,width)
-
-                    if rnd:
-                        x_rot = random.random()*2.0*math.pi
-                        y_rot = random.random()*2.0*math.pi
-                        #y_rot = (random.random()*0.5-0.25)*math.pi
-                        z_rot = random.random()*2.0*math.pi
-                        xyz = pyrr.vector3.create(random.random()*5 + 2.5, random.random()*5 + 2.5, 5.0)
-                    else:
-                        x_rot = R
-                        y_rot = R
-                        z_rot = R
-                        xyz = pyrr.vector3.create(math.cos(R)*5 + 2.5, math.sin(R)*5 + 2.5, 0.0)
-                        R += 0.063
-
-                    euler = pyrr.euler.create(roll=x_rot, pitch=y_rot, yaw=z_rot)
-                    #rot = pyrr.Quaternion.from_eulers(euler)
-                    mat = pyrr.matrix33.create_from_eulers(euler)
-                    AA = (pyrr.matrix33.apply_to_vector(mat, A)+xyz) * scale
-                    BB = (pyrr.matrix33.apply_to_vector(mat, B)+xyz) * scale
-                    CC = (pyrr.matrix33.apply_to_vector(mat, C)+xyz) * scale
-
-                    red = AA[2] + 1.0*scale
-                    green = BB[2] + 1.0*scale
-                    blue = CC[2] + 1.0*scale
-                    
-                    img[0, int(AA[0]), int(AA[1])] = red
-                    img[1, int(BB[0]), int(BB[1])] = green
-                    img[2, int(CC[0]), int(CC[1])] = blue
-
-                    if find_max_min:
-                        if max([red,green,blue]) > self.max_z:
-                            self.max_z = max([red,green,blue])
-                        if min([red,green,blue]) < self.min_z:
-                            self.min_z = min([red,green,blue])
-                    
-                    target = torch.tensor([mat[0,0], mat[0,1],mat[0,2],mat[1,0],mat[1,1],mat[1,2], xyz[0], xyz[1], xyz[2], 1.0])
-                    self.train_data.append(img)
-                    self.train_labels.append(target)
-                    pbar.update()
-                
-                a = (0.1-1)/(self.min_z-self.max_z)
-                b = 1-self.max_z*a
-                for i,val in enumerate(self.train_data):
-                    bb = (val > 0).float() * b
-                    aa = (val > 0).float() * a
-                    self.train_data[i] *= aa
-                    self.train_data[i] += bb
-            elif img_type=='matmul_test':
-                x_rot = random.random()*2.0*math.pi
-                y_rot = random.random()*2.0*math.pi
-                z_rot = random.random()*2.0*math.pi
-                euler = pyrr.euler.create(roll=x_rot, pitch=y_rot, yaw=z_rot)
-                mat = pyrr.matrix33.create_from_eulers(euler)
-                trans = torch.from_numpy(mat).float()
-                for _ in range(sz):
-                    x_rot = random.random()*1.*math.pi
-                    y_rot = random.random()*1.*math.pi
-                    z_rot = random.random()*1.*math.pi
-                    euler = pyrr.euler.create(roll=x_rot, pitch=y_rot, yaw=z_rot)
-                    mat = pyrr.matrix33.create_from_eulers(euler)
-                    img = torch.from_numpy(mat).float()
-                    self.train_data.append(img.view(1,3,3))
-                    target = trans @ img
-                    self.train_labels.append(target.view(1,3,3))
-                    pbar.update()
-
-            elif img_type=='matmul':
-                isz = 28
-                x_rot = random.random()*2.0*math.pi
-                y_rot = random.random()*2.0*math.pi
-                z_rot = random.random()*2.0*math.pi
-                euler = pyrr.euler.create(roll=x_rot, pitch=y_rot, yaw=z_rot)
-                mat = pyrr.matrix33.create_from_eulers(euler)
-                trans = torch.from_numpy(mat).float()
-                for _ in range(sz):
-                    img_list = []
-                    trg_list = []
-                    x_scale = random.random()*0.5 + 0.5
-                    y_scale = random.random()*0.5 + 0.5
-                    z_scale = random.random()*0.5 + 0.5
-                    for i in range(isz):
-                        for j in range(isz):
-                            d = math.sqrt(i*i + j*j)
-                            x_rot = 4*math.pi*d*x_scale / (isz/2.)
-                            y_rot = 4*math.pi*d*y_scale / (isz/2.)
-                            z_rot = 4*math.pi*d*z_scale / (isz/2.)
-                            euler = pyrr.euler.create(roll=x_rot, pitch=y_rot, yaw=z_rot)
-                            mat = pyrr.matrix33.create_from_eulers(euler)
-                            img = torch.from_numpy(mat).float()
-                            img_list.append(img)
-                            target = trans @ img
-                            trg_list.append(target)
-
-                    img = torch.stack(img_list)
-                    img = img.permute(1,2,0).view(9,isz,isz)
-                    self.train_data.append(img)
-                    target = torch.stack(trg_list)
-                    target = target.permute(1,2,0).view(9,isz,isz)
-                    self.train_labels.append(target)
-                    pbar.update()
-
-            elif img_type=='three_point':
-                scale = width/10.0
-                A = np.array([-1,-2])
-                B = np.array([1,-2])
-                C = np.array([0,2])
-                
-                for _ in range(sz):
-                    img = torch.zeros(width,width)
-                    XY = np.array([random.random()*5 + 2.5, random.random()*5 + 2.5])
-                    #x = int(random.random()*5) + 2.5
-                    #y = int(random.random()*5) + 2.5
-                    R = random.random()*2*math.pi
-                    AA = ( [A[0]*math.cos(R)-A[1]*math.sin(R), A[0]*math.sin(R)+A[1]*math.cos(R)] + XY ) * scale
-                    BB = ( [B[0]*math.cos(R)-B[1]*math.sin(R), B[0]*math.sin(R)+B[1]*math.cos(R)] + XY ) * scale
-                    CC = ( [C[0]*math.cos(R)-C[1]*math.sin(R), C[0]*math.sin(R)+C[1]*math.cos(R)] + XY ) * scale
-                    Xaxis = [math.cos(R), math.sin(R)]
-                    for i in range(width):
-                        for j in range(width):
-                            dist = (AA[0]-i)**2 + (AA[1]-j)**2
-                            dist_next = (BB[0]-i)**2 + (BB[1]-j)**2
-                            if dist_next < dist:
-                                dist=dist_next
-                            dist_next = (CC[0]-i)**2 + (CC[1]-j)**2
-                            if dist_next < dist:
-                                dist=dist_next
-                            
-                            intensency = 1. - math.sqrt(dist) / max_distance
-                            if intensency < 0.7:
-                                intensency = 0.
-                            img[i,j] = intensency**2
-                            
-                    target = torch.tensor([XY[0], XY[1], Xaxis[0], Xaxis[1]])
-                    target[:2] = (target[2] - 2.5) / (5./2.) - 1 # scale to {-1,1}
-                    self.train_data.append(img)
-                    self.train_labels.append(target)
-                    pbar.update()
-
+        if img_type == 'matmul_test' or img_type == 'matmul':
+            """ One transformation for the whole dataset """
+            rot = uniform_hash(self.seed, [0], 3, stream=1)[0] * 2.0*math.pi
+            self.trans = euler_matrices(rot[0:1], rot[1:2], rot[2:3])[0].float()
+        elif img_type == 'three_dot_3d' and self.max_z == -100000 and self.min_z == 100000:
+            """ Depth range of the whole set, swept in blocks (only the dot positions are computed) """
+            for start in range(0, sz, 65536):
+                points = self._three_dot_3d_points(torch.arange(start, min(start + 65536, sz)))[0]
+                self.max_z = max(self.max_z, points[..., 2].max().item() + width/10.0)
+                self.min_z = min(self.min_z, points[..., 2].min().item() + width/10.0)
 
     def __len__(self):
-        return len(self.train_data)
+        return self.sz
 
     def __getitem__(self, index):
-        img, target = self.train_data[index], self.train_labels[index]
+        img, target = self.__getitems__([index])[0]
+
+        return img, target
+
+    def __getitems__(self, indices):
+        index = torch.as_tensor(indices, dtype=torch.long).view(-1)
+        if len(index) and (index.min() < -self.sz or index.max() >= self.sz):
+            raise IndexError('index out of range')
+        imgs, targets = self.batch(index % self.sz)
+        return list(zip(imgs, targets))
+
+    def _uniform(self, index):
+        return uniform_hash(self.seed, index.numpy(), self.draws[self.img_type][0 if self.rnd else 1])
+
+    def _pixels(self, v):
+        """ int() of the coordinates, negative ones index from the end like the python indexing did """
+        return v.trunc().long() % self.width
+
+    def _three_dot_3d_points(self, index):
+        """ Rotations (N,3,3) and the three dots (N,3,3) [dot, xyz] in pixels """
+        scale = self.width/10.0
+        u = self._uniform(index)
+        if self.rnd:
+            x_rot, y_rot, z_rot = u[:, 0]*2.0*math.pi, u[:, 1]*2.0*math.pi, u[:, 2]*2.0*math.pi
+            xyz = torch.stack([u[:, 3]*5 + 2.5, u[:, 4]*5 + 2.5, torch.full_like(u[:, 3], 5.0)], -1)
+        else:
+            x_rot = y_rot = z_rot = 0.01222 + 0.063*index.double()
+            xyz = torch.stack([torch.cos(x_rot)*5 + 2.5, torch.sin(x_rot)*5 + 2.5, torch.zeros_like(x_rot)], -1)
+        mat = euler_matrices(x_rot, y_rot, z_rot)
+        dots = torch.tensor([[-1.,-2.,0.], [1.,-2.,0.], [0.,2.,0.]], dtype=torch.float64)
+        """ np.dot(vec, mat) """
+        points = dots[None, :, 0, None]*mat[:, None, 0] + dots[None, :, 1, None]*mat[:, None, 1] + dots[None, :, 2, None]*mat[:, None, 2]
+        return (points + xyz[:, None]) * scale, mat, xyz
+
+    def _three_dots_2d(self, XY, R):
+        """ The three dots (N,3,2) of the flat types in pixels """
+        scale = self.width/10.0
+        dots = torch.tensor([[-1.,-2.], [1.,-2.], [0.,2.]], dtype=torch.float64)
+        c, s = torch.cos(R)[:, None], torch.sin(R)[:, None]
+        rotated = torch.stack([dots[:, 0]*c - dots[:, 1]*s, dots[:, 0]*s + dots[:, 1]*c], -1)
+        return (rotated + XY[:, None]) * scale
+
+    def batch(self, index):
+        """ Images and targets of a batch of sample indices, stacked """
+        N, width = len(index), self.width
+        n = torch.arange(N)
+        u = self._uniform(index)
+        grid = torch.arange(width, dtype=torch.float64)
+
+        if self.img_type=='one_dot':
+            x = (u[:, 0]*width).long()
+            y = (u[:, 1]*width).long()
+            img = torch.zeros(N, width, width)
+            img[n, x, y] = 1
+            target = torch.stack([x, y], -1).float()
+        elif self.img_type=='simple_angle':
+            a = u[:, 0]*2*math.pi if self.rnd else 0.063*(index.double() + 1)
+            step_x = torch.cos(a)
+            step_y = torch.sin(a)
+            """ Walk from the centre until the first step off the image; cumsum adds up the steps in the same order as x += step_x """
+            steps = int(width * 0.75) + 2
+            x = torch.cat([torch.full((N, 1), width/2, dtype=torch.float64), step_x[:, None].expand(N, steps - 1)], 1).cumsum(1)
+            y = torch.cat([torch.full((N, 1), width/2, dtype=torch.float64), -step_y[:, None].expand(N, steps - 1)], 1).cumsum(1)
+            inside = ((x < width) & (y < width) & (x >= 0) & (y >= 0)).cummin(1)[0]
+            img = torch.zeros(N, width, width)
+            rows = n[:, None].expand(N, steps)[inside]
+            img[rows, y[inside].long(), x[inside].long()] = 1
+            target = torch.stack([step_x, step_y], -1).float()
+        elif self.img_type=='one_point':
+            x = (u[:, 0]*width).long()
+            y = (u[:, 1]*width).long()
+            dist = ((x[:, None, None] - grid[:, None])**2 + (y[:, None, None] - grid)**2).sqrt()
+            img = ((1. - dist / self.max_distance).clamp(min=0.)**2).float()
+            target = torch.stack([x, y], -1).float()
+        elif self.img_type=='one_point_rot':
+            x = u[:, 0]*(width-2)+1
+            y = u[:, 1]*(width-2)+1
+            r = u[:, 2]*math.pi/2 + math.pi/4
+            img = torch.zeros(N, width, width, 2)
+            img[n, x.long(), y.long(), 0] = (torch.cos(r) > 0).float()
+            img[n, x.long(), y.long(), 1] = torch.sin(r).float()
+            target = torch.stack([x, y, torch.cos(r), torch.sin(r)], -1).float()
+        elif self.img_type=='two_capsules':
+            def capsule(theta, x, y):
+                return torch.stack([x*10, y*10, torch.cos(theta), torch.sin(theta)], -1).float()
+            thetaA = u[:, 0]*2*math.pi
+            vectorA = capsule(thetaA, u[:, 1], u[:, 2])
+            vectorB = torch.stack([vectorA[:, 0]+(torch.cos(thetaA-math.pi/2)*4).float(), vectorA[:, 1]+(torch.sin(thetaA-math.pi/2)*4).float(),
+                                   torch.cos(thetaA+math.pi/2).float(), torch.sin(thetaA+math.pi/2).float()], -1)
+            target = torch.stack([vectorA[:, 0]+(vectorB[:, 0]-vectorA[:, 0])/2, vectorA[:, 1]+(vectorB[:, 1]-vectorA[:, 1])/2,
+                                  torch.cos(thetaA-math.pi/2).float(), torch.sin(thetaA-math.pi/2).float()], -1)
+            noiseA = capsule(u[:, 3]*2*math.pi, u[:, 4], u[:, 5])
+            noiseB = capsule(u[:, 6]*2*math.pi, u[:, 7], u[:, 8])
+            img = torch.stack([vectorA, vectorB, noiseA, noiseB], 1)[..., None, None] # batch_size, input_dim, input_atoms, dim_x, dim_y
+        elif self.img_type=='three_dot':
+            XY = u[:, :2]*5 + 2.5
+            R = u[:, 2]*2*math.pi if self.rnd else 0.063*(index.double() + 1)
+            points = self._pixels(self._three_dots_2d(XY, R))
+            img = torch.zeros(N, width, width)
+            for dot, value in enumerate([1, 0.7, 0.4]):
+                img[n, points[:, dot, 0], points[:, dot, 1]] = value
+            img = img.unsqueeze(1)
+            target = torch.stack([XY[:, 0], XY[:, 1], torch.cos(R), torch.sin(R)], -1)
+            target[:, :2] = (target[:, :2] - 2.5) / (5./2.) - 1 # scale to {-1,1}
+        elif self.img_type=='three_dot_3d':
+            points, mat, xyz = self._three_dot_3d_points(index)
+            depth = points[..., 2] + 1.0*width/10.0
+            pixels = self._pixels(points)
+            img = torch.zeros(N, 3, width, width)
+            for dot in range(3):
+                img[n, dot, pixels[:, dot, 0], pixels[:, dot, 1]] = depth[:, dot].float()
+            a = (0.1-1)/(self.min_z-self.max_z)
+            b = 1-self.max_z*a
+            dots = (img > 0).float()
+            img *= dots * a
+            img += dots * b
+            target = torch.cat([mat[:, 0], mat[:, 1], xyz, torch.ones(N, 1, dtype=torch.float64)], -1)
+        elif self.img_type=='matmul_test':
+            rot = u*1.*math.pi
+            img = euler_matrices(rot[:, 0], rot[:, 1], rot[:, 2]).float()
+            target = (self.trans @ img).view(N,1,3,3)
+            img = img.view(N,1,3,3)
+        elif self.img_type=='matmul':
+            isz = 28
+            scales = u*0.5 + 0.5
+            d = (torch.arange(isz, dtype=torch.float64)[:, None]**2 + torch.arange(isz, dtype=torch.float64)**2).sqrt()
+            rot = 4*math.pi*d*scales[:, :, None, None] / (isz/2.)
+            img = euler_matrices(rot[:, 0], rot[:, 1], rot[:, 2]).float()
+            target = self.trans @ img
+            img = img.permute(0,3,4,1,2).reshape(N,9,isz,isz)
+            target = target.permute(0,3,4,1,2).reshape(N,9,isz,isz)
+        elif self.img_type=='three_point':
+            XY = u[:, :2]*5 + 2.5
+            R = u[:, 2]*2*math.pi
+            points = self._three_dots_2d(XY, R)
+            dist = ((points[:, :, 0, None, None] - grid[:, None])**2 + (points[:, :, 1, None, None] - grid)**2).min(1)[0]
+            intensency = 1. - dist.sqrt() / self.max_distance
+            img = (intensency.masked_fill(intensency < 0.7, 0.)**2).float()
+            target = torch.stack([XY[:, 0], XY[:, 1], torch.cos(R), torch.sin(R)], -1)
+            target[:, :2] = ((target[:, 2] - 2.5) / (5./2.) - 1)[:, None] # scale to {-1,1}
 
         return img, target
 
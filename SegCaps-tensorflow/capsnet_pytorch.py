@@ -24,7 +24,11 @@ from layers import CapsuleLayer, calc_same_padding
 
 
 class CapsNetR3(nn.Module):
-    def __init__(self, n_class=2):
+    """
+    tile: route the capsule layers in tiles of tile x tile positions (see CapsuleLayer),
+          bounds the memory of a 512x512 slice with identical segmentations
+    """
+    def __init__(self, n_class=2, device=torch.device('cuda'), tile=None):
         super(CapsNetR3, self).__init__()
         # Layer 1: Just a conventional Conv2D layer
         d = 512
@@ -32,8 +36,6 @@ class CapsNetR3(nn.Module):
         self.conv1 = nn.Conv2d(in_channels=1, out_channels=16, kernel_size=5, stride=1, padding=padding, bias=True)
         #conv1 = layers.Conv2D(filters=16, kernel_size=5, strides=1, padding='same', activation='relu', name='conv1')(x)
     
-        device = torch.device('cuda')
-    
         # Reshape layer to be 1 capsule x [filters] atoms
         #_, H, W, C = conv1.get_shape()
         #conv1_reshaped = layers.Reshape((H.value, W.value, 1, C.value))(conv1)
@@ -41,37 +43,37 @@ class CapsNetR3(nn.Module):
         # Layer 1: Primary Capsule: Conv cap with routing 1
         padding, d = calc_same_padding(d, kernel=5, stride=2)
         self.primary_caps = CapsuleLayer(output_dim=2, output_atoms=16, num_routing=1,
-                                             voting={'type': 'Conv2d', 'stride': 2, 'kernel_size': 5, 'padding': padding}, device=device)
+                                             voting={'type': 'Conv2d', 'stride': 2, 'kernel_size': 5, 'padding': padding}, device=device, tile=tile)
 
         # Layer 2: Convolutional Capsule
         padding, d = calc_same_padding(d, kernel=5, stride=1)
         self.conv_cap_2_1 = CapsuleLayer(output_dim=4, output_atoms=16, num_routing=3,
-                                             voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device)
+                                             voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device, tile=tile)
     
         # Layer 2: Convolutional Capsule
         padding, d = calc_same_padding(d, kernel=5, stride=2)
         self.conv_cap_2_2 = CapsuleLayer(output_dim=4, output_atoms=32, num_routing=3,
-                                             voting={'type': 'Conv2d', 'stride': 2, 'kernel_size': 5, 'padding': padding}, device=device)
+                                             voting={'type': 'Conv2d', 'stride': 2, 'kernel_size': 5, 'padding': padding}, device=device, tile=tile)
     
         # Layer 3: Convolutional Capsule
         padding, d = calc_same_padding(d, kernel=5, stride=1)
         self.conv_cap_3_1 = CapsuleLayer(output_dim=8, output_atoms=32, num_routing=3,
-                                             voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device)
+                                             voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device, tile=tile)
     
         # Layer 3: Convolutional Capsule
         padding, d = calc_same_padding(d, kernel=5, stride=2)
         self.conv_cap_3_2 = CapsuleLayer(output_dim=8, output_atoms=64, num_routing=3,
-                                             voting={'type': 'Conv2d', 'stride': 2, 'kernel_size': 5, 'padding': padding}, device=device)
+                                             voting={'type': 'Conv2d', 'stride': 2, 'kernel_size': 5, 'padding': padding}, device=device, tile=tile)
     
         # Layer 4: Convolutional Capsule
         padding, d = calc_same_padding(d, kernel=5, stride=1)
         self.conv_cap_4_1 = CapsuleLayer(output_dim=8, output_atoms=32, num_routing=3,
-                                             voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device)
+                                             voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device, tile=tile)
     
         # Layer 1 Up: Deconvolutional Capsule
         padding, d = calc_same_padding(d, kernel=4, stride=2, transposed=True)
         self.deconv_cap_1_1 = CapsuleLayer(output_dim=8, output_atoms=32, num_routing=3,
-                                               voting={'type': 'ConvTranspose2d', 'stride': 2, 'kernel_size': 4, 'padding': padding}, device=device)
+                                               voting={'type': 'ConvTranspose2d', 'stride': 2, 'kernel_size': 4, 'padding': padding}, device=device, tile=tile)
     
         # Skip connection
         #up_1 = layers.Concatenate(axis=-2, name='up_1')([deconv_cap_1_1, conv_cap_3_1])
@@ -79,12 +81,12 @@ class CapsNetR3(nn.Module):
         # Layer 1 Up: Deconvolutional Capsule
         padding, d = calc_same_padding(d, kernel=5, stride=1)
         self.deconv_cap_1_2 = CapsuleLayer(output_dim=4, output_atoms=32, num_routing=3,
-                                               voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device)
+                                               voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device, tile=tile)
     
         # Layer 2 Up: Deconvolutional Capsule
         padding, d = calc_same_padding(d, kernel=4, stride=2, transposed=True)
         self.deconv_cap_2_1 = CapsuleLayer(output_dim=4, output_atoms=16, num_routing=3,
-                                               voting={'type': 'ConvTranspose2d', 'stride': 2, 'kernel_size': 4, 'padding': padding}, device=device)
+                                               voting={'type': 'ConvTranspose2d', 'stride': 2, 'kernel_size': 4, 'padding': padding}, device=device, tile=tile)
     
         # Skip connection
         #up_2 = layers.Concatenate(axis=-2, name='up_2')([deconv_cap_2_1, conv_cap_2_1])
@@ -92,12 +94,12 @@ class CapsNetR3(nn.Module):
         # Layer 2 Up: Deconvolutional Capsule
         padding, d = calc_same_padding(d, kernel=5, stride=1)
         self.deconv_cap_2_2 = CapsuleLayer(output_dim=4, output_atoms=16, num_routing=3,
-                                               voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device)
+                                               voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 5, 'padding': padding}, device=device, tile=tile)
     
         # Layer 3 Up: Deconvolutional Capsule
         padding, d = calc_same_padding(d, kernel=4, stride=2, transposed=True)
         self.deconv_cap_3_1 = CapsuleLayer(output_dim=2, output_atoms=16, num_routing=3,
-                                               voting={'type': 'ConvTranspose2d', 'stride': 2, 'kernel_size': 4, 'padding': padding}, device=device)
+                                               voting={'type': 'ConvTranspose2d', 'stride': 2, 'kernel_size': 4, 'padding': padding}, device=device, tile=tile)
     
         # Skip connection
         #up_3 = layers.Concatenate(axis=-2, name='up_3')([deconv_cap_3_1, conv1_reshaped])
@@ -105,10 +107,11 @@ class CapsNetR3(nn.Module):
         # Layer 4: Convolutional Capsule: 1x1
         padding, d = calc_same_padding(d, kernel=1, stride=1)
         self.seg_caps = CapsuleLayer(output_dim=1, output_atoms=16, num_routing=3,
-                                         voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 1, 'padding': padding}, device=device)
+                                         voting={'type': 'Conv2d', 'stride': 1, 'kernel_size': 1, 'padding': padding}, device=device, tile=tile)
     
         # Layer 4: This is an auxiliary layer to replace each capsule with its length. Just to match the true label's shape.
         self.out_seg = Length(num_classes=n_class, seg=True)
+        self.tile = tile
     
         # Decoder network.
         #_, H, W, C, A = seg_caps.get_shape()
@@ -206,13 +209,20 @@ class CapsNetR3(nn.Module):
         #def shared_decoder(mask_layer):
         recon_remove_dim = masked_by_y.view(-1, A, H, W) # -> (1,512,512,16)
 
+        if self.tile:
+            # The decoder is pointwise, decode bands of tile rows so only one band of the 128 channels exists at a time
+            out_recon = torch.cat([self.decode(band) for band in recon_remove_dim.split(self.tile, dim=2)], dim=2)
+        else:
+            out_recon = self.decode(recon_remove_dim)
+
+        return out_seg, out_recon
+
+    def decode(self, recon_remove_dim):
         recon_1 = F.relu(self.recon_1(recon_remove_dim))# -> (1,512,512,64)
 
         recon_2 = F.relu(self.recon_2(recon_1))# -> (1,512,512,128)
 
-        out_recon = torch.sigmoid(self.out_recon(recon_2))# -> (1,512,512,1)
-
-        return out_seg, out_recon
+        return torch.sigmoid(self.out_recon(recon_2))# -> (1,512,512,1)
 
 """    
 nn.init.normal(self.recon_1.weight, mean=0,std=0.1)
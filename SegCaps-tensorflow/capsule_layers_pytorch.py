@@ -18,6 +18,12 @@ from torchvision import transforms
 from PIL import Image
 from keras.utils.conv_utils import deconv_length
 
+import os
+import sys
+# one routing engine for both projects, the dynamic routing of DynamicRouting/layers.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DynamicRouting'))
+from layers import dynamic_routing
+
 class Length(nn.Module):
     def __init__(self, num_classes, seg=True):
         super(Length, self).__init__()
@@ -106,15 +112,9 @@ class ConvCapsuleLayer(nn.Module):
         # votes: (1,1,8,32,512,512)
         votes = votes.permute(0,1,4,5,2,3)
 
-        logit_shape = torch.Size([input_shape[0], input_shape[1], conv_height, conv_width, self.num_capsule]) # -> (1,1,512,512,8)
-        biases_replicated = self.b.repeat(conv_height, conv_width, 1, 1) # -> (512,512,8,32)
-
         activations = update_routing(
             votes=votes,
-            biases=biases_replicated,
-            logit_shape=logit_shape,
-            num_dims=6,
-            input_dim=self.input_num_capsule,
+            biases=self.b, # (1,1,8,32) broadcasts over (512,512,8,32)
             num_routing=self.routings) # -> (1, 512,512,8,32)
 
         return activations.permute(0,3,4,1,2)
@@ -187,84 +187,20 @@ class DeconvCapsuleLayer(nn.Module):
 
         votes = outputs.view(input_shape[1], input_shape[0], votes_shape[1], votes_shape[2], self.num_capsule, self.num_atoms)
 
-        logit_shape = torch.stack([input_shape[1], input_shape[0], votes_shape[1], votes_shape[2], self.num_capsule])
-        biases_replicated = self.b.repeat(votes_shape[1], votes_shape[2], 1, 1)
-
         activations = update_routing(
             votes=votes,
-            biases=biases_replicated,
-            logit_shape=logit_shape,
-            num_dims=6,
-            input_dim=self.input_num_capsule,
+            biases=self.b,
             num_routing=self.routings)
 
         return activations
 """
-def update_routing(votes, biases, logit_shape, num_dims, input_dim, num_routing):
-    # votes: (1,1,512,512,8,32)
-    if num_dims == 6:
-        votes_t_shape = 5, 0, 1, 2, 3, 4
-        r_t_shape = 1, 2, 3, 4, 5, 0
-    elif num_dims == 4:
-        votes_t_shape = 3, 0, 1, 2
-        r_t_shape = 1, 2, 3, 0
-    else:
+def update_routing(votes, biases, num_routing):
+    # votes: (1,1,512,512,8,32), output capsules and their atoms are the last two dims
+    if votes.dim() not in (4, 6):
         raise NotImplementedError('Not implemented')
+    return dynamic_routing(votes, biases, num_routing, capsule_dim=votes.dim() - 2, detach_logits=True) # -> (1,512,512,8,32)
 
-    votes_trans = votes.permute(votes_t_shape) # -> (32,1,1,512,512,8)
-    #_, _, _, height, width, caps = votes_trans.shape
-
-    activations = []
-    logits = Variable(torch.zeros(logit_shape), requires_grad=False).cuda() # -> (1,1,512,512,8)
-
-    for _ in range(num_routing):
-        """Routing while loop."""
-        # route: [batch, input_dim, output_dim, ...]
-        route = F.softmax(logits, dim=-1) # -> (1,1,512,512,8)
-        preactivate_unrolled = route * votes_trans # -> (32,1,1,512,512,8)
-        preact_trans = preactivate_unrolled.permute(r_t_shape) # -> (1,1,512,512,8,32)
-        preactivate = preact_trans.sum(dim=1) + biases # -> (1,512,512,8,32)
-        activation = _squash(preactivate) # -> (1,512,512,8,32)
-        activations.append(activation)
-        
-        act_3d = activation.data.unsqueeze(1) # -> (1,1,512,512,8,32)
-        #-----
-        tile_shape = torch.ones(num_dims, dtype=torch.int32).tolist() # -> [1,1,1,1,1,1]
-        tile_shape[1] = input_dim
-        act_replicated = act_3d.repeat(tile_shape) # -> (1,1,512,512,8,32)
-        #-----
-        distances = (votes.data * act_replicated).sum(dim=-1) # -> (1,1,512,512,8)
-        logits += distances
-
-    return activations[num_routing - 1]
-
-"""
-def dynamic_routing(self, votes, b, r):
-    batch_size, input_caps, output_caps, output_dim = votes.size()
-    route = F.softmax(b)
-    preactivation = (route.unsqueeze(2) * votes).sum(dim=1)
-    activation = squash(preactivation)
-
-    b_batch = b.expand((batch_size, input_caps, output_caps))
-    for _ in range(r):
-        activation = activation.unsqueeze(1)
-        #-----
-        #-----
-        b_batch += (votes * activation).sum(-1)
-        route = F.softmax(b_batch.view(-1, output_caps)).view(-1, input_caps, output_caps, 1)
-        preactivation = (route * votes).sum(dim=1)
-        activation = squash(preactivation)
-
-    return activation
-
-def squash(x):
-    lengths2 = x.pow(2).sum(dim=2)
-    lengths = lengths2.sqrt()
-    x = x * (lengths2 / (1 + lengths2) / lengths).view(x.size(0), x.size(1), 1)
-    return x
-"""
-
-def _squash(input_tensor):
-    norm = input_tensor.norm(dim=-1, keepdim=True)
+def _squash(input_tensor, dim=-1):
+    norm = input_tensor.norm(dim=dim, keepdim=True)
     norm_squared = norm ** 2
     return (input_tensor / norm) * (norm_squared / (1 + norm_squared))
@@ -13,8 +13,13 @@ Modifications will be needed to train/test on normal 3-channel images.
 from __future__ import print_function
 
 import threading
+import functools
+import multiprocessing
+import queue as queue_module
+import time
+import traceback
 from os.path import join, basename
-from os import mkdir
+from os import mkdir, rename
 from glob import glob
 import csv
 from sklearn.model_selection import KFold
@@ -113,7 +118,48 @@ def split_data(root_path, num_splits=4):
         n += 1
 
 
-def convert_data_to_numpy(root_path, img_name, no_masks=False, overwrite=False):
+def save_uncompressed(numpy_path, fname, img, mask=None):
+    '''
+        Uncompressed, memory-mappable copy of a scan: <fname>_img.npy, <fname>_mask.npy and <fname>_slices.npy, the
+        indices of the slices with any mask. The volumes are stored slice by slice, (slices, rows, cols), so reading
+        a few slices from the map only touches those slices.
+    '''
+    arrays = [('img', img)]
+    if mask is not None:
+        arrays = [('slices', np.flatnonzero(np.any(mask, axis=(0, 1)))), ('mask', mask)] + arrays
+    for key, value in arrays:
+        path = join(numpy_path, fname + '_' + key + '.npy')
+        with open(path + '.part', 'wb') as f:
+            np.save(f, value if key == 'slices' else np.ascontiguousarray(np.moveaxis(value, 2, 0)))
+        rename(path + '.part', path)
+
+def load_uncompressed(root_path, scan_name, no_masks=False):
+    '''
+        Memory maps of the uncompressed scan (rows, cols, slices) like the npz arrays, and the indices of the slices
+        with any mask. Raises IOError if the scan has not been converted with uncompressed=True.
+    '''
+    path = join(root_path, 'np_files', basename(scan_name)[:-4])
+    img = np.moveaxis(np.load(path + '_img.npy', mmap_mode='r'), 0, 2)
+    if no_masks:
+        return img
+    return img, np.moveaxis(np.load(path + '_mask.npy', mmap_mode='r'), 0, 2), np.load(path + '_slices.npy')
+
+def nonempty_slices(mask, slices=None):
+    '''
+        Flags of the slices with any mask, from the precomputed indices if there are some. A window of slices
+        j:j+n:s has a mask if any of nonempty[j:j+n:s] does, the volume is not scanned again.
+    '''
+    nonempty = np.zeros(mask.shape[2], dtype=bool)
+    if slices is None:
+        slices = np.flatnonzero(np.any(mask, axis=(0, 1)))
+    nonempty[slices] = True
+    return nonempty
+
+def convert_data_to_numpy(root_path, img_name, no_masks=False, overwrite=False, uncompressed=False):
+    '''
+        Converts a scan (and its mask) to <root>/np_files/<fname>.npz, or with uncompressed to memory-mappable .npy
+        files (save_uncompressed). An existing npz is reused for the uncompressed files.
+    '''
     fname = img_name[:-4]
     numpy_path = join(root_path, 'np_files')
     img_path = join(root_path, 'imgs')
@@ -134,6 +180,9 @@ def convert_data_to_numpy(root_path, img_name, no_masks=False, overwrite=False):
     if not overwrite:
         try:
             with np.load(join(numpy_path, fname + '.npz')) as data:
+                if uncompressed:
+                    save_uncompressed(numpy_path, fname, data['img'], None if no_masks else data['mask'])
+                    return data['img'] if no_masks else (data['img'], data['mask'])
                 return data['img'], data['mask']
         except:
             pass
@@ -190,7 +239,9 @@ def convert_data_to_numpy(root_path, img_name, no_masks=False, overwrite=False):
             print(e)
             print('-'*100+'\n')
 
-        if not no_masks:
+        if uncompressed:
+            save_uncompressed(numpy_path, fname, img, None if no_masks else mask)
+        elif not no_masks:
             np.savez_compressed(join(numpy_path, fname + '.npz'), img=img, mask=mask)
         else:
             np.savez_compressed(join(numpy_path, fname + '.npz'), img=img)
@@ -228,7 +279,9 @@ def augmentImages(batch_of_images, batch_of_masks):
                                            fill_mode='constant', cval=0.)
 
         if np.random.randint(0, 5) == 3:
-            img_and_mask = elastic_transform(img_and_mask, alpha=1000, sigma=80, alpha_affine=50)
+            # drawn from the global state like the other augmentations, so np.random.seed makes the batches repeatable
+            img_and_mask = elastic_transform(img_and_mask, alpha=1000, sigma=80, alpha_affine=50,
+                                             random_state=np.random.RandomState(np.random.randint(2**31)))
 
         if np.random.randint(0, 10) == 7:
             img_and_mask = random_shift(img_and_mask, wrg=0.2, hrg=0.2, row_axis=0, col_axis=1, channel_axis=2,
@@ -286,13 +339,143 @@ class threadsafe_iter:
 def threadsafe_generator(f):
     """A decorator that takes a generator function and makes it thread-safe.
     """
+    @functools.wraps(f) # keeps the name, so the generators can be handed to worker processes
     def g(*a, **kw):
         return threadsafe_iter(f(*a, **kw))
     return g
 
+
+''' Produce the batches of a generator in worker processes '''
+def _flatten(batch, arrays):
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_flatten(b, arrays) for b in batch)
+    arrays.append(np.ascontiguousarray(batch))
+    return len(arrays) - 1
+
+def _unflatten(structure, arrays):
+    if isinstance(structure, (list, tuple)):
+        return type(structure)(_unflatten(s, arrays) for s in structure)
+    return arrays[structure]
+
+class NoWindowsError(ValueError):
+    ''' A pass over the scans of an endless generator found no window with a mask, it would never yield '''
+
+def _prefetch_worker(generator, args, kwargs, seed, slots, free, ready):
+    '''
+        Runs the generator on its shard of scans and copies every batch into a free shared memory slot. The slot,
+        the nesting of the batch and the (dtype, shape, offset) of its arrays go to the ready queue; None when the
+        generator is exhausted, the NoWindowsError of a shard without masks, an error message if it raised.
+    '''
+    try:
+        np.random.seed(seed)
+        buffers = [np.frombuffer(slot, dtype=np.uint8) for slot in slots]
+        for batch in generator(*args, **kwargs):
+            arrays = []
+            structure = _flatten(batch, arrays)
+            slot = free.get()
+            offset, meta = 0, []
+            for a in arrays:
+                if offset + a.nbytes > len(buffers[slot]):
+                    raise ValueError('A batch needs more than the {} bytes of a slot, raise slot_bytes'.format(len(buffers[slot])))
+                buffers[slot][offset:offset + a.nbytes] = a.reshape(-1).view(np.uint8)
+                meta.append((a.dtype.str, a.shape, offset))
+                offset += a.nbytes
+            ready.put((slot, structure, meta))
+        ready.put(None)
+    except NoWindowsError as e:
+        ready.put(e)
+    except Exception:
+        ready.put(traceback.format_exc())
+
+def _ready_item(ready, worker, w, poll=1.):
+    ''' Next item of a worker's ready queue, an error instead of waiting forever when the worker died (OOM killer, signal) '''
+    while True:
+        try:
+            return ready.get(timeout=poll)
+        except queue_module.Empty:
+            pass
+        if not worker.is_alive():
+            # the last item may have been flushed to the pipe just before the worker exited
+            try:
+                return ready.get(timeout=poll)
+            except queue_module.Empty:
+                raise RuntimeError('Batch worker {} died with exit code {}'.format(w, worker.exitcode))
+
+@threadsafe_generator
+def prefetch_batches(generator, root_path, scan_list, net_input_shape, num_workers=4, queue_size=4, seed=1, copy=False,
+                     slot_bytes=None, report_every=100, **kwargs):
+    '''
+        Producer/consumer pipeline around generate_train_batches, generate_val_batches or generate_test_batches.
+        num_workers processes each run the generator on their own shard of scan_list (scan_list[w::num_workers]),
+        worker w seeded with seed + w, and fill queue_size shared memory slots of ready batches. The batches are
+        taken from the workers in turn, so the sequence of batches, augmentation included, is the same on every run
+        (unless the generator reseeds itself: subSampAmt=-1 with numSlices > 1).
+        The yielded arrays are views of the slot and stay valid until the next batch is requested, like the
+        buffers the generators reuse; copy=True yields copies, for consumers that keep batches (Keras' queue).
+        A worker whose shard has no window with a mask is dropped (an error if that is every worker), a worker that
+        dies raises in the consumer.
+        Every report_every batches the throughput and the time spent waiting for the workers is printed.
+    '''
+    num_workers = max(1, min(num_workers, len(scan_list)))
+    if slot_bytes is None:
+        # img (float32), mask, mask (uint8) and mask*img (float32) of the caps generators
+        slot_bytes = kwargs.get('batchSize', 1) * int(np.prod(net_input_shape)) * 10
+    workers, free, ready, slots = [], [], [], []
+    for w in range(num_workers):
+        slots.append([multiprocessing.RawArray('B', slot_bytes) for _ in range(queue_size)])
+        free.append(multiprocessing.Queue())
+        ready.append(multiprocessing.Queue())
+        for slot in range(queue_size):
+            free[w].put(slot)
+        args = (root_path, scan_list[w::num_workers], net_input_shape)
+        workers.append(multiprocessing.Process(target=_prefetch_worker, args=(generator, args, kwargs, seed + w, slots[w], free[w], ready[w])))
+        workers[w].daemon = True
+        workers[w].start()
+    buffers = [[np.frombuffer(slot, dtype=np.uint8) for slot in worker_slots] for worker_slots in slots]
+
+    try:
+        active, empty = list(range(num_workers)), 0
+        count, waited, start = 0, 0., time.time()
+        while active:
+            for w in list(active):
+                t = time.time()
+                item = _ready_item(ready[w], workers[w], w)
+                waited += time.time() - t
+                if item is None:
+                    active.remove(w)
+                    continue
+                if isinstance(item, NoWindowsError):
+                    empty += 1
+                    if empty == num_workers:
+                        raise item
+                    print('\nprefetch: worker {} stopped, {}'.format(w, item))
+                    active.remove(w)
+                    continue
+                if not isinstance(item, tuple):
+                    raise RuntimeError('Batch worker {} failed:\n{}'.format(w, item))
+                slot, structure, meta = item
+                arrays = [np.frombuffer(buffers[w][slot], dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+                          for dtype, shape, offset in meta]
+                if copy:
+                    arrays = [a.copy() for a in arrays]
+                    free[w].put(slot)
+                yield _unflatten(structure, arrays)
+                if not copy:
+                    free[w].put(slot) # the next batch is asked for, this one has been used
+
+                count += 1
+                if report_every and count % report_every == 0:
+                    elapsed = time.time() - start
+                    print('\nprefetch: {} batches, {:.2f} batches/s, {:.0f}% of the time waiting for {} workers'.format(
+                        count, count / elapsed, 100. * waited / elapsed, num_workers))
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
 @threadsafe_generator
 def generate_train_batches(root_path, train_list, net_input_shape, net, batchSize=1, numSlices=1, subSampAmt=-1,
-                           stride=1, downSampAmt=1, shuff=1, aug_data=1):
+                           stride=1, downSampAmt=1, shuff=1, aug_data=1, uncompressed=0):
     # Create placeholders for training
     img_batch = np.zeros((np.concatenate(((batchSize,), net_input_shape))), dtype=np.float32)
     mask_batch = np.zeros((np.concatenate(((batchSize,), net_input_shape))), dtype=np.uint8)
@@ -301,20 +484,27 @@ def generate_train_batches(root_path, train_list, net_input_shape, net, batchSiz
         if shuff:
             shuffle(train_list)
         count = 0
+        windows = 0
         for i, scan_name in enumerate(train_list):
             try:
                 scan_name = scan_name[0]
-                path_to_np = join(root_path,'np_files',basename(scan_name)[:-3]+'npz')
-                with np.load(path_to_np) as data:
-                    train_img = data['img']
-                    train_mask = data['mask']
+                if uncompressed:
+                    train_img, train_mask, slices = load_uncompressed(root_path, scan_name)
+                else:
+                    path_to_np = join(root_path,'np_files',basename(scan_name)[:-3]+'npz')
+                    with np.load(path_to_np) as data:
+                        train_img = data['img']
+                        train_mask = data['mask']
+                    slices = None
             except:
                 print('\nPre-made numpy array not found for {}.\nCreating now...'.format(scan_name[:-4]))
-                train_img, train_mask = convert_data_to_numpy(root_path, scan_name)
+                train_img, train_mask = convert_data_to_numpy(root_path, scan_name, uncompressed=uncompressed)
+                slices = None
                 if np.array_equal(train_img,np.zeros(1)):
                     continue
                 else:
                     print('\nFinished making npz file.')
+            nonempty = nonempty_slices(train_mask, slices)
 
             if numSlices == 1:
                 subSampAmt = 0
@@ -327,7 +517,7 @@ def generate_train_batches(root_path, train_list, net_input_shape, net, batchSiz
                 shuffle(indicies)
 
             for j in indicies:
-                if not np.any(train_mask[:, :, j:j + numSlices * (subSampAmt+1):subSampAmt+1]):
+                if not np.any(nonempty[j:j + numSlices * (subSampAmt+1):subSampAmt+1]):
                     continue
                 if img_batch.ndim == 4:
                     img_batch[count, :, :, :] = train_img[:, :, j:j + numSlices * (subSampAmt+1):subSampAmt+1]
@@ -341,6 +531,7 @@ def generate_train_batches(root_path, train_list, net_input_shape, net, batchSiz
                     exit(0)
 
                 count += 1
+                windows += 1
                 if count % batchSize == 0:
                     count = 0
                     if aug_data:
@@ -359,6 +550,8 @@ def generate_train_batches(root_path, train_list, net_input_shape, net, batchSiz
                     else:
                         yield (img_batch, mask_batch)
 
+        if windows == 0:
+            raise NoWindowsError('none of the {} scans has a slice with a mask'.format(len(train_list)))
         if count != 0:
             if aug_data:
                 img_batch[:count,...], mask_batch[:count,...] = augmentImages(img_batch[:count,...],
@@ -371,7 +564,7 @@ def generate_train_batches(root_path, train_list, net_input_shape, net, batchSiz
 
 @threadsafe_generator
 def generate_val_batches(root_path, val_list, net_input_shape, net, batchSize=1, numSlices=1, subSampAmt=-1,
-                         stride=1, downSampAmt=1, shuff=1):
+                         stride=1, downSampAmt=1, shuff=1, uncompressed=0):
     # Create placeholders for validation
     img_batch = np.zeros((np.concatenate(((batchSize,), net_input_shape))), dtype=np.float32)
     mask_batch = np.zeros((np.concatenate(((batchSize,), net_input_shape))), dtype=np.uint8)
@@ -380,20 +573,27 @@ def generate_val_batches(root_path, val_list, net_input_shape, net, batchSize=1,
         if shuff:
             shuffle(val_list)
         count = 0
+        windows = 0
         for i, scan_name in enumerate(val_list):
             try:
                 scan_name = scan_name[0]
-                path_to_np = join(root_path,'np_files',basename(scan_name)[:-3]+'npz')
-                with np.load(path_to_np) as data:
-                    val_img = data['img']
-                    val_mask = data['mask']
+                if uncompressed:
+                    val_img, val_mask, slices = load_uncompressed(root_path, scan_name)
+                else:
+                    path_to_np = join(root_path,'np_files',basename(scan_name)[:-3]+'npz')
+                    with np.load(path_to_np) as data:
+                        val_img = data['img']
+                        val_mask = data['mask']
+                    slices = None
             except:
                 print('\nPre-made numpy array not found for {}.\nCreating now...'.format(scan_name[:-4]))
-                val_img, val_mask = convert_data_to_numpy(root_path, scan_name)
+                val_img, val_mask = convert_data_to_numpy(root_path, scan_name, uncompressed=uncompressed)
+                slices = None
                 if np.array_equal(val_img,np.zeros(1)):
                     continue
                 else:
                     print('\nFinished making npz file.')
+            nonempty = nonempty_slices(val_mask, slices)
 
             if numSlices == 1:
                 subSampAmt = 0
@@ -406,7 +606,7 @@ def generate_val_batches(root_path, val_list, net_input_shape, net, batchSize=1,
                 shuffle(indicies)
 
             for j in indicies:
-                if not np.any(val_mask[:, :, j:j + numSlices * (subSampAmt+1):subSampAmt+1]):
+                if not np.any(nonempty[j:j + numSlices * (subSampAmt+1):subSampAmt+1]):
                     continue
                 if img_batch.ndim == 4:
                     img_batch[count, :, :, :] = val_img[:, :, j:j + numSlices * (subSampAmt+1):subSampAmt+1]
@@ -420,6 +620,7 @@ def generate_val_batches(root_path, val_list, net_input_shape, net, batchSize=1,
                     exit(0)
 
                 count += 1
+                windows += 1
                 if count % batchSize == 0:
                     count = 0
                     if net.find('caps') != -1:
@@ -427,6 +628,8 @@ def generate_val_batches(root_path, val_list, net_input_shape, net, batchSize=1,
                     else:
                         yield (img_batch, mask_batch)
 
+        if windows == 0:
+            raise NoWindowsError('none of the {} scans has a slice with a mask'.format(len(val_list)))
         if count != 0:
             if net.find('caps') != -1:
                 yield ([img_batch[:count, ...], mask_batch[:count, ...]],
@@ -436,19 +639,22 @@ def generate_val_batches(root_path, val_list, net_input_shape, net, batchSize=1,
 
 @threadsafe_generator
 def generate_test_batches(root_path, test_list, net_input_shape, batchSize=1, numSlices=1, subSampAmt=0,
-                          stride=1, downSampAmt=1):
+                          stride=1, downSampAmt=1, uncompressed=0):
     # Create placeholders for testing
     img_batch = np.zeros((np.concatenate(((batchSize,), net_input_shape))), dtype=np.float32)
     count = 0
     for i, scan_name in enumerate(test_list):
         try:
             scan_name = scan_name[0]
-            path_to_np = join(root_path,'np_files',basename(scan_name)[:-3]+'npz')
-            with np.load(path_to_np) as data:
-                test_img = data['img']
+            if uncompressed:
+                test_img = load_uncompressed(root_path, scan_name, no_masks=True)
+            else:
+                path_to_np = join(root_path,'np_files',basename(scan_name)[:-3]+'npz')
+                with np.load(path_to_np) as data:
+                    test_img = data['img']
         except:
             print('\nPre-made numpy array not found for {}.\nCreating now...'.format(scan_name[:-4]))
-            test_img = convert_data_to_numpy(root_path, scan_name, no_masks=True)
+            test_img = convert_data_to_numpy(root_path, scan_name, no_masks=True, uncompressed=uncompressed)
             if np.array_equal(test_img,np.zeros(1)):
                 continue
             else:
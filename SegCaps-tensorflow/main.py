@@ -51,8 +51,10 @@ def main(args):
     net_input_shape = (img_shape[1], img_shape[2], args.slices)
 
     if args.pytorch:
+        import torch
         from capsnet_pytorch import CapsNetBasic, CapsNetR3
-        model = CapsNetR3() #CapsNetBasic()
+        device = torch.device('cpu') if args.which_gpus == '-2' else torch.device('cuda')
+        model = CapsNetR3(device=device, tile=args.tile or None) #CapsNetBasic()
     else:
         # Create the model for training/testing/manipulation
         model_list = create_model(args=args, input_shape=net_input_shape)
@@ -93,7 +95,7 @@ def main(args):
         if args.train:
             from train_pytorch import train
             # Run training
-            train(args, model, train_list, net_input_shape)
+            train(args, model, train_list, net_input_shape, device)
             #train(args, train_list, val_list, model_list[0], net_input_shape)
         
         
@@ -151,8 +153,16 @@ if __name__ == '__main__':
                              'subsampling up to 5% of total slices.')
     parser.add_argument('--stride', type=int, default=1,
                         help='Number of slices to move when generating the next sample.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Worker processes producing the training batches, each from its own share of the scans '
+                             '(0: produce them in the training process).')
+    parser.add_argument('--uncompressed', type=int, default=0, choices=[0,1],
+                        help='1: Read the scans from uncompressed, memory-mapped .npy files (made from the npz files '
+                             'or the scans on first use) instead of decompressing the npz files on every visit.')
 
     parser.add_argument('--pytorch', action='store_true', help='Use Pytorch')
+    parser.add_argument('--tile', type=int, default=0,
+                        help='Pytorch: route the capsule layers in tiles of this many positions per side (0: whole slice).')
     
     parser.add_argument('--verbose', type=int, default=1, choices=[0, 1, 2],
                         help='Set the verbose value for training. 0: Silent, 1: per iteration, 2: per epoch.')
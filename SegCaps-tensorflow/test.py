@@ -134,7 +134,8 @@ def test(args, test_list, model_list, net_input_shape):
                                                                               batchSize=args.batch_size,
                                                                               numSlices=args.slices,
                                                                               subSampAmt=0,
-                                                                              stride=1),
+                                                                              stride=1,
+                                                                              uncompressed=args.uncompressed),
                                                         steps=num_slices, max_queue_size=1, workers=1,
                                                         use_multiprocessing=False, verbose=1)
 
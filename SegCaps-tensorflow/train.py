@@ -26,7 +26,7 @@ from keras.callbacks import ModelCheckpoint, CSVLogger, EarlyStopping, ReduceLRO
 import tensorflow as tf
 
 from custom_losses import dice_hard, weighted_binary_crossentropy_loss, dice_loss, margin_loss
-from load_3D_data import load_class_weights, generate_train_batches, generate_val_batches
+from load_3D_data import load_class_weights, generate_train_batches, generate_val_batches, prefetch_batches
 
 
 def get_loss(root, split, net, recon_wei, choice):
@@ -135,16 +135,22 @@ def train(args, train_list, val_list, u_model, net_input_shape):
     # Set the callbacks
     callbacks = get_callbacks(args)
 
-    # Training the network
+    # Training the network, the batches produced by worker processes (copies, Keras queues them)
+    train_kwargs = dict(net=args.net, batchSize=args.batch_size, numSlices=args.slices, subSampAmt=args.subsamp,
+                        stride=args.stride, shuff=args.shuffle_data, aug_data=args.aug_data,
+                        uncompressed=args.uncompressed)
+    if args.workers:
+        train_batches = prefetch_batches(generate_train_batches, args.data_root_dir, train_list, net_input_shape,
+                                         num_workers=args.workers, copy=True, **train_kwargs)
+    else:
+        train_batches = generate_train_batches(args.data_root_dir, train_list, net_input_shape, **train_kwargs)
     history = model.fit_generator(
-        generate_train_batches(args.data_root_dir, train_list, net_input_shape, net=args.net,
-                               batchSize=args.batch_size, numSlices=args.slices, subSampAmt=args.subsamp,
-                               stride=args.stride, shuff=args.shuffle_data, aug_data=args.aug_data),
-        max_queue_size=40, workers=4, use_multiprocessing=False,
+        train_batches,
+        max_queue_size=40, workers=1 if args.workers else 4, use_multiprocessing=False,
         steps_per_epoch=10000,
         validation_data=generate_val_batches(args.data_root_dir, val_list, net_input_shape, net=args.net,
                                              batchSize=args.batch_size,  numSlices=args.slices, subSampAmt=0,
-                                             stride=20, shuff=args.shuffle_data),
+                                             stride=20, shuff=args.shuffle_data, uncompressed=args.uncompressed),
         validation_steps=500, # Set validation stride larger to see more of the data.
         epochs=200,
         callbacks=callbacks,
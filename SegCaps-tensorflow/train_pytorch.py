@@ -33,13 +33,13 @@ import tensorflow as tf
 """
 
 #from custom_losses import dice_hard, weighted_binary_crossentropy_loss, dice_loss, margin_loss
-from load_3D_data import load_class_weights, generate_train_batches, generate_val_batches
+from load_3D_data import load_class_weights, generate_train_batches, generate_val_batches, prefetch_batches
 
 class WeightedBinaryCrossEntropy(nn.Module):
-    def __init__(self, pos_weight):
+    def __init__(self, pos_weight, device):
         super(WeightedBinaryCrossEntropy, self).__init__()
         self.pos_weight = pos_weight
-        self.zero_tensor = torch.zeros(1).cuda()
+        self.zero_tensor = torch.zeros(1, device=device)
 
 
     def weighted_cross_entropy_with_logits(self, logits, target):
@@ -86,10 +86,10 @@ class WeightedBinaryCrossEntropy(nn.Module):
                                                         pos_weight=pos_weight)
         """
 
-def get_loss(root, split, net, recon_wei, choice):
+def get_loss(root, split, net, recon_wei, choice, device):
     if choice == 'w_bce':
         pos_class_weight = load_class_weights(root=root, split=split)
-        loss = WeightedBinaryCrossEntropy(pos_class_weight)
+        loss = WeightedBinaryCrossEntropy(pos_class_weight, device)
     elif choice == 'bce':
         loss = 'binary_crossentropy'
     elif choice == 'dice':
@@ -203,7 +203,7 @@ def save_image(imgs, path):
     imgs = Image.fromarray(imgs)
     imgs.save(path)
 
-def train(args, model, train_list, net_input_shape):
+def train(args, model, train_list, net_input_shape, device):
     """
     # Compile the loaded model
     model = compile_model(args=args, net_input_shape=net_input_shape, uncomp_model=u_model)
@@ -226,32 +226,38 @@ def train(args, model, train_list, net_input_shape):
         verbose=1)
     """
 
-    model.cuda()
+    model.to(device)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=args.initial_lr, betas=(0.99, 0.999))
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.05, patience=5, verbose=True)
 
     loss, loss_weighting = get_loss(root=args.data_root_dir, split=args.split_num, net=args.net,
-                                    recon_wei=args.recon_wei, choice=args.loss)
+                                    recon_wei=args.recon_wei, choice=args.loss, device=device)
 
     recon_loss = nn.MSELoss(reduction='sum')
 
 
-    fit_generator = generate_train_batches(args.data_root_dir, train_list, net_input_shape, net=args.net,
-                               batchSize=args.batch_size, numSlices=args.slices, subSampAmt=args.subsamp,
-                               stride=args.stride, shuff=args.shuffle_data, aug_data=args.aug_data)
+    train_kwargs = dict(net=args.net, batchSize=args.batch_size, numSlices=args.slices, subSampAmt=args.subsamp,
+                        stride=args.stride, shuff=args.shuffle_data, aug_data=args.aug_data,
+                        uncompressed=args.uncompressed)
+    if args.workers:
+        # batches are views of shared memory, used up (copied to the device) before the next one is asked for
+        fit_generator = prefetch_batches(generate_train_batches, args.data_root_dir, train_list, net_input_shape,
+                                         num_workers=args.workers, **train_kwargs)
+    else:
+        fit_generator = generate_train_batches(args.data_root_dir, train_list, net_input_shape, **train_kwargs)
 
     factor = 1.
 
     for i, batch in enumerate(fit_generator):
         x = torch.from_numpy(batch[0][0]).float().permute(0,3,1,2) # -> (1,512,512,1)
-        x = Variable(x).cuda()
+        x = Variable(x).to(device)
         x1 = torch.from_numpy(batch[0][1]).float().permute(0,3,1,2) # -> (1,512,512,1)
-        x1 = Variable(x1).cuda()
+        x1 = Variable(x1).to(device)
         y = torch.from_numpy(batch[1][0]).float().permute(0,3,1,2) # -> (1,512,512,1)
-        y = y.cuda()
+        y = y.to(device)
         label_recon = torch.from_numpy(batch[1][1]).float().permute(0,3,1,2) # -> (1,512,512,1)
-        label_recon = label_recon.cuda()
+        label_recon = label_recon.to(device)
 
         optimizer.zero_grad()
 
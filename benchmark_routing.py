@@ -0,0 +1,192 @@
+'''
+Routing micro-benchmarks
+
+Times the routing step of the capsule projects in isolation, on random votes:
+  matrix   PoseCapsules_experimental2 layers.MatrixRouting
+  em       Matrix-Capsule-Network ConvCaps.EM_routing
+  angle    Matrix-Capsule-Network ConvCaps.angle_routing
+  dynamic  DynamicRouting layers._routing
+  segcaps  SegCaps-tensorflow capsule_layers_pytorch.update_routing
+
+Every combination of the sweep runs in a forked process, so the projects (which all have their own
+layers.py/util.py) do not clash and the peak memory of one case does not hide the next.
+Results are written as JSON, e.g.
+
+    python benchmark_routing.py --batch 8 32 --output_caps 10 32 --output routing.json
+'''
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import resource
+import sys
+import time
+import types
+
+import torch
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+PROJECTS = {
+    'matrix': 'PoseCapsules_experimental2',
+    'em': 'Matrix-Capsule-Network',
+    'angle': 'Matrix-Capsule-Network',
+    'dynamic': 'DynamicRouting',
+    'segcaps': 'SegCaps-tensorflow',
+}
+
+
+def make_matrix(b, B, C, h, iterations, device):
+    import layers
+    routing = layers.MatrixRouting(output_dim=C, num_routing=iterations).to(device)
+    V = torch.randn(b, B, C, h, 1, 1, device=device)
+    a = torch.rand(b, B, C, 1, 1, 1, device=device)
+    return routing, lambda: routing((V, a))[0], [V]
+
+
+def make_em(b, B, C, h, iterations, device, routing='EM_routing'):
+    from model.capsules import ConvCaps
+    args = types.SimpleNamespace(batch_size=b, routing=routing, routing_bytes=None, routing_tol=None)
+    caps = ConvCaps(args, B=B, C=C, kernel=1, stride=1, h=int(h ** 0.5), iteration=iterations).to(device)
+    caps.b, caps.Bkk, caps.Cww = b, B, C
+    V = torch.randn(b, B, C, caps.hh, device=device)
+    a = torch.rand(b, B, C, device=device)
+    return caps, lambda: getattr(caps, routing)(0.01, a, V)[1], [V]
+
+
+def make_angle(b, B, C, h, iterations, device):
+    return make_em(b, B, C, h, iterations, device, routing='angle_routing')
+
+
+def make_dynamic(b, B, C, h, iterations, device):
+    import layers
+    votes = torch.randn(b, B, C, h, 1, 1, device=device)
+    biases = torch.full((C, h, 1, 1), 0.1, device=device)
+    return None, lambda: layers._routing(votes, biases, iterations), [votes]
+
+
+def make_segcaps(b, B, C, h, iterations, device):
+    from capsule_layers_pytorch import update_routing
+    votes = torch.randn(b, B, 1, 1, C, h, device=device)
+    biases = torch.full((1, 1, C, h), 0.1, device=device)
+    return None, lambda: update_routing(votes, biases, iterations), [votes]
+
+
+def peak_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+
+def run_case(case, args, queue):
+    """ Child process: import the project, build the routing inputs and time args.repeat calls """
+    result = dict(case)
+    try:
+        torch.set_num_threads(args.threads)
+        torch.manual_seed(0)
+        device = torch.device(args.device)
+        sys.path.insert(0, os.path.join(ROOT, PROJECTS[case['backend']]))
+        make = globals()['make_' + case['backend']]
+        module, routing, inputs = make(case['batch'], case['input_caps'], case['output_caps'], case['pose'], case['iterations'], device)
+        for x in inputs:
+            x.requires_grad_(args.backward)
+
+        def step():
+            out = routing()
+            if args.backward:
+                out.sum().backward()
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+
+        """ Peak memory above the inputs, over the warm-up and timed calls """
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline = torch.cuda.memory_allocated(device)
+        else:
+            baseline = peak_memory(device)
+
+        with torch.set_grad_enabled(args.backward):
+            for _ in range(args.warmup):
+                step()
+            times = []
+            for _ in range(args.repeat):
+                t = time.perf_counter()
+                step()
+                times.append(time.perf_counter() - t)
+
+        mean = sum(times) / len(times)
+        result.update(time_s_mean=mean, time_s_min=min(times),
+                      peak_bytes=peak_memory(device) - baseline,
+                      capsules_per_s=case['batch'] * case['input_caps'] / mean)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    queue.put(result)
+
+
+def wait_case(case, process, queue, timeout=None, poll=1.):
+    """
+    Result of a forked case. A child that dies without reporting (killed by the OOM killer or a signal,
+    crashed interpreter) or runs longer than timeout seconds becomes an error entry instead of a hang
+    """
+    start = time.time()
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except queue_module.Empty:
+            pass
+        if not process.is_alive():
+            """ The result may have been flushed to the pipe just before the child exited """
+            try:
+                return queue.get(timeout=poll)
+            except queue_module.Empty:
+                return dict(case, error='process died with exit code {}'.format(process.exitcode))
+        if timeout is not None and time.time() - start > timeout:
+            process.terminate()
+            return dict(case, error='timed out after {:.0f} s'.format(timeout))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Routing micro-benchmarks (JSON output)')
+    parser.add_argument('--backends', nargs='+', default=list(PROJECTS), choices=list(PROJECTS))
+    parser.add_argument('--batch', type=int, nargs='+', default=[8])
+    parser.add_argument('--input_caps', type=int, nargs='+', default=[288])
+    parser.add_argument('--output_caps', type=int, nargs='+', default=[32])
+    parser.add_argument('--pose', type=int, nargs='+', default=[16], help='pose/atom size (matrix capsules need a square)')
+    parser.add_argument('--iterations', type=int, nargs='+', default=[3])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--backward', action='store_true', help='time forward and backward')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--output', type=str, default=None, help='JSON file (stdout if not given)')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which a case is killed and recorded as an error')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    results = []
+    for backend, b, B, C, h, r in itertools.product(args.backends, args.batch, args.input_caps, args.output_caps, args.pose, args.iterations):
+        case = dict(backend=backend, batch=b, input_caps=B, output_caps=C, pose=h, iterations=r)
+        queue = context.Queue()
+        process = context.Process(target=run_case, args=(case, args, queue))
+        process.start()
+        result = wait_case(case, process, queue, args.timeout)
+        process.join()
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    report = dict(torch=torch.__version__, python=platform.python_version(), machine=platform.machine(),
+                  device=args.device, threads=args.threads, backward=args.backward, repeat=args.repeat,
+                  date=time.strftime('%Y-%m-%d %H:%M:%S'), results=results)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()